@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+"""Fake Cisco WLC SSH server used by the benchmarks
+
+Speaks the AireOS login (User:/Password:) and the netuser dialogue used by
+wlc_guest_user_creator.py with a configurable latency and error injection.
+"""
+
+import random
+import socket
+import threading
+from time import sleep
+
+import paramiko
+
+wlc_prompt = '(Cisco Controller) >'
+host_key = None
+host_key_lock = threading.Lock()
+
+
+def get_host_key():
+    #generating an RSA key is slow, all the fake WLCs share one
+    global host_key
+    with host_key_lock:
+        if host_key is None:
+            host_key = paramiko.RSAKey.generate(2048)
+        return host_key
+
+
+class fake_wlc_ssh_interface(paramiko.ServerInterface):
+    """Accepts SSH password logins for the fake WLC
+    """
+    def __init__(self, wlc):
+        self.wlc = wlc
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if self.wlc.auth_failure_rate and self.wlc.random.random() < self.wlc.auth_failure_rate:
+            return paramiko.AUTH_FAILED
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        return True
+
+
+class fake_wlc(object):
+    """One fake WLC listening on address:port, its guest users are kept in memory
+    """
+    def __init__(self, address='127.0.0.1', port=0, username='admin', password='password', command_latency=0.0, save_latency=0.0, login_latency=0.0, add_failure_rate=0.0, auth_failure_rate=0.0, delete_syntax='username', seed=None):
+        self.address = address
+        self.username = username
+        self.password = password
+        self.command_latency = command_latency
+        self.save_latency = save_latency
+        self.login_latency = login_latency
+        self.add_failure_rate = add_failure_rate
+        self.auth_failure_rate = auth_failure_rate
+        #username: accepts "config netuser delete username X", legacy: only "config netuser delete X"
+        self.delete_syntax = delete_syntax
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.netusers = {}
+        self.sessions = 0
+        self.commands = 0
+        self.saves = 0
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind((address, port))
+        self.listen_socket.listen(100)
+        self.port = self.listen_socket.getsockname()[1]
+        self.stopping = False
+
+
+    def start(self):
+        threading.Thread(target=self.accept_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self.stopping = True
+        try:
+            self.listen_socket.close()
+        except OSError:
+            pass
+
+
+    def accept_forever(self):
+        while not self.stopping:
+            try:
+                client_socket, client_address = self.listen_socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve_client, args=(client_socket,), daemon=True).start()
+
+
+    def serve_client(self, client_socket):
+        transport = paramiko.Transport(client_socket)
+        transport.add_server_key(get_host_key())
+        try:
+            transport.start_server(server=fake_wlc_ssh_interface(self))
+            channel = transport.accept(20)
+            if channel is None:
+                return
+            with self.lock:
+                self.sessions += 1
+            fake_wlc_session(self, channel).run()
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            transport.close()
+
+
+    def run_command(self, command):
+        #Returns the CLI output of one command, the prompt is added by the session
+        words = command.split()
+        with self.lock:
+            self.commands += 1
+        if self.command_latency:
+            sleep(self.command_latency)
+
+        if command.startswith('config netuser add ') and len(words) >= 5:
+            user = words[3]
+            with self.lock:
+                if self.add_failure_rate and self.random.random() < self.add_failure_rate:
+                    return 'Request failed: Guest user not added\r\n'
+                if user in self.netusers:
+                    return 'Error: User %s already exists.\r\n' % user
+                self.netusers[user] = command
+            return ''
+        elif command.startswith('config netuser delete '):
+            if words[3] == 'username' and len(words) == 5:
+                if self.delete_syntax != 'username':
+                    return 'Incorrect usage. Use the \'?\' or <TAB> key to list commands.\r\n'
+                user = words[4]
+            elif len(words) == 4:
+                user = words[3]
+            else:
+                return 'Incorrect usage. Use the \'?\' or <TAB> key to list commands.\r\n'
+            with self.lock:
+                if self.netusers.pop(user, None) is None:
+                    return 'User %s does not exist.\r\n' % user
+            return 'Deleted user %s\r\n' % user if self.delete_syntax == 'username' else ''
+        elif command == 'show netuser summary':
+            with self.lock:
+                users = sorted(self.netusers)
+            output = 'Maximum logins allowed for a given username ........ Unlimited\r\n\r\n'
+            for user in users:
+                output += '   User Name............................... %s\r\n   WLAN Id................................. Any\r\n   Lifetime................................ Permanent\r\n   Description............................. Benchmark\r\n\r\n' % user
+            return output
+        elif command.startswith('config paging '):
+            return ''
+        return 'Incorrect usage. Use the \'?\' or <TAB> key to list commands.\r\n'
+
+
+class fake_wlc_session(object):
+    """Interactive CLI session on the fake WLC: login, then one command per line
+    """
+    def __init__(self, wlc, channel):
+        self.wlc = wlc
+        self.channel = channel
+        self.buffer = ''
+
+
+    def send(self, text):
+        self.channel.sendall(text.encode())
+
+
+    def read_line(self):
+        #Returns the next line sent by the client, \r\n, \r and \n all end a line
+        while True:
+            for i, char in enumerate(self.buffer):
+                if char in '\r\n':
+                    line = self.buffer[:i]
+                    self.buffer = self.buffer[i + 1:]
+                    if char == '\r' and self.buffer.startswith('\n'):
+                        self.buffer = self.buffer[1:]
+                    return line
+            data = self.channel.recv(65536)
+            if not data:
+                raise EOFError()
+            self.buffer += data.decode(errors='replace')
+
+
+    def buffered_line(self):
+        #the next line if the client already sent it, without waiting for it
+        if '\n' in self.buffer or '\r' in self.buffer:
+            return self.read_line()
+        return None
+
+
+    def run(self):
+        self.send('\r\n(Cisco Controller)\r\nUser: ')
+        username = self.read_line()
+        self.send(username + '\r\nPassword:')
+        password = self.read_line()
+        if self.wlc.login_latency:
+            sleep(self.wlc.login_latency)
+        if username != self.wlc.username or password != self.wlc.password:
+            self.send('\r\nLogin incorrect.\r\n')
+            self.channel.close()
+            return
+        self.send('\r\n\r\n' + wlc_prompt)
+
+        while True:
+            command = self.read_line().strip()
+            if command == 'logout':
+                self.channel.close()
+                return
+            if command == 'save config':
+                #"save config\ny" is sent in one go, the answer is echoed with the command
+                answer = self.buffered_line()
+                if answer is None:
+                    self.send(command + '\r\nAre you sure you want to save? (y/n) ')
+                    answer = self.read_line()
+                    self.send(answer + '\r\n')
+                else:
+                    self.send(command + '\r\n' + answer + '\r\nAre you sure you want to save? (y/n) \r\n')
+                if answer.strip().lower() == 'y':
+                    with self.wlc.lock:
+                        self.wlc.saves += 1
+                    if self.wlc.save_latency:
+                        sleep(self.wlc.save_latency)
+                    self.send('\r\nConfiguration Saved!\r\n' + wlc_prompt)
+                else:
+                    self.send('\r\n' + wlc_prompt)
+                continue
+            #echo, output and prompt go out in one write like on the WLC
+            if command == '':
+                self.send('\r\n' + wlc_prompt)
+                continue
+            self.send(command + '\r\n' + self.wlc.run_command(command) + wlc_prompt)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Runs a fake Cisco WLC SSH server until CTRL-C')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2222)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--command-latency', type=float, default=0.0, help='seconds added to every command')
+    parser.add_argument('--save-latency', type=float, default=0.0, help='seconds added to save config')
+    parser.add_argument('--add-failure-rate', type=float, default=0.0, help='share of user adds rejected (0-1)')
+    args = parser.parse_args()
+    wlc = fake_wlc(args.address, args.port, args.username, args.password, args.command_latency, args.save_latency, add_failure_rate=args.add_failure_rate).start()
+    print('Fake WLC listening on %s:%s' % (wlc.address, wlc.port))
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        wlc.stop()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+"""Fake WLC RESTCONF server used by the benchmarks
+
+Serves the netuser list used by the restconf transport of wlc_guest_user_creator.py:
+YANG Patch (RFC 8072) requests on the data path, GET of the list and the save-config
+operation, with HTTP basic authentication, a configurable latency and error injection.
+"""
+
+import json
+import random
+import threading
+from base64 import b64encode
+from time import sleep
+from urllib.parse import unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+data_path = '/restconf/data/wlc-guest-users:netusers'
+save_path = '/restconf/operations/cisco-ia:save-config'
+
+
+class fake_wlc_restconf_handler(BaseHTTPRequestHandler):
+    """RESTCONF requests of one HTTP connection, kept alive between requests
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def reply(self, status, body=None):
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        if payload:
+            self.send_header('Content-Type', 'application/yang-data+json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', '0'))
+        return json.loads(self.rfile.read(length).decode()) if length else None
+
+
+    def authorized(self):
+        wlc = self.server
+        if self.headers.get('Authorization') == 'Basic ' + b64encode((wlc.username + ':' + wlc.password).encode()).decode():
+            return True
+        self.read_body()
+        self.reply(401, {'ietf-restconf:errors': {'error': [{'error-type': 'protocol', 'error-tag': 'access-denied', 'error-message': 'Authentication failed'}]}})
+        return False
+
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path != self.server.data_path:
+            return self.reply(404)
+        with self.server.lock:
+            netusers = [dict(netuser, password='********') for netuser in self.server.netusers.values()]
+        self.reply(200, {'wlc-guest-users:netusers': {'netuser': netusers}})
+
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        self.read_body()
+        if self.path != self.server.save_path:
+            return self.reply(404)
+        with self.server.lock:
+            self.server.saves += 1
+        if self.server.save_latency:
+            sleep(self.server.save_latency)
+        self.reply(204)
+
+
+    def do_PATCH(self):
+        if not self.authorized():
+            return
+        wlc = self.server
+        yang_patch = self.read_body()
+        if self.path != wlc.data_path or self.headers.get('Content-Type') != 'application/yang-patch+json':
+            return self.reply(415 if self.path == wlc.data_path else 404)
+        with wlc.lock:
+            wlc.requests += 1
+        if wlc.request_latency:
+            sleep(wlc.request_latency)
+
+        yang_patch = yang_patch['ietf-yang-patch:yang-patch']
+        edit_errors = []
+        with wlc.lock:
+            #the edits are applied to a copy, the patch is committed only when every edit succeeds
+            netusers = dict(wlc.netusers)
+            for edit in yang_patch['edit']:
+                user = unquote(edit['target'].split('=', 1)[1])
+                if edit['operation'] == 'remove':
+                    netusers.pop(user, None)
+                elif edit['operation'] == 'create':
+                    if user in netusers:
+                        edit_errors.append((edit['edit-id'], 'data-exists', 'User %s already exists' % user))
+                    elif wlc.add_failure_rate and wlc.random.random() < wlc.add_failure_rate:
+                        edit_errors.append((edit['edit-id'], 'operation-failed', 'Guest user %s not added' % user))
+                    else:
+                        netusers[user] = edit['value']['netuser'][0]
+                else:
+                    edit_errors.append((edit['edit-id'], 'operation-not-supported', 'Operation %s not supported' % edit['operation']))
+            if not edit_errors:
+                wlc.netusers = netusers
+                wlc.edits += len(yang_patch['edit'])
+
+        if edit_errors:
+            return self.reply(409, {'ietf-yang-patch:yang-patch-status': {'patch-id': yang_patch['patch-id'], 'edit-status': {'edit': [
+                {'edit-id': edit_id, 'errors': {'error': [{'error-type': 'application', 'error-tag': error_tag, 'error-message': error_message}]}}
+                for edit_id, error_tag, error_message in edit_errors]}}})
+        self.reply(200, {'ietf-yang-patch:yang-patch-status': {'patch-id': yang_patch['patch-id'], 'ok': [None]}})
+
+
+class fake_wlc_restconf(ThreadingHTTPServer):
+    """One fake WLC serving RESTCONF over plain HTTP on address:port, its guest users are kept in memory
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address='127.0.0.1', port=0, username='admin', password='password', request_latency=0.0, save_latency=0.0, add_failure_rate=0.0, seed=None):
+        ThreadingHTTPServer.__init__(self, (address, port), fake_wlc_restconf_handler)
+        self.address = address
+        self.port = self.server_address[1]
+        self.username = username
+        self.password = password
+        self.request_latency = request_latency
+        self.save_latency = save_latency
+        self.add_failure_rate = add_failure_rate
+        self.data_path = data_path
+        self.save_path = save_path
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.netusers = {}
+        self.requests = 0
+        self.edits = 0
+        self.saves = 0
+
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Runs a fake WLC RESTCONF server until CTRL-C')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--request-latency', type=float, default=0.0, help='seconds added to every YANG Patch request')
+    parser.add_argument('--save-latency', type=float, default=0.0, help='seconds added to save-config')
+    parser.add_argument('--add-failure-rate', type=float, default=0.0, help='share of user creates rejected (0-1)')
+    args = parser.parse_args()
+    wlc = fake_wlc_restconf(args.address, args.port, args.username, args.password, args.request_latency, args.save_latency, args.add_failure_rate).start()
+    print('Fake WLC RESTCONF listening on http://%s:%s%s' % (wlc.address, wlc.port, wlc.data_path))
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        wlc.stop()
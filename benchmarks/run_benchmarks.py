@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for wlc_guest_user_creator.py
+
+Runs the script against local fake WLCs (fake_wlc.py over SSH, fake_wlc_restconf.py
+over RESTCONF) and a local SMTP sink (smtp_sink.py), nothing leaves the machine. Reports users/second,
+controllers/second and mails/second for each scenario.
+"""
+
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import argparse
+import configparser
+from time import monotonic
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import wlc_guest_user_creator as wgc
+from fake_wlc import fake_wlc
+import fake_wlc_restconf as fake_wlc_restconf_module
+from fake_wlc_restconf import fake_wlc_restconf
+from smtp_sink import smtp_sink
+
+#the fake WLCs drop sessions abruptly, paramiko would log every one of them
+logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+
+def start_fake_wlcs(controller_count, args):
+    #one fake WLC per controller on 127.0.0.2, 127.0.0.3, ... all listening on the port picked by the first one
+    fake_wlcs = []
+    port = 0
+    for i in range(controller_count):
+        if args.transport == 'restconf':
+            fake_wlcs.append(fake_wlc_restconf('127.0.0.%s' % (i + 2), port, 'admin', 'password', args.request_latency, args.save_latency, args.add_failure_rate, seed=i).start())
+        else:
+            fake_wlcs.append(fake_wlc('127.0.0.%s' % (i + 2), port, 'admin', 'password', args.command_latency, args.save_latency, args.login_latency, args.add_failure_rate, seed=i).start())
+        port = fake_wlcs[0].port
+    return fake_wlcs
+
+
+def restconf_settings(port, batch_size):
+    #the settings read by the restconf transport, pointing at a fake WLC over plain HTTP
+    return {'username': 'admin', 'password': 'password', 'restconf_scheme': 'http', 'restconf_port': port, 'restconf_verify_tls': False, 'restconf_timeout': 60,
+        'restconf_batch_size': batch_size, 'restconf_data_path': fake_wlc_restconf_module.data_path, 'restconf_save_path': fake_wlc_restconf_module.save_path}
+
+
+def benchmark_device(args):
+    #issue_commands_on_device() (or the restconf transport) on a single fake WLC, once per command batch size
+    results = []
+    fake_wlcs = start_fake_wlcs(1, args)
+    wgc.log.addHandler(logging.NullHandler())
+    wgc.log.propagate = False
+    for batch_size in args.batch_sizes:
+        selected_data = ['BENCH', fake_wlcs[0].address, 'FAKE-WLC', 'BENCH_DEVICE', str(args.users), '1', 'Bench_SSID', 'guest', '86400', 'Europe/London', 'Benchmark', 'bench@example.com', '', '']
+        user_credentials, command_list = next(wgc.iter_user_chunks(selected_data, args.users))
+        start = monotonic()
+        if args.transport == 'restconf':
+            transport = wgc.restconf_transport(restconf_settings(fake_wlcs[0].port, batch_size))
+            outcome = transport.issue_commands('FAKE-WLC', fake_wlcs[0].address, command_list)
+        else:
+            outcome = wgc.issue_commands_on_device('cisco_wlc', 'FAKE-WLC', fake_wlcs[0].address, 'admin', 'password', command_list, batch_size, False, 'auto', None, True, fake_wlcs[0].port)
+        elapsed = monotonic() - start
+        results.append({
+            'scenario': 'device %s batch_size=%s' % (args.transport, batch_size),
+            'outcome': outcome,
+            'seconds': round(elapsed, 3),
+            'users_per_second': round(len(user_credentials) / elapsed, 2),
+            'commands_per_second': round(len(command_list) / elapsed, 2),
+        })
+    for wlc in fake_wlcs:
+        wlc.stop()
+    return results
+
+
+#files and folders written by the script, kept in the work folder of the benchmark when set (empty ones stay disabled)
+benchmark_side_files = ['JournalDir', 'LedgerFile', 'LatencyProfileFile', 'PreflightCacheFile', 'QueueFile', 'PoolFile']
+
+
+def write_benchmark_files(work_dir, job_count, user_count, controllers, sink, overrides):
+    #config.ini of the repo with the servers, files and overrides of the benchmark
+    #nothing is written next to the script: every file of the run goes in work_dir
+    repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(os.path.join(repo_dir, 'config.ini'))
+    config['DEVICE_PARAMETERS']['Username'] = 'admin'
+    config['DEVICE_PARAMETERS']['Password'] = 'password'
+    config['DEVICE_PARAMETERS']['SshPort'] = str(controllers[0].port)
+    if isinstance(controllers[0], fake_wlc_restconf):
+        config['DEVICE_PARAMETERS']['DefaultTransport'] = 'restconf'
+        config['DEVICE_PARAMETERS']['RestconfScheme'] = 'http'
+        config['DEVICE_PARAMETERS']['RestconfPort'] = str(controllers[0].port)
+    config['GLOBAL_PARAMETERS']['EmailServer'] = sink.address()
+    config['GLOBAL_PARAMETERS']['CsvFile'] = os.path.join(work_dir, 'job_data.csv')
+    config['GLOBAL_PARAMETERS']['CsvRowsSkip'] = '1'
+    config['GLOBAL_PARAMETERS']['FileLogging'] = 'True'
+    config['GLOBAL_PARAMETERS']['LogFileName'] = os.path.join(work_dir, 'benchmark.log')
+    config['GLOBAL_PARAMETERS']['MetricsReportFile'] = os.path.join(work_dir, 'benchmark_report.json')
+    if config.has_section('EMAIL_OUTBOX'):
+        config['EMAIL_OUTBOX']['OutboxDir'] = os.path.join(work_dir, 'outbox')
+    for option, value in overrides:
+        section = [s for s in config.sections() if config.has_option(s, option)] or ['GLOBAL_PARAMETERS']
+        config[section[0]][option] = value
+    for section in config.sections():
+        for option in benchmark_side_files:
+            if config.has_option(section, option) and config[section][option] and not os.path.isabs(config[section][option]):
+                config[section][option] = os.path.join(work_dir, config[section][option])
+    if config.has_section('SCHEDULE'):
+        config.remove_section('SCHEDULE')
+    config_file = os.path.join(work_dir, 'config.ini')
+    with open(config_file, 'w') as f:
+        config.write(f)
+
+    job_ids = ['BENCH-%s' % (i + 1) for i in range(job_count)]
+    with open(os.path.join(work_dir, 'job_data.csv'), 'w') as f:
+        f.write('id,wlcIP,wlcName,user_prefix,userQty,wlanId,ssid,userType,lifetime,timezone,description,email\n')
+        for job_id in job_ids:
+            wlc_ips = ';'.join(wlc.address for wlc in controllers)
+            wlc_names = ';'.join('FAKE-WLC%s' % (i + 1) for i in range(len(controllers)))
+            f.write('%s,%s,%s,%s,%s,1,Bench_SSID,guest,86400,Europe/London,Benchmark,bench@example.com\n' % (job_id, wlc_ips, wlc_names, job_id.replace('-', '_'), user_count))
+    return config_file, job_ids
+
+
+def benchmark_main(args, overrides, label):
+    #main() end to end: config, job data, SSH to every fake WLC, guest and admin e-mails
+    fake_wlcs = start_fake_wlcs(args.controllers, args)
+    sink = smtp_sink(message_latency=args.mail_latency).start()
+    work_dir = tempfile.mkdtemp(prefix='wlc_bench_')
+    try:
+        config_file, job_ids = write_benchmark_files(work_dir, args.jobs, args.users, fake_wlcs, sink, overrides)
+        #the run report only covers this scenario
+        wgc.metrics = wgc.run_metrics()
+        start = monotonic()
+        try:
+            wgc.main(['--config=' + config_file] + job_ids)
+        except SystemExit:
+            pass
+        elapsed = monotonic() - start
+        users = sum(len(wlc.netusers) for wlc in fake_wlcs) // max(len(fake_wlcs), 1)
+        return {
+            'scenario': 'main %s %s' % (args.transport, label),
+            'seconds': round(elapsed, 3),
+            'users_created': users,
+            'users_per_second': round(users / elapsed, 2),
+            'controllers_per_second': round(args.jobs * len(fake_wlcs) / elapsed, 2),
+            'mails_per_second': round(sink.messages / elapsed, 2),
+            'mails': sink.messages,
+            'ssh_sessions': sum(getattr(wlc, 'sessions', 0) for wlc in fake_wlcs),
+            'restconf_requests': sum(getattr(wlc, 'requests', 0) for wlc in fake_wlcs),
+            'smtp_connections': sink.connections,
+        }
+    finally:
+        for wlc in fake_wlcs:
+            wlc.stop()
+        sink.shutdown()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        else:
+            print('Benchmark files kept in ' + work_dir)
+
+
+def parse_overrides(option_values):
+    #"Key=Value" pairs applied to the config.ini of a main scenario
+    return [tuple(option_value.split('=', 1)) for option_value in option_values]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks wlc_guest_user_creator.py against local fake WLCs and a local SMTP sink')
+    parser.add_argument('--scenario', choices=['device', 'main', 'all'], default='all')
+    parser.add_argument('--users', type=int, default=50, help='guest users per job')
+    parser.add_argument('--jobs', type=int, default=2, help='jobs run by the main scenario')
+    parser.add_argument('--controllers', type=int, default=2, help='fake WLCs per job in the main scenario')
+    parser.add_argument('--transport', choices=['cli', 'restconf'], default='cli', help='fake WLCs reached over SSH (cli) or RESTCONF')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 25], help='CommandBatchSize (RestconfBatchSize with --transport restconf) values of the device scenario')
+    parser.add_argument('--command-latency', type=float, default=0.0, help='seconds the fake WLCs add to every command')
+    parser.add_argument('--save-latency', type=float, default=0.0, help='seconds the fake WLCs add to save config')
+    parser.add_argument('--request-latency', type=float, default=0.0, help='seconds the fake RESTCONF WLCs add to every request')
+    parser.add_argument('--login-latency', type=float, default=0.0, help='seconds the fake WLCs add to every login')
+    parser.add_argument('--add-failure-rate', type=float, default=0.0, help='share of user adds the fake WLCs reject (0-1)')
+    parser.add_argument('--mail-latency', type=float, default=0.0, help='seconds the SMTP sink adds to every e-mail')
+    parser.add_argument('--set', action='append', default=[], metavar='Key=Value', help='config.ini value for the main scenario, can be repeated (e.g. --set CommandBatchSize=25)')
+    parser.add_argument('--json', metavar='FILE', help='also write the results to a JSON file')
+    parser.add_argument('--keep', action='store_true', help='keep the config, job data, log and report files of the main scenario')
+    args = parser.parse_args(argv)
+
+    results = []
+    if args.scenario in ('device', 'all'):
+        results += benchmark_device(args)
+    if args.scenario in ('main', 'all'):
+        overrides = parse_overrides(args.set)
+        results.append(benchmark_main(args, overrides, ' '.join(args.set) or 'config.ini'))
+
+    for result in results:
+        print(' - '.join('%s: %s' % (key, value) for key, value in result.items()))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""Local SMTP sink used by the benchmarks
+
+Accepts every e-mail and throws it away, counting connections and messages.
+"""
+
+import socketserver
+import threading
+from time import sleep
+
+
+class smtp_sink_handler(socketserver.StreamRequestHandler):
+    """Minimal SMTP dialogue: EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP and QUIT
+    """
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply('220 smtp sink ready')
+        in_data = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode(errors='replace').rstrip('\r\n')
+            if in_data:
+                if line == '.':
+                    in_data = False
+                    if self.server.message_latency:
+                        sleep(self.server.message_latency)
+                    with self.server.lock:
+                        self.server.messages += 1
+                    self.reply('250 ok: queued')
+                continue
+            verb = line[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 smtp sink')
+            elif verb == 'DATA':
+                in_data = True
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class smtp_sink(socketserver.ThreadingTCPServer):
+    """SMTP server on localhost that counts and discards every e-mail
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address='127.0.0.1', port=0, message_latency=0.0):
+        socketserver.ThreadingTCPServer.__init__(self, (address, port), smtp_sink_handler)
+        self.message_latency = message_latency
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+    def address(self):
+        #host:port as expected by EmailServer in config.ini
+        return '%s:%s' % self.server_address
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Runs a local SMTP sink until CTRL-C')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--message-latency', type=float, default=0.0, help='seconds added to every e-mail')
+    args = parser.parse_args()
+    sink = smtp_sink(args.address, args.port, args.message_latency).start()
+    print('SMTP sink listening on ' + sink.address())
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        print('%s e-mails received over %s connections' % (sink.messages, sink.connections))
+        sink.shutdown()
@@ -0,0 +1,121 @@
+"""CLI output tests of wlc_guest_user_creator.py: AireOS replies to the netuser commands, batched command output
+splitting and the reconciliation of delete commands with the users found on the WLC
+"""
+
+import os
+import sys
+import unittest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repo_dir)
+import wlc_guest_user_creator as wgc
+
+wlc_prompt = '(Cisco Controller) >'
+add_command = 'config netuser add BENCH_1 s3cr3tpw wlan 1 userType guest lifetime 86400 description Benchmark'
+#(command, AireOS output, command_result)
+cli_outputs = [
+    (add_command, '', ('add', 'added', 'BENCH_1')),
+    (add_command, '\n', ('add', 'added', 'BENCH_1')),
+    (add_command, 'Error: User BENCH_1 already exists.\n', ('add', 'rejected', 'BENCH_1')),
+    (add_command, 'Request failed: Guest user not added\n', ('add', 'rejected', 'BENCH_1')),
+    (add_command, 'Incorrect input! Use \'config netuser add ?\' for help\n', ('add', 'rejected', 'BENCH_1')),
+    #an add only succeeds without output, anything unrecognised fails the job
+    (add_command, 'Deleted user BENCH_1\n', ('add', 'unknown', 'BENCH_1')),
+    (add_command, 'Please wait...\n', ('add', 'unknown', 'BENCH_1')),
+    ('config netuser delete username BENCH_1', 'Deleted user BENCH_1\n', ('delete', 'deleted', 'BENCH_1')),
+    ('config netuser delete BENCH_1', '', ('delete', 'deleted', 'BENCH_1')),
+    ('config netuser delete username BENCH_1', 'User BENCH_1 does not exist.\n', ('delete', 'absent', 'BENCH_1')),
+    ('config netuser delete username BENCH_1', 'Incorrect usage. Use the \'?\' or <TAB> key to list commands.\n', ('delete', 'rejected', 'BENCH_1')),
+    ('config netuser delete BENCH_1', 'Some release specific banner\n', ('delete', 'unknown', 'BENCH_1')),
+    ('config paging disable', '', ('other', 'unknown', '')),
+]
+delete_commands = ['config netuser delete username BENCH_1', 'config netuser delete BENCH_1', 'config netuser delete username BENCH_2', 'config netuser delete BENCH_2']
+add_commands = [add_command, add_command.replace('BENCH_1', 'BENCH_2')]
+#(users on the WLC, delete syntax, commands left by reconcile_command_list)
+reconciled_command_lists = [
+    (set(), 'username', add_commands),
+    ({'BENCH_1'}, 'username', ['config netuser delete username BENCH_1'] + add_commands),
+    ({'BENCH_1'}, 'legacy', ['config netuser delete BENCH_1'] + add_commands),
+    ({'BENCH_1', 'BENCH_2'}, 'legacy', ['config netuser delete BENCH_1', 'config netuser delete BENCH_2'] + add_commands),
+    ({'OTHER_1'}, 'username', add_commands),
+]
+#(commands, reads of the SSH channel, outputs) as the WLC sends them back for a batch
+batch_outputs = [
+    ([add_command, 'config netuser delete username BENCH_2'],
+        [add_command + '\r\n' + wlc_prompt + 'config netuser delete username BENCH_2\r\nUser BENCH_2 does not exist.\r\n' + wlc_prompt],
+        ['\n', 'User BENCH_2 does not exist.\n']),
+    #output split over several reads, with empty reads in between
+    ([add_command, add_command.replace('BENCH_1', 'BENCH_2')],
+        [add_command[:20], '', add_command[20:] + '\r\n' + wlc_prompt + 'config netuser add BENCH_2', '', ' s3cr3tpw wlan 1 userType guest lifetime 86400 description Benchmark\r\nError: User BENCH_2 already exists.\r\n' + wlc_prompt],
+        ['\n', 'Error: User BENCH_2 already exists.\n']),
+    #a long command echo wrapped over two lines by the WLC
+    ([add_command],
+        ['config netuser add BENCH_1 s3cr3tpw wlan 1 user\r\nType guest lifetime 86400 description Benchmark\r\nRequest failed: Guest user not added\r\n' + wlc_prompt],
+        ['Request failed: Guest user not added\n']),
+]
+
+
+class fake_device(object):
+    """Netmiko session stand-in replaying the reads of a batch
+    """
+    RETURN = '\n'
+
+    def __init__(self, reads):
+        self.reads = list(reads)
+        self.written = ''
+
+    def write_channel(self, data):
+        self.written += data
+
+    def read_channel(self):
+        return self.reads.pop(0) if self.reads else ''
+
+
+class cli_output_tests(unittest.TestCase):
+
+    def test_classify_command_output(self):
+        for command, command_output, result in cli_outputs:
+            with self.subTest(command=command, command_output=command_output):
+                self.assertEqual(tuple(wgc.classify_command_output(command, command_output)), result)
+
+
+    def test_reconcile_command_list(self):
+        for existing_users, delete_syntax, command_list in reconciled_command_lists:
+            with self.subTest(existing_users=existing_users, delete_syntax=delete_syntax):
+                self.assertEqual(wgc.reconcile_command_list(delete_commands + add_commands, existing_users, delete_syntax), command_list)
+
+
+    def test_wlc_netusers(self):
+        netusers = wgc.wlc_netusers()
+        netusers.users = wgc.parse_netuser_summary('Maximum logins allowed for a given username ........ Unlimited\r\n\r\n'
+            '   User Name............................... BENCH_1\r\n   WLAN Id................................. Any\r\n\r\n'
+            '   User Name............................... BENCH_2\r\n   Lifetime................................ Permanent\r\n')
+        self.assertEqual(netusers.users, {'BENCH_1', 'BENCH_2'})
+        netusers.update(wgc.command_result('delete', 'deleted', 'BENCH_1'))
+        netusers.update(wgc.command_result('add', 'added', 'BENCH_3'))
+        netusers.update(wgc.command_result('add', 'rejected', 'BENCH_4'))
+        netusers.update(wgc.command_result('delete', 'absent', 'BENCH_5'))
+        self.assertEqual(netusers.users, {'BENCH_2', 'BENCH_3'})
+
+
+    def test_send_command_batch(self):
+        for commands, reads, outputs in batch_outputs:
+            with self.subTest(commands=commands):
+                device = fake_device(reads)
+                self.assertEqual(wgc.send_command_batch(device, commands, wlc_prompt, 1, 0.001), outputs)
+                self.assertEqual(device.written, '\n'.join(commands) + '\n')
+
+
+    def test_send_command_batch_timeout(self):
+        device = fake_device([add_command + '\r\n' + wlc_prompt])
+        with self.assertRaises(IOError):
+            wgc.send_command_batch(device, [add_command, add_command], wlc_prompt, 0.05, 0.001)
+
+
+    def test_mask_netuser_password(self):
+        self.assertEqual(wgc.mask_netuser_password(add_command), add_command.replace('s3cr3tpw', '********'))
+        self.assertEqual(wgc.mask_netuser_password('config netuser delete BENCH_1'), 'config netuser delete BENCH_1')
+
+
+if __name__ == "__main__":
+    unittest.main()
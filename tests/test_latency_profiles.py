@@ -0,0 +1,69 @@
+"""AdaptiveTiming tests of wlc_guest_user_creator.py: read timeouts and delay factor derived from the latency profile of a WLC
+"""
+
+import os
+import sys
+import unittest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repo_dir)
+import wlc_guest_user_creator as wgc
+
+#(replies timed on the WLC as (kind, seconds), kind of command, read timeout expected)
+read_timeouts = [
+    ([], 'command', 10.0),
+    #a fast WLC is bounded by MinReadTimeout
+    ([('prompt', 0.002), ('command', 0.05)], 'command', 5.0),
+    #first sample: average 8 s, deviation 4 s, 24 s expected times the multiplier of 3
+    ([('save_config', 8.0)], 'save_config', 72.0),
+    #no command timed yet: the multiplied prompt round trip when it is longer than the netmiko default
+    ([('prompt', 0.002)], 'command', 10.0),
+    ([('prompt', 5.0)], 'show', 45.0),
+    ([('command', 200.0)], 'command', 300.0),
+]
+#(prompt round trip, delay factor expected)
+delay_factors = [
+    (None, 1.0),
+    (0.0005, 0.01),
+    (0.002, 0.024),
+    (0.05, 0.1),
+    (1.0, 0.1),
+]
+
+
+class latency_profile_tests(unittest.TestCase):
+
+    def profiles(self):
+        profiles = wgc.latency_profiles()
+        #the profile file is only read and written by configure() and save()
+        profiles.configure(os.path.join(repo_dir, 'tests', 'no_such_latency_profile.json'))
+        return profiles
+
+
+    def test_read_timeout(self):
+        for replies, kind, read_timeout in read_timeouts:
+            with self.subTest(replies=replies, kind=kind):
+                profiles = self.profiles()
+                for reply_kind, seconds in replies:
+                    profiles.observe('192.0.2.1', reply_kind, seconds)
+                self.assertAlmostEqual(profiles.read_timeout('192.0.2.1', kind), read_timeout)
+
+
+    def test_delay_factor(self):
+        for round_trip, delay_factor in delay_factors:
+            with self.subTest(round_trip=round_trip):
+                profiles = self.profiles()
+                if round_trip is not None:
+                    profiles.observe('192.0.2.1', 'prompt', round_trip)
+                self.assertAlmostEqual(profiles.delay_factor('192.0.2.1'), delay_factor)
+
+
+    def test_disabled(self):
+        profiles = wgc.latency_profiles()
+        profiles.observe('192.0.2.1', 'command', 60.0)
+        self.assertEqual(profiles.read_timeout('192.0.2.1', 'command'), 10.0)
+        self.assertEqual(profiles.delay_factor('192.0.2.1'), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
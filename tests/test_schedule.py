@@ -0,0 +1,106 @@
+"""Daemon mode schedule tests of wlc_guest_user_creator.py: cron field parsing and when a job is due
+"""
+
+import os
+import sys
+import unittest
+from time import mktime
+from datetime import datetime
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repo_dir)
+import wlc_guest_user_creator as wgc
+
+#(field, minimum, maximum, names, values matched)
+cron_fields = [
+    ('*', 0, 59, {}, set(range(0, 60))),
+    ('5', 0, 59, {}, {5}),
+    ('1-5', 0, 23, {}, {1, 2, 3, 4, 5}),
+    ('*/15', 0, 59, {}, {0, 15, 30, 45}),
+    ('0-30/10', 0, 59, {}, {0, 10, 20, 30}),
+    ('10/20', 0, 59, {}, {10, 30, 50}),
+    ('1,15', 1, 31, {}, {1, 15}),
+    ('JAN', 1, 12, wgc.cron_field_names[3], {1}),
+    ('jun-aug', 1, 12, wgc.cron_field_names[3], {6, 7, 8}),
+    ('MON-FRI', 0, 7, wgc.cron_field_names[4], {1, 2, 3, 4, 5}),
+    ('SUN,sat', 0, 7, wgc.cron_field_names[4], {0, 6}),
+]
+#(field, minimum, maximum, names) that are not valid
+invalid_cron_fields = [
+    ('60', 0, 59, {}),
+    ('5-1', 0, 23, {}),
+    ('*/0', 0, 59, {}),
+    ('MON', 0, 59, {}),
+    ('JANUARY', 1, 12, wgc.cron_field_names[3]),
+    ('1-', 1, 31, {}),
+    ('', 0, 59, {}),
+]
+#(expression, local time, whether the schedule matches it)
+cron_matches = [
+    ('0 7 * * 1-5', datetime(2024, 3, 4, 7, 0), True),
+    ('0 7 * * 1-5', datetime(2024, 3, 3, 7, 0), False),
+    ('0 7 * * MON-FRI', datetime(2024, 3, 8, 7, 0), True),
+    ('0 7 * * MON-FRI', datetime(2024, 3, 8, 7, 1), False),
+    ('30 2 * JAN,JUL *', datetime(2024, 7, 15, 2, 30), True),
+    ('30 2 * JAN,JUL *', datetime(2024, 6, 15, 2, 30), False),
+    ('0 0 * * 7', datetime(2024, 3, 3, 0, 0), True),
+    ('0 0 * * SUN', datetime(2024, 3, 3, 0, 0), True),
+    #a restricted day of month and day of week match when either of them does
+    ('0 12 1 * MON', datetime(2024, 3, 1, 12, 0), True),
+    ('0 12 1 * MON', datetime(2024, 3, 4, 12, 0), True),
+    ('0 12 1 * MON', datetime(2024, 3, 5, 12, 0), False),
+]
+
+
+def timestamp(local_time):
+    return mktime(local_time.timetuple())
+
+
+class schedule_tests(unittest.TestCase):
+
+    def test_parse_cron_field(self):
+        for field, minimum, maximum, names, values in cron_fields:
+            with self.subTest(field=field):
+                self.assertEqual(wgc.parse_cron_field(field, minimum, maximum, names), values)
+
+
+    def test_invalid_cron_field(self):
+        for field, minimum, maximum, names in invalid_cron_fields:
+            with self.subTest(field=field):
+                with self.assertRaises(ValueError):
+                    wgc.parse_cron_field(field, minimum, maximum, names)
+
+
+    def test_invalid_schedule_names_job_id(self):
+        for expression in ['0 7 * * MONDAY', '0 7 * *', 'every 0', 'every x']:
+            with self.subTest(expression=expression):
+                with self.assertRaisesRegex(ValueError, 'JOB-1'):
+                    wgc.job_schedule('JOB-1', expression)
+
+
+    def test_cron_matches(self):
+        for expression, local_time, matches in cron_matches:
+            with self.subTest(expression=expression, local_time=local_time):
+                self.assertEqual(wgc.job_schedule('JOB-1', expression).cron_matches(local_time), matches)
+
+
+    def test_cron_runs_once_per_minute(self):
+        schedule = wgc.job_schedule('JOB-1', '*/5 * * * *')
+        now = timestamp(datetime(2024, 3, 4, 7, 5, 1))
+        self.assertTrue(schedule.is_due(now))
+        schedule.mark_started(now)
+        self.assertFalse(schedule.is_due(now + 30))
+        self.assertFalse(schedule.is_due(timestamp(datetime(2024, 3, 4, 7, 6))))
+        self.assertTrue(schedule.is_due(timestamp(datetime(2024, 3, 4, 7, 10))))
+
+
+    def test_interval(self):
+        schedule = wgc.job_schedule('JOB-1', 'every 3600')
+        self.assertTrue(schedule.is_due(1000))
+        schedule.mark_started(1000)
+        self.assertFalse(schedule.is_due(4599))
+        self.assertTrue(schedule.is_due(4600))
+
+
+if __name__ == "__main__":
+    unittest.main()
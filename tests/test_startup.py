@@ -0,0 +1,57 @@
+"""Start-up tests of wlc_guest_user_creator.py
+
+The script is started from cron every few minutes: importing it has to stay cheap and must not load
+the SSH stack or any module only some modes need, and --check must never load netmiko.
+Each test runs the script in a fresh interpreter so nothing is already imported.
+"""
+
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+#seconds importing the script may take (best of import_time_runs), WLC_IMPORT_TIME_BUDGET raises it on slow machines
+import_time_budget = float(os.environ.get('WLC_IMPORT_TIME_BUDGET', '0.2'))
+import_time_runs = 3
+#modules imported by the code paths that need them only
+lazy_modules = ['netmiko', 'paramiko', 'pytz', 'sqlite3', 'http.client', 'http.server']
+
+
+def run_python(code):
+    #Runs code in a fresh interpreter from the repository folder, returns the JSON it prints last
+    env = dict(os.environ)
+    #the bytecode cache is written so the import is not timed with the compilation of the script
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    output = subprocess.run([sys.executable, '-c', code], cwd=repo_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class startup_tests(unittest.TestCase):
+
+    def test_import_time(self):
+        import_code = ('import sys, json\nfrom time import perf_counter\nstart = perf_counter()\nimport wlc_guest_user_creator\n'
+            'print(json.dumps({"seconds": perf_counter() - start, "modules": sorted(sys.modules)}))')
+        #the first run writes the bytecode cache
+        run_python(import_code)
+        runs = [run_python(import_code) for i in range(import_time_runs)]
+        loaded_lazy_modules = [module for module in lazy_modules if module in runs[0]['modules']]
+        self.assertEqual(loaded_lazy_modules, [], 'modules imported at start-up: ' + ', '.join(loaded_lazy_modules))
+        import_time = min(run['seconds'] for run in runs)
+        self.assertLess(import_time, import_time_budget, 'importing the script took %.3f s, the budget is %s s' % (import_time, import_time_budget))
+
+
+    def test_check_does_not_load_ssh_stack(self):
+        result = run_python('import sys, json, io, contextlib\nimport wlc_guest_user_creator\n'
+            'with contextlib.redirect_stdout(io.StringIO()) as output:\n'
+            '    try:\n        wlc_guest_user_creator.main(["--check"])\n    except SystemExit as e:\n        exit_code = e.code\n'
+            'print(json.dumps({"exit_code": exit_code, "output": output.getvalue(), "modules": sorted(sys.modules)}))')
+        self.assertIn('Config file OK', result['output'])
+        self.assertEqual(result['exit_code'], 0, result['output'])
+        self.assertNotIn('netmiko', result['modules'])
+        self.assertNotIn('paramiko', result['modules'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,30 +8,338 @@ Written by Rocco De Angelis
 """
 
 from __future__ import print_function
-from netmiko import (
-    ConnectHandler, NetMikoTimeoutException, NetMikoAuthenticationException)
-import paramiko
 import socket
-import numpy as np
 import csv
 import os
 import sys
 import random
 import re
 import string
+import queue
+import threading
+import signal
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import uuid
+import json
+import io
+import html
 import configparser
+import ipaddress
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, CancelledError, wait as wait_futures
 from datetime import datetime
 from datetime import timedelta
-from pytz import timezone
-from time import sleep
+from time import sleep, monotonic, time
+from urllib.parse import quote, urlparse, parse_qs
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+fmt = "%a %b %d %Y - %H:%M:00 %Z %z"
+fmtlog = "%a %b %d %Y - %H:%M:%S %Z %z"
+
+log = logging.getLogger('wlc_guest_user_creator')
+#correlation ids added to every log record
+log_run_id = contextvars.ContextVar('log_run_id', default='')
+log_job_id = contextvars.ContextVar('log_job_id', default='')
+log_controller = contextvars.ContextVar('log_controller', default='')
+
+
+class log_context_filter(logging.Filter):
+    """Adds the run, job and controller correlation ids to log records
+    """
+    def filter(self, record):
+        record.run_id = log_run_id.get()
+        record.job_id = log_job_id.get()
+        record.controller = log_controller.get()
+        return True
+
+
+class log_separator_filter(logging.Filter):
+    """Drops the dash and blank separator lines of the text log, they carry nothing in JSON lines
+    """
+    def filter(self, record):
+        return record.getMessage().strip('-\n ') != ''
+
+
+class json_lines_formatter(logging.Formatter):
+    """Formats each log record as a JSON object on its own line
+    """
+    def format(self, record):
+        log_entry = {
+            'time': datetime.utcfromtimestamp(record.created).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'level': record.levelname,
+            'run_id': getattr(record, 'run_id', ''),
+            'job_id': getattr(record, 'job_id', ''),
+            'controller': getattr(record, 'controller', ''),
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            log_entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(log_entry)
+
+
+#background thread writing the queued log records, one per process
+log_listener = None
+#settings used by setup_logging, a daemon reloading config.ini sets up logging again when one of them changes
+logging_setting_keys = ['file_logging', 'log_full_path_file', 'log_format', 'log_level', 'log_rotation', 'log_max_bytes', 'log_backup_count', 'log_rotate_when']
+
+
+def stop_logging():
+    #Writes the records still queued and closes the log file
+    global log_listener
+    if log_listener:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        log_listener = None
+
+
+def setup_logging(settings):
+    #Records are put on a queue and written by a background thread so jobs never wait on disk I/O
+    #The file handler rotates the log by size or time, the console is used when FileLogging is False
+    #Calling it again replaces the previous listener and its log file
+    global log_listener
+    if settings['file_logging']:
+        if settings['log_rotation'] == 'size':
+            log_handler = logging.handlers.RotatingFileHandler(settings['log_full_path_file'], maxBytes=settings['log_max_bytes'], backupCount=settings['log_backup_count'])
+        elif settings['log_rotation'] == 'time':
+            log_handler = logging.handlers.TimedRotatingFileHandler(settings['log_full_path_file'], when=settings['log_rotate_when'], backupCount=settings['log_backup_count'])
+        else:
+            log_handler = logging.FileHandler(settings['log_full_path_file'])
+    else:
+        log_handler = logging.StreamHandler(sys.stdout)
+    if settings['file_logging'] and settings['log_format'] == 'json':
+        log_handler.setFormatter(json_lines_formatter())
+        log_handler.addFilter(log_separator_filter())
+    else:
+        log_handler.setFormatter(logging.Formatter('%(message)s'))
+    
+    log_queue = queue.Queue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(log_context_filter())
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+    log.addHandler(queue_handler)
+    log.setLevel(settings['log_level'])
+    log.propagate = False
+    #the previous listener writes what it still has queued before it goes
+    stop_logging()
+    log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+    log_listener.start()
+    #queued records are flushed on exit, including sys.exit() and CTRL-C
+    atexit.unregister(stop_logging)
+    atexit.register(stop_logging)
+    return log_listener
+
+
+class run_metrics(object):
+    """Counters and latency histograms collected during a run, written as a JSON report and a Prometheus textfile
+    """
+    histogram_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time()
+        self.counters = {}
+        self.histograms = {}
+
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'count': 0, 'sum': 0.0, 'min': seconds, 'max': seconds, 'buckets': [0] * len(self.histogram_buckets)}
+            histogram = self.histograms[key]
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['min'] = min(histogram['min'], seconds)
+            histogram['max'] = max(histogram['max'], seconds)
+            for i, upper_bound in enumerate(self.histogram_buckets):
+                if seconds <= upper_bound:
+                    histogram['buckets'][i] += 1
+                    break
+
+
+    @contextmanager
+    def timer(self, name, **labels):
+        #the time is recorded even when the timed block raises
+        timer_start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - timer_start, **labels)
+
+
+    def report(self):
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+            timers = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                timers.append({
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': histogram['count'],
+                    'sum_seconds': round(histogram['sum'], 6),
+                    'mean_seconds': round(histogram['sum'] / histogram['count'], 6),
+                    'min_seconds': round(histogram['min'], 6),
+                    'max_seconds': round(histogram['max'], 6),
+                    'buckets': dict(zip([str(upper_bound) for upper_bound in self.histogram_buckets], histogram['buckets'])),
+                })
+        return {
+            'run_id': log_run_id.get(),
+            'started': datetime.utcfromtimestamp(self.started).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'duration_seconds': round(time() - self.started, 3),
+            'counters': counters,
+            'timers': timers,
+        }
+
+
+    def prometheus_text(self, prefix='wlc_guest_user_creator_'):
+        def fmt_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+        lines = []
+        with self.lock:
+            for metric_name in sorted(set(name for name, labels in self.counters)):
+                lines.append('# TYPE %s%s_total counter' % (prefix, metric_name))
+                for (name, labels), value in sorted(self.counters.items()):
+                    if name == metric_name:
+                        lines.append('%s%s_total%s %s' % (prefix, name, fmt_labels(labels), value))
+            for metric_name in sorted(set(name for name, labels in self.histograms)):
+                lines.append('# TYPE %s%s histogram' % (prefix, metric_name))
+                for (name, labels), histogram in sorted(self.histograms.items()):
+                    if name != metric_name:
+                        continue
+                    cumulative = 0
+                    for upper_bound, bucket_count in zip(self.histogram_buckets, histogram['buckets']):
+                        cumulative += bucket_count
+                        lines.append('%s%s_bucket%s %s' % (prefix, name, fmt_labels(labels, [('le', upper_bound)]), cumulative))
+                    lines.append('%s%s_bucket%s %s' % (prefix, name, fmt_labels(labels, [('le', '+Inf')]), histogram['count']))
+                    lines.append('%s%s_sum%s %s' % (prefix, name, fmt_labels(labels), histogram['sum']))
+                    lines.append('%s%s_count%s %s' % (prefix, name, fmt_labels(labels), histogram['count']))
+        lines.append('# TYPE %slast_run_timestamp_seconds gauge' % prefix)
+        lines.append('%slast_run_timestamp_seconds %s' % (prefix, int(time())))
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self, report_file='', prometheus_file=''):
+        #files are replaced atomically so the textfile collector never reads half a file
+        for path, content in ((report_file, lambda: json.dumps(self.report(), indent=2) + '\n'), (prometheus_file, self.prometheus_text)):
+            if not path:
+                continue
+            try:
+                with open(path + '.tmp', 'w') as metrics_file:
+                    metrics_file.write(content())
+                os.replace(path + '.tmp', path)
+            except (IOError, OSError) as e:
+                log.error('Error: unable to write metrics file ' + path + ' (' + str(e) + ')')
+
+
+metrics = run_metrics()
+
+
+class smtp_connection_pool(object):
+    """Pool of reusable SMTP sessions shared by all e-mails sent in a run
+    """
+    def __init__(self, host, pool_size=1, max_messages_per_connection=100):
+        self.host = host
+        self.pool_size = pool_size
+        self.max_messages_per_connection = max_messages_per_connection
+        self.idle_connections = queue.LifoQueue()
+        self.connection_slots = threading.BoundedSemaphore(pool_size)
+
+
+    def acquire(self, timeout=None):
+        self.connection_slots.acquire()
+        try:
+            return self.idle_connections.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            smtp_obj = smtplib.SMTP(self.host, timeout=timeout) if timeout else smtplib.SMTP(self.host)
+        except:
+            self.connection_slots.release()
+            raise
+        smtp_obj.messages_sent = 0
+        return smtp_obj
+
+
+    def release(self, smtp_obj, reusable=True):
+        if reusable and smtp_obj.messages_sent < self.max_messages_per_connection:
+            self.idle_connections.put(smtp_obj)
+        else:
+            self.disconnect(smtp_obj)
+        self.connection_slots.release()
+
+
+    def disconnect(self, smtp_obj):
+        try:
+            smtp_obj.quit()
+        except:
+            smtp_obj.close()
+
+
+    def ehlo(self, timeout=None):
+        #timeout bounds the connection and the EHLO reply, the session goes back to the pool without it
+        smtp_obj = self.acquire(timeout)
+        try:
+            if timeout: smtp_obj.sock.settimeout(timeout)
+            smtp_reply = smtp_obj.ehlo()
+            if timeout: smtp_obj.sock.settimeout(socket.getdefaulttimeout())
+        except:
+            self.release(smtp_obj, False)
+            raise
+        self.release(smtp_obj)
+        return smtp_reply
+
+
+    def sendmail(self, sender, receiver, message):
+        #A session dropped by the server (idle timeout, 421 throttling) is replaced once with a fresh one
+        for attempt in range(2):
+            smtp_obj = self.acquire()
+            try:
+                smtp_obj.sendmail(sender, receiver, message)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException, socket.error) as e:
+                self.release(smtp_obj, False)
+                dropped = isinstance(e, smtplib.SMTPServerDisconnected) or getattr(e, 'smtp_code', None) == 421
+                if attempt == 0 and dropped:
+                    continue
+                raise
+            except:
+                self.release(smtp_obj, False)
+                raise
+            smtp_obj.messages_sent += 1
+            self.release(smtp_obj)
+            return
+
+
+    def close(self):
+        while True:
+            try:
+                smtp_obj = self.idle_connections.get_nowait()
+            except queue.Empty:
+                break
+            self.disconnect(smtp_obj)
+
+
 class email_SMTP(object):
     """Send text email via SMTP server
     """
-    def __init__(self, host, sender_name=None, sender=None, receiver_name=None, receiver=None, subject=None, message=None):
+    def __init__(self, host, sender_name=None, sender=None, receiver_name=None, receiver=None, subject=None, message=None, pool=None, attachments=None):
         self.host = host
         self.sender_name = sender_name
         self.sender = sender
@@ -39,35 +347,41 @@ class email_SMTP(object):
         self.receiver = receiver
         self.subject = subject
         self.message = message
+        self.pool = pool
+        #list of (file name, text subtype, content) attached to the e-mail
+        self.attachments = attachments or []
 
 
-    def test(self):
+    def test(self, timeout=None):
         try:
-            smtp_obj = smtplib.SMTP(self.host)
-            smtp_test = smtp_obj.ehlo()
-            smtp_obj.quit()
+            if self.pool:
+                smtp_test = self.pool.ehlo(timeout)
+            else:
+                smtp_obj = smtplib.SMTP(self.host, timeout=timeout) if timeout else smtplib.SMTP(self.host)
+                smtp_test = smtp_obj.ehlo()
+                smtp_obj.quit()
             
             if smtp_test[0] == 250:
-                print('Reply Code: ' + str(smtp_test[0]) + ' OK')
+                log.info('Reply Code: ' + str(smtp_test[0]) + ' OK')
                 return True
             else:
-                print('Reply Code: ' + str(smtp_test[0]) + ' UNKNOWN. (250 is required to continue)\nExiting!')
+                log.info('Reply Code: ' + str(smtp_test[0]) + ' UNKNOWN. (250 is required to continue)\nExiting!')
                 return False
                 
                 
         except smtplib.SMTPException as e:
-            print('Error: Unable to send email')
+            log.error('Error: Unable to send email')
             return False
         except socket.error as e:
-            print('Error: Could not connect to SMTP server - is it down or unreachable?\n({0})'.format(e.strerror))
+            log.error('Error: Could not connect to SMTP server - is it down or unreachable?\n({0})'.format(e.strerror))
             return False
         except:
-            print('Unknown Error: ', sys.exc_info()[0])
+            log.error('Unknown Error: %s', sys.exc_info()[0])
             return False
 
 
-    def send(self):
-        mimemsg = MIMEMultipart('alternative')
+    def build(self):
+        mimemsg = MIMEMultipart('mixed' if self.attachments else 'alternative')
         mimemsg['Subject'] = self.subject
         mimemsg['From'] = self.sender_name + ' <' + self.sender + '>'
         if (type(self.receiver_name) == list) and (type(self.receiver) == list):
@@ -102,119 +416,572 @@ class email_SMTP(object):
         # According to RFC 2046, the last part of a multipart message, in this case
         # the HTML message, is best and preferred.
         mimemsg.attach(html_msg)
-        
+        for file_name, subtype, content in self.attachments:
+            attachment = MIMEText(content, subtype)
+            attachment.add_header('Content-Disposition', 'attachment', filename=file_name)
+            mimemsg.attach(attachment)
+        return mimemsg
+
+
+    def send(self):
+        mimemsg = self.build()
         try:
-            smtp_obj = smtplib.SMTP(self.host)
-            smtp_obj.sendmail(self.sender, self.receiver, mimemsg.as_string())
-            print('An e-mail has been successfully sent:\nSubject: "' + mimemsg['Subject'] + '"\nRecipient: ' + mimemsg['To'])
+            with metrics.timer('smtp_send_seconds', via='direct'):
+                if self.pool:
+                    self.pool.sendmail(self.sender, self.receiver, mimemsg.as_string())
+                else:
+                    smtp_obj = smtplib.SMTP(self.host)
+                    smtp_obj.sendmail(self.sender, self.receiver, mimemsg.as_string())
+                    smtp_obj.quit()
+            metrics.increment('emails', result='sent')
+            log.info('An e-mail has been successfully sent:\nSubject: "' + mimemsg['Subject'] + '"\nRecipient: ' + mimemsg['To'])
             return True
         except smtplib.SMTPException as e:
-            print('Error: Unable to send email')
+            metrics.increment('emails', result='failed')
+            log.error('Error: Unable to send email')
             return False
         except socket.error as e:
-            print('Error: Could not connect to SMTP server - is it down or unreachable?\n({0})'.format(e.strerror))
+            metrics.increment('emails', result='failed')
+            log.error('Error: Could not connect to SMTP server - is it down or unreachable?\n({0})'.format(e.strerror))
             return False
         except:
-            print('Unknown Error: ', sys.exc_info()[0])
+            metrics.increment('emails', result='failed')
+            log.error('Unknown Error: %s', sys.exc_info()[0])
+            return False
+
+
+class email_outbox(object):
+    """On-disk spool of rendered e-mails drained by a pool of background delivery workers
+    """
+    def __init__(self, spool_dir, smtp_pool, workers=2, max_per_second=0, max_attempts=8, retry_delay=30):
+        self.spool_dir = spool_dir
+        self.queue_dir = os.path.join(spool_dir, 'queue')
+        self.inflight_dir = os.path.join(spool_dir, 'inflight')
+        self.dead_dir = os.path.join(spool_dir, 'dead')
+        self.smtp_pool = smtp_pool
+        self.workers = workers
+        self.send_interval = (1.0 / max_per_second) if max_per_second > 0 else 0
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.next_send_time = 0
+        self.rate_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.worker_threads = []
+        for spool_subdir in (self.queue_dir, self.inflight_dir, self.dead_dir):
+            os.makedirs(spool_subdir, exist_ok=True)
+
+
+    def spool_file_name(self, next_attempt):
+        #file names sort by the time they are next due for delivery
+        return '%013d-%s.json' % (int(next_attempt * 1000), uuid.uuid4().hex)
+
+
+    def write_spool_file(self, path, entry):
+        tmp_path = path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as spool_file:
+            json.dump(entry, spool_file)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        os.replace(tmp_path, path)
+
+
+    def enqueue(self, sender, receiver, mimemsg):
+        entry = {
+            'sender': sender,
+            'receiver': receiver,
+            'subject': mimemsg['Subject'],
+            'to': mimemsg['To'],
+            'attempts': 0,
+            'last_error': '',
+            'message': mimemsg.as_string(),
+        }
+        self.write_spool_file(os.path.join(self.queue_dir, self.spool_file_name(time())), entry)
+        self.wakeup.set()
+
+
+    def start(self):
+        #anything left in flight by a previous run that was killed mid delivery is queued again
+        for spool_file in os.listdir(self.inflight_dir):
+            os.replace(os.path.join(self.inflight_dir, spool_file), os.path.join(self.queue_dir, spool_file))
+        self.stopping = False
+        for i in range(self.workers):
+            worker_thread = threading.Thread(target=self.deliver_forever, name='outbox-worker-%s' % (i+1))
+            worker_thread.daemon = True
+            worker_thread.start()
+            self.worker_threads.append(worker_thread)
+
+
+    def claim(self):
+        now_ms = int(time() * 1000)
+        for spool_file in sorted(os.listdir(self.queue_dir)):
+            if spool_file.endswith('.tmp'):
+                continue
+            if int(spool_file.split('-')[0]) > now_ms:
+                break
+            inflight_path = os.path.join(self.inflight_dir, spool_file)
+            try:
+                os.rename(os.path.join(self.queue_dir, spool_file), inflight_path)
+            except OSError:
+                #claimed by another worker
+                continue
+            return inflight_path
+        return None
+
+
+    def throttle(self):
+        if self.send_interval == 0:
+            return
+        with self.rate_lock:
+            send_time = max(self.next_send_time, monotonic())
+            self.next_send_time = send_time + self.send_interval
+        if send_time > monotonic():
+            sleep(send_time - monotonic())
+
+
+    def deliver(self, inflight_path):
+        with open(inflight_path) as spool_file:
+            entry = json.load(spool_file)
+        self.throttle()
+        try:
+            with metrics.timer('smtp_send_seconds', via='outbox'):
+                self.smtp_pool.sendmail(entry['sender'], entry['receiver'], entry['message'])
+        except Exception as e:
+            entry['attempts'] += 1
+            entry['last_error'] = repr(e)
+            permanent = isinstance(e, smtplib.SMTPRecipientsRefused) or getattr(e, 'smtp_code', 0) >= 500
+            if permanent or entry['attempts'] >= self.max_attempts:
+                self.write_spool_file(inflight_path, entry)
+                os.replace(inflight_path, os.path.join(self.dead_dir, os.path.basename(inflight_path)))
+                metrics.increment('emails', result='dead_letter')
+                log.error('Error: e-mail moved to dead-letter folder after %s attempt(s): "%s" to %s (%s)' % (entry['attempts'], entry['subject'], entry['to'], entry['last_error']))
+            else:
+                next_attempt = time() + self.retry_delay * (2 ** (entry['attempts'] - 1))
+                self.write_spool_file(os.path.join(self.queue_dir, self.spool_file_name(next_attempt)), entry)
+                os.remove(inflight_path)
+                metrics.increment('emails', result='retried')
+                log.error('Error: e-mail delivery failed, attempt %s of %s will be retried: "%s" to %s (%s)' % (entry['attempts'], self.max_attempts, entry['subject'], entry['to'], entry['last_error']))
             return False
+        os.remove(inflight_path)
+        metrics.increment('emails', result='sent')
+        log.info('An e-mail has been successfully sent:\nSubject: "' + entry['subject'] + '"\nRecipient: ' + entry['to'])
+        return True
+
+
+    def deliver_forever(self):
+        while not self.stopping:
+            inflight_path = self.claim()
+            if inflight_path is None:
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+                continue
+            try:
+                self.deliver(inflight_path)
+            except Exception:
+                log.error('Unknown Error: %s', sys.exc_info()[0])
+
+
+    def pending(self):
+        #e-mails due now plus those being delivered, e-mails waiting for a retry are not counted
+        now_ms = int(time() * 1000)
+        due = [f for f in os.listdir(self.queue_dir) if not f.endswith('.tmp') and int(f.split('-')[0]) <= now_ms]
+        return len(due) + len(os.listdir(self.inflight_dir))
+
+
+    def close(self, timeout=300):
+        #waits for due e-mails to be delivered, anything still spooled is picked up by the next run
+        deadline = monotonic() + timeout
+        while self.pending() > 0 and monotonic() < deadline:
+            self.wakeup.set()
+            sleep(0.1)
+        self.stopping = True
+        self.wakeup.set()
+        for worker_thread in self.worker_threads:
+            worker_thread.join()
+        self.worker_threads = []
+        spooled = len([f for f in os.listdir(self.queue_dir) if not f.endswith('.tmp')])
+        if spooled > 0:
+            log.info('%s e-mail(s) left in outbox %s will be delivered by the next run' % (spooled, self.queue_dir))
+        return spooled
 
 
 def script_start(print_time, fmtlog):
+    script_start_time = datetime.utcnow()
     if print_time:
-        script_start_time = datetime.utcnow()
         script_start_formatted = script_start_time.strftime(fmtlog)
-        print('Script Start Time: ' + script_start_formatted)
-        print(((('-' * 100) + "\n") * 2) + ('-' * 100))
-        return script_start_time
+        log.info('Script Start Time: ' + script_start_formatted)
+        log.info(((('-' * 100) + "\n") * 2) + ('-' * 100))
+    return script_start_time
 
 
 def script_end(print_time, fmtlog):
     if print_time:
         script_end_time = datetime.utcnow()
         script_end_formatted = script_end_time.strftime(fmtlog)
-        print(((('-' * 100) + "\n") * 2) + ('-' * 100))
-        print('Script End Time: ' + script_end_formatted)
-        print('\n' * 3)
+        log.info(((('-' * 100) + "\n") * 2) + ('-' * 100))
+        log.info('Script End Time: ' + script_end_formatted)
+        log.info('\n' * 3)
         return script_end_time
 
 
-def process_select_data(csv_data, entered_id, full_path_csv_file, log_full_path_file):
-    id_idx = None
-    id_list = []
+job_data_cache = {}
+
+
+guest_user = namedtuple('guest_user', ['user', 'password'])
+password_random = random.SystemRandom()
+
+
+def generate_guest_users(user_prefix, first_user_number, user_count):
+    #Lazily generates guest user names (user_prefix_N) with random passwords
+    password_length = 8
+    chars = string.ascii_letters + string.digits + ''
+    for i in range(first_user_number, first_user_number + user_count):
+        password = ''.join(password_random.choice(chars) for j in range(password_length))
+        yield guest_user(user_prefix + '_' + str(i), password)
+
+
+def build_user_commands(guest_credential, wlan_id, user_type, lifetime, description):
+    command_del = 'config netuser delete username ' + guest_credential.user + ''
+    command_del_old = 'config netuser delete ' + guest_credential.user + ''
+    command_add = 'config netuser add ' + guest_credential.user + ' ' + guest_credential.password + ' wlan ' + wlan_id + ' userType ' + user_type + ' lifetime ' + lifetime + ' description "' + description + '"'
+    return [command_del, command_del_old, command_add]
+
+
+def iter_user_chunks(selected_data, chunk_size, issued_credentials=None):
+    #Yields (user_credentials, command_list) for consecutive chunks of at most chunk_size users of a job
+    #Users found in issued_credentials (user: password) keep the password they were already given
+    user_prefix, user_qty, wlan_id = selected_data[3], int(selected_data[4]), selected_data[5]
+    user_type, lifetime, description = selected_data[7], selected_data[8], selected_data[10]
+    for first_user_number in range(1, user_qty + 1, chunk_size):
+        user_credentials = list(generate_guest_users(user_prefix, first_user_number, min(chunk_size, user_qty - first_user_number + 1)))
+        if issued_credentials:
+            user_credentials = [guest_user(user, issued_credentials.get(user, password)) for user, password in user_credentials]
+        command_list = []
+        for guest_credential in user_credentials:
+            command_list += build_user_commands(guest_credential, wlan_id, user_type, lifetime, description)
+        yield user_credentials, command_list
+
+
+class job_journal(object):
+    """Durable journal of a job: credentials issued, users confirmed and saved on each WLC and users e-mailed
+    
+    One JSON line per event, written with fsync so a run killed at any point can be resumed
+    with --resume: confirmed users are not sent again and keep their password, only missing e-mails are sent.
+    """
+    def __init__(self, journal_dir, job_id):
+        self.journal_dir = journal_dir
+        self.path = os.path.join(journal_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', job_id) + '.jsonl')
+        self.lock = threading.Lock()
+        self.job_row = None
+        self.date_start = None
+        self.credentials = {}
+        self.confirmed = {}
+        self.saved = set()
+        self.mailed = set()
+        self.journal_file = None
+
+
+    def load(self):
+        #Replays the journal left by an interrupted run, returns False when there is none
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    #last line torn by a crash
+                    break
+                if entry['event'] == 'start':
+                    self.job_row = entry['job']
+                    self.date_start = datetime.strptime(entry['date_start'], '%Y-%m-%dT%H:%M:%S.%f')
+                elif entry['event'] == 'issued':
+                    self.credentials.update(entry['users'])
+                elif entry['event'] == 'confirmed':
+                    self.confirmed.setdefault(entry['controller'], set()).add(entry['user'])
+                    self.saved.discard(entry['controller'])
+                elif entry['event'] == 'saved':
+                    self.saved.add(entry['controller'])
+                elif entry['event'] == 'mailed':
+                    self.mailed.update(entry['users'])
+        return True
+
+
+    def start(self, job_row, date_start):
+        #A new run of the job replaces the journal of any previous run
+        os.makedirs(self.journal_dir, exist_ok=True)
+        #the journal holds guest passwords, it is only readable by the script user
+        self.journal_file = os.fdopen(os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w')
+        self.job_row = job_row
+        self.date_start = date_start
+        self.write({'event': 'start', 'job': job_row, 'date_start': date_start.strftime('%Y-%m-%dT%H:%M:%S.%f')})
+
+
+    def resume(self):
+        self.journal_file = os.fdopen(os.open(self.path, os.O_WRONLY | os.O_APPEND), 'a')
+
+
+    def write(self, entry):
+        with self.lock:
+            self.journal_file.write(json.dumps(entry) + '\n')
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+
+
+    def record_issued(self, user_credentials):
+        new_credentials = [[user, password] for user, password in user_credentials if user not in self.credentials]
+        if new_credentials:
+            self.write({'event': 'issued', 'users': new_credentials})
+            self.credentials.update(new_credentials)
+
+
+    def record_command(self, wlc_ip, cli_result):
+        #command_callback of the WLC sessions
+        if cli_result.command_type == 'add' and cli_result.kind == 'added':
+            self.write({'event': 'confirmed', 'controller': wlc_ip, 'user': cli_result.user})
+            with self.lock:
+                self.confirmed.setdefault(wlc_ip, set()).add(cli_result.user)
+                self.saved.discard(wlc_ip)
+        elif cli_result.kind == 'saved':
+            self.write({'event': 'saved', 'controller': wlc_ip})
+            with self.lock:
+                self.saved.add(wlc_ip)
+
+
+    def record_mailed(self, user_credentials):
+        self.write({'event': 'mailed', 'users': [user for user, password in user_credentials]})
+        self.mailed.update(user for user, password in user_credentials)
+
+
+    def pending_commands(self, selected_data, user_credentials, wlc_ip, save_config=True):
+        #Commands of each WLC for the users it has not confirmed yet, None for a WLC with nothing left to do
+        wlc_command_lists = {}
+        for ip in wlc_ip:
+            confirmed_users = self.confirmed.get(ip, set())
+            command_list = []
+            for guest_credential in user_credentials:
+                if guest_credential.user not in confirmed_users:
+                    command_list += build_user_commands(guest_credential, selected_data[5], selected_data[7], selected_data[8], selected_data[10])
+            if command_list or (save_config and ip not in self.saved):
+                wlc_command_lists[ip] = command_list
+            else:
+                wlc_command_lists[ip] = None
+        return wlc_command_lists
+
+
+    def unmailed(self, user_credentials):
+        return [guest_credential for guest_credential in user_credentials if guest_credential.user not in self.mailed]
+
+
+    def close(self, completed=False):
+        #the journal of a completed job is removed with the passwords it holds
+        if self.journal_file:
+            self.journal_file.close()
+            self.journal_file = None
+        if completed and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def chain_command_callbacks(*command_callbacks):
+    #One command_callback calling each of the given ones in turn, None when none is given
+    command_callbacks = [command_callback for command_callback in command_callbacks if command_callback]
+    if len(command_callbacks) <= 1:
+        return (command_callbacks or [None])[0]
+    def command_callback(wlc_ip, cli_result):
+        for chained_command_callback in command_callbacks:
+            chained_command_callback(wlc_ip, cli_result)
+    return command_callback
+
+
+class account_ledger(object):
+    """Local record of the guest accounts created on each WLC: job id, user, lifetime and expiry
+    
+    Kept in a SQLite file (no passwords) indexed by controller and expiry, it answers --active,
+    feeds --sweep and, with DeleteKnownUsersOnly, limits the delete commands of a job to users it lists.
+    Commands confirmed by the WLCs are buffered by the command_callback of recorder() and written by flush().
+    """
+    def __init__(self, ledger_file):
+        self.ledger_file = ledger_file
+        self.lock = threading.Lock()
+        self.pending = []
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS ledger_accounts (controller TEXT NOT NULL, user TEXT NOT NULL, controller_name TEXT NOT NULL, job_id TEXT NOT NULL, '
+                'transport TEXT NOT NULL, created REAL NOT NULL, lifetime INTEGER NOT NULL, expires REAL, PRIMARY KEY (controller, user))')
+            db.execute('CREATE INDEX IF NOT EXISTS ledger_accounts_controller_expiry ON ledger_accounts (controller, expires)')
+            db.execute('CREATE INDEX IF NOT EXISTS ledger_accounts_expiry ON ledger_accounts (expires)')
+            db.execute('CREATE INDEX IF NOT EXISTS ledger_accounts_controller_name ON ledger_accounts (controller_name)')
+    
+    
+    @contextmanager
+    def connect(self):
+        #autocommit connection, transactions are opened explicitly with BEGIN IMMEDIATE
+        import sqlite3
+        db = sqlite3.connect(self.ledger_file, timeout=60, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+    
+    
+    def recorder(self, job_id, controller_names, transport_name, lifetime):
+        #Returns the command_callback recording the users a job adds and deletes on its WLCs (controller_names: {wlc_ip: wlc_name})
+        def record_command(wlc_ip, cli_result):
+            if cli_result.command_type == 'add' and cli_result.kind == 'added':
+                created = time()
+                #a lifetime of 0 never expires
+                with self.lock:
+                    self.pending.append((wlc_ip, cli_result.user, (controller_names.get(wlc_ip, ''), job_id, transport_name, created, lifetime, created + lifetime if lifetime else None)))
+            elif cli_result.command_type == 'delete' and cli_result.kind in ('deleted', 'absent'):
+                with self.lock:
+                    self.pending.append((wlc_ip, cli_result.user, None))
+        return record_command
+    
+    
+    def flush(self):
+        #Writes the buffered adds and deletes in one transaction, in the order the WLCs confirmed them
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            for wlc_ip, user, account in pending:
+                if account is None:
+                    db.execute('DELETE FROM ledger_accounts WHERE controller = ? AND user = ?', (wlc_ip, user))
+                else:
+                    db.execute('INSERT OR REPLACE INTO ledger_accounts (controller, user, controller_name, job_id, transport, created, lifetime, expires) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (wlc_ip, user) + account)
+            db.execute('COMMIT')
+    
+    
+    def controller_users(self, wlc_ip):
+        #users the ledger lists on a WLC, expired ones included until they are swept
+        with self.connect() as db:
+            return set(user for user, in db.execute('SELECT user FROM ledger_accounts WHERE controller = ?', (wlc_ip,)))
+    
+    
+    def known_deletes_only(self, command_lists, wlc_ip):
+        #command_lists is a command list or a dict with the command list of each WLC IP (None when it has nothing left to do)
+        #Returns the dict of the command lists of each WLC IP without the deletes of users the ledger does not list on it
+        wlc_command_lists = {}
+        for ip in wlc_ip:
+            command_list = command_lists[ip] if isinstance(command_lists, dict) else command_lists
+            if command_list is None:
+                wlc_command_lists[ip] = None
+                continue
+            known_users = self.controller_users(ip)
+            wlc_command_lists[ip] = [command for command in command_list if not command.startswith('config netuser delete ') or command.rsplit(' ', 1)[-1] in known_users]
+        return wlc_command_lists
+    
+    
+    def active(self, now, controller=''):
+        #Returns the accounts not expired at now as (controller, controller_name, user, job_id, expires), on every WLC or on one WLC (IP or name)
+        with self.connect() as db:
+            if controller:
+                return db.execute('SELECT controller, controller_name, user, job_id, expires FROM ledger_accounts WHERE (controller = ? OR controller_name = ?) AND (expires IS NULL OR expires > ?) '
+                    'ORDER BY controller, expires', (controller, controller, now)).fetchall()
+            return db.execute('SELECT controller, controller_name, user, job_id, expires FROM ledger_accounts WHERE expires IS NULL OR expires > ? ORDER BY controller, expires', (now,)).fetchall()
+    
+    
+    def expired(self, now):
+        #Returns {(transport, controller): (controller_name, [users])} of the accounts expired at now
+        expired_accounts = {}
+        with self.connect() as db:
+            for controller, controller_name, transport_name, user in db.execute('SELECT controller, controller_name, transport, user FROM ledger_accounts WHERE expires <= ? ORDER BY controller, expires', (now,)):
+                expired_accounts.setdefault((transport_name, controller), (controller_name, []))[1].append(user)
+        return expired_accounts
+
+
+def load_job_data(full_path_csv_file, csv_rows_skip):
+    #Returns the job rows indexed by job id and the set of job ids present more than once
+    #The index is stored next to the csv file and only rebuilt when the csv file size or mtime changes
+    #A long running process also keeps the last index in memory
+    index_file = full_path_csv_file + '.idx'
+    csv_stat = os.stat(full_path_csv_file)
+    csv_signature = [csv_stat.st_mtime_ns, csv_stat.st_size, int(csv_rows_skip)]
+    if full_path_csv_file in job_data_cache and job_data_cache[full_path_csv_file][0] == csv_signature:
+        return job_data_cache[full_path_csv_file][1], job_data_cache[full_path_csv_file][2]
+    try:
+        with open(index_file) as f:
+            job_data_index = json.load(f)
+        if job_data_index['signature'] == csv_signature:
+            job_data_cache[full_path_csv_file] = (csv_signature, job_data_index['jobs'], set(job_data_index['duplicates']))
+            return job_data_index['jobs'], set(job_data_index['duplicates'])
+    except (IOError, ValueError, KeyError):
+        pass
+    
+    job_index = {}
+    duplicate_job_ids = set()
+    with open(full_path_csv_file, newline='') as csv_file:
+        for i in range(int(csv_rows_skip)):
+            csv_file.readline()
+        for row in csv.reader(csv_file):
+            if len(row) == 0 or ''.join(row).strip() == '':
+                continue
+            if len(row) < 12:
+                raise ValueError('Job data row has %s columns instead of 12: %s' % (len(row), ','.join(row)))
+            row = [column.strip() for column in row]
+            if row[0] in job_index:
+                duplicate_job_ids.add(row[0])
+            job_index[row[0]] = row
+    
+    try:
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump({'signature': csv_signature, 'jobs': job_index, 'duplicates': sorted(duplicate_job_ids)}, f)
+        os.replace(index_file + '.tmp', index_file)
+    except (IOError, OSError):
+        #a read-only job data folder only costs parsing the csv file again on the next run
+        pass
+    job_data_cache[full_path_csv_file] = (csv_signature, job_index, duplicate_job_ids)
+    return job_index, duplicate_job_ids
+
+
+def process_select_data(job_index, duplicate_job_ids, entered_id, full_path_csv_file, log_full_path_file, stream_chunk_size=0):
     process_error = []
 
-    if len(csv_data) == 0:
+    if len(job_index) == 0:
         process_error.append('Error / Wireless Guest User Creation - Absence of jobs in data file')
         process_error.append('No jobs exist in job data file: ' + full_path_csv_file + '\n\nAdd some jobs and run the script again!')
         return [], [], [], process_error
-    elif csv_data.ndim == 1:
-        id_list.append(csv_data[0][0])
-        id_idx = 0
-    else:
-        for i in range(len(csv_data)):
-            id_list.append(csv_data[i][0])
-            if str(entered_id) == csv_data[i][0]:
-                id_idx = i
 
-    if id_list.count(entered_id) > 1:
+    if entered_id in duplicate_job_ids:
         process_error.append('Error / Wireless Guest User Creation - Duplicate job id')
         process_error.append('Selected id "' + entered_id + '" is present more than once in the job data file: ' + full_path_csv_file + '\n\nRemove duplicate job ids and run the script again!')
         return [], [], [], process_error
 
-    if (id_idx == None) and (len(csv_data) != 0):
+    if entered_id not in job_index:
         process_error.append('Error / Wireless Guest User Creation - Unable to select job id')
         process_error.append('The selected id "' + str(entered_id) + '" does not exist in data file: ' + full_path_csv_file)
         return [], [], [], process_error
 
-    if csv_data.ndim == 1:
-        id = csv_data[0]
-        wlc_ip = csv_data[1]
-        wlc_name = csv_data[2]
-        user_prefix = csv_data[3]
-        user_qty = csv_data[4]
-        wlan_id = csv_data[5]
-        ssid = csv_data[6]
-        user_type = csv_data[7]
-        lifetime = csv_data[8]
-        timezone_code = csv_data[9]
-        description = csv_data[10]
-        guest_email_receiver_address = csv_data[11]
-    elif csv_data.ndim > 1:
-        id = csv_data[id_idx][0]
-        wlc_ip = csv_data[id_idx][1]
-        wlc_name = csv_data[id_idx][2]
-        user_prefix = csv_data[id_idx][3]
-        user_qty = csv_data[id_idx][4]
-        wlan_id = csv_data[id_idx][5]
-        ssid = csv_data[id_idx][6]
-        user_type = csv_data[id_idx][7]
-        lifetime = csv_data[id_idx][8]
-        timezone_code = csv_data[id_idx][9]
-        description = csv_data[id_idx][10]
-        guest_email_receiver_address = csv_data[id_idx][11]
-    else:
-        process_error.append('Error / Wireless Guest User Creation - Unknown error')
-        process_error.append('Something has gone wrong, not sure quite what though!\nFor more info check check log file: ' + log_full_path_file)
-        return [], [], [], process_error
+    job_row = job_index[entered_id]
+    id = job_row[0]
+    wlc_ip = job_row[1]
+    wlc_name = job_row[2]
+    user_prefix = job_row[3]
+    user_qty = job_row[4]
+    wlan_id = job_row[5]
+    ssid = job_row[6]
+    user_type = job_row[7]
+    lifetime = job_row[8]
+    timezone_code = job_row[9]
+    description = job_row[10]
+    guest_email_receiver_address = job_row[11]
+    #optional columns
+    email_delivery = job_row[12] if len(job_row) > 12 else ''
+    transport = job_row[13] if len(job_row) > 13 else ''
 
     if id == str(entered_id):
-        password_length = 8
-        chars = string.ascii_letters + string.digits + ''
-        random.seed = (os.urandom(1024))
+        selected_data = [id, wlc_ip, wlc_name, user_prefix, user_qty, wlan_id, ssid, user_type, lifetime, timezone_code, description, guest_email_receiver_address, email_delivery, transport]
+        if 0 < stream_chunk_size < int(user_qty):
+            #Streaming mode: users and commands are generated chunk by chunk while the job runs (see iter_user_chunks)
+            return selected_data, None, None, ''
         command_list = []
         user_credentials = []
         #Generates a list of commands
-        for i in range(int(user_qty)):
-            user = user_prefix + '_' + str(i+1)
-            password = ''.join(random.choice(chars) for i in range(password_length))
-            command_del = 'config netuser delete username ' + user + ''
-            command_del_old = 'config netuser delete ' + user + ''
-            command_add = 'config netuser add ' + user + ' ' + password + ' wlan ' + wlan_id + ' userType ' + user_type + ' lifetime ' + lifetime + ' description "' + description + '"'
-            command_list.append(command_del)
-            command_list.append(command_del_old)
-            command_list.append(command_add)
-            user_credentials.append([[user],[password]])
-        selected_data = [id, wlc_ip, wlc_name, user_prefix, user_qty, wlan_id, ssid, user_type, lifetime, timezone_code, description, guest_email_receiver_address]
+        for guest_credential in generate_guest_users(user_prefix, 1, int(user_qty)):
+            command_list += build_user_commands(guest_credential, wlan_id, user_type, lifetime, description)
+            user_credentials.append(guest_credential)
         #Returns list of commands
         return selected_data, command_list, user_credentials, ''
     else:
@@ -223,278 +990,1806 @@ def process_select_data(csv_data, entered_id, full_path_csv_file, log_full_path_
         return [], [], [], process_error
 
 
-def issue_commands_on_device(platform, wlc_name, wlc_ip, username, password, command_list):
-    creation_outcome = ''
-    cli_failure_msg = 'WLC cli commads execution failure, check script log file for command execution logs'
+class latency_profiles(object):
+    """Latency profile of each WLC, learned from its sessions and kept between runs in LatencyProfileFile (AdaptiveTiming)
     
-    try:
-        device = ConnectHandler(device_type=platform, ip=wlc_ip, username=username, password=password)
-        print('SSH Connected!\nExecuting the following commands via ssh on "' + wlc_name + ' - '  + wlc_ip + '":\n' + '-' * 100)
-        
-        for command in command_list:
-            print(re.sub(r'(.*?config netuser add\ .*?\ )(.{8})(\ wlan.*?)', r'\1********\3', command, re.MULTILINE))
-            command_result = device.send_command(command)
-            if command_result == '\n':
-                command_result = '\nNo Output\n\n'
-                if creation_outcome != ('' or cli_failure_msg): creation_outcome = 'success'
+    The round trip of the prompt, the netuser commands, show netuser summary and save config are tracked per WLC
+    as a smoothed average and deviation, like TCP retransmission timers. The learned latency is applied through
+    the read_timeout given to every send_command (the slowest reply expected, times ReadTimeoutMultiplier), the
+    batch timeout and the polling of streamed batches. The delay factor only trims the fixed sleeps netmiko adds
+    around the output read, WLCs without a profile keep the netmiko defaults.
+    """
+    default_read_timeout = {'command': 10.0, 'show': 10.0, 'save_config': 10.0}
+    default_batch_timeout = 120.0
+    default_poll_interval = 0.02
+    #in netmiko 4 the delay factor scales the sleeps of find_prompt (0.25 s times it), clear_buffer and the login only,
+    #the output of send_command is polled every 25 ms until the prompt shows up or read_timeout runs out
+    prompt_wait = 0.25
+    #delay factor netmiko uses with fast_cli, profiled WLCs never wait longer than that
+    fast_cli_delay_factor = 0.1
+    
+    def __init__(self):
+        self.profile_file = ''
+        self.read_timeout_multiplier = 3.0
+        self.min_read_timeout = 5.0
+        self.max_read_timeout = 300.0
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.updated_controllers = set()
+    
+    
+    def configure(self, profile_file, read_timeout_multiplier=3.0, min_read_timeout=5.0, max_read_timeout=300.0):
+        self.profile_file = profile_file
+        self.read_timeout_multiplier = read_timeout_multiplier
+        self.min_read_timeout = min_read_timeout
+        self.max_read_timeout = max_read_timeout
+        try:
+            with open(profile_file) as f:
+                self.profiles = json.load(f)
+        except (IOError, ValueError):
+            #first run, or a profile file damaged by hand: the WLCs are learned again
+            self.profiles = {}
+    
+    
+    def enabled(self):
+        return bool(self.profile_file)
+    
+    
+    def observe(self, wlc_ip, kind, seconds):
+        if not self.profile_file:
+            return
+        with self.lock:
+            profile = self.profiles.setdefault(wlc_ip, {})
+            stats = profile.get(kind)
+            if stats is None:
+                profile[kind] = {'average': seconds, 'deviation': seconds / 2, 'samples': 1}
             else:
-                command_result = re.sub(r'(.*?user add\ .*?\ )(.{8})(\ wlan.*?)', r'\1********\3', command_result, re.MULTILINE)
-                if ((creation_outcome != ('' or cli_failure_msg)) and 
-                    ((command_result == '\n') or ('Deleted user' in command_result) or (re.findall(r'.*?User.*?does\ not\ exist.*', command_result) is not None)) and
-                	(re.findall(r'.*Guest\ user\ not\ added.*', command_result) == [])):
-                    creation_outcome = 'success'
-                else:
-                    creation_outcome = cli_failure_msg
-            print('Command Output:\n' + ('-' * 100) + '\n' + command_result + '' + ('-' * 100) + '\n')
-        
-        print('save config')
-        output = device.send_command('save config\ny')
-        print(output)
-        
-        device.disconnect()
-        return creation_outcome
+                stats['deviation'] = 0.75 * stats['deviation'] + 0.25 * abs(seconds - stats['average'])
+                stats['average'] = 0.875 * stats['average'] + 0.125 * seconds
+                stats['samples'] += 1
+            profile['updated'] = time()
+            self.updated_controllers.add(wlc_ip)
+    
+    
+    def expected(self, wlc_ip, kind):
+        #slowest reply expected from the WLC (average plus 4 deviations), None without a profile
+        with self.lock:
+            stats = self.profiles.get(wlc_ip, {}).get(kind) if self.profile_file else None
+            return stats and stats['average'] + 4 * stats['deviation']
+    
+    
+    def read_timeout(self, wlc_ip, kind):
+        #read_timeout of send_command: the slowest reply expected for the kind of command times the margin
+        #a kind not timed yet on the WLC waits at least the multiplied prompt round trip measured at the start of the session
+        expected = self.expected(wlc_ip, kind)
+        if expected is None:
+            expected_prompt = self.expected(wlc_ip, 'prompt')
+            if expected_prompt is None:
+                return self.default_read_timeout[kind]
+            return min(max(self.read_timeout_multiplier * expected_prompt, self.default_read_timeout[kind]), self.max_read_timeout)
+        return min(max(self.read_timeout_multiplier * expected, self.min_read_timeout), self.max_read_timeout)
+    
+    
+    def batch_timeout(self, wlc_ip, command_count):
+        #commands streamed in a batch are profiled by their share of the batch time
+        expected = self.expected(wlc_ip, 'batch')
+        if expected is None:
+            return self.default_batch_timeout
+        return min(max(self.read_timeout_multiplier * expected * command_count, self.min_read_timeout), self.max_read_timeout)
+    
+    
+    def delay_factor(self, wlc_ip):
+        #global_delay_factor of the netmiko session (1 lets netmiko pick its fast_cli default of 0.1)
+        #the find_prompt and clear_buffer sleeps shrink from the fast_cli 25 ms to the round trip of nearby WLCs, down to 2.5 ms
+        #slow WLCs are covered by their read timeouts, not by longer sleeps
+        expected = self.expected(wlc_ip, 'prompt')
+        if expected is None:
+            return 1.0
+        return min(max(expected / self.prompt_wait, 0.01), self.fast_cli_delay_factor)
+    
+    
+    def poll_interval(self, wlc_ip):
+        expected = self.expected(wlc_ip, 'prompt')
+        if expected is None:
+            return self.default_poll_interval
+        return min(max(expected / 4, 0.005), 0.1)
+    
+    
+    def save(self):
+        #Writes the profiles of the WLCs seen by this process, the other WLCs of the file are kept as they are
+        if not self.profile_file or not self.updated_controllers:
+            return
+        with self.lock:
+            try:
+                with open(self.profile_file) as f:
+                    profiles = json.load(f)
+            except (IOError, ValueError):
+                profiles = {}
+            for wlc_ip in self.updated_controllers:
+                profiles[wlc_ip] = self.profiles[wlc_ip]
+            self.updated_controllers = set()
+            try:
+                with open(self.profile_file + '.%s.tmp' % os.getpid(), 'w') as f:
+                    json.dump(profiles, f, indent=1, sort_keys=True)
+                os.replace(self.profile_file + '.%s.tmp' % os.getpid(), self.profile_file)
+            except (IOError, OSError) as e:
+                log.error('Error: the WLC latency profile file could not be written (' + str(e) + ')')
 
-    except NetMikoTimeoutException:
-        err_msg = 'SSH connection timeout for %s (%s)' % (wlc_name, wlc_ip)
-        print(err_msg)
-        return err_msg
-    except NetMikoAuthenticationException:
-        err_msg = 'SSH authentication failure for %s (%s)' % (wlc_name, wlc_ip)
-        print(err_msg)
-        return err_msg
-    except IOError:
-        err_msg = 'SSH session ended unexpectedly for %s (%s)' % (wlc_name, wlc_ip)
-        print(err_msg)
-        return err_msg
-    except Exception:
-        if wlc_ip == '':
-            wlc_ip ='WLC IP Missing'
-        err_msg = 'Unspecified exception for %s (%s).<br>Possible reasons: missing wlc ip, wrong password, or something else entirely' % (wlc_name, wlc_ip)
-        print(err_msg)
-        return err_msg
 
+#configured by main() when AdaptiveTiming is enabled
+controller_timing = latency_profiles()
 
-def send_guest_user_mail(user_credentials, ssid, user_type, localized_date_start, localized_date_end, email_server, guest_email_sender_name, guest_email_sender_address, guest_email_receiver_address):
-    guest_email_receiver_name = guest_email_receiver_address
-    guest_email_subject = "Wireless Guest User Credentials"
-    
-    i = 0
-    for user_credential in user_credentials:
-        user, password = user_credential[0][0], user_credential[1][0]
-        guest_email_msg = ('Wireless Guest User Credentials<br>'
-            '-------------------------------<br>'
-            'Guest account User Name : %s<br>'
-            'Guest account Password : %s<br>'
-            'Profile name : %s<br>'
-            'User Active from : %s<br>'
-            'User Active until : %s<br><br>'
-            'DISCLAIMER : Guests understand and acknowledge that we exercise no control over the nature, content or reliability of the information and/or data passing through our network.<br><br>'
-            'Regards,<br><br>'
-            'Network Team'
-        ) % (user, password, ssid, localized_date_start, localized_date_end)
-        #print(guest_email_msg)
-        email = email_SMTP(email_server, guest_email_sender_name, guest_email_sender_address, guest_email_receiver_name, guest_email_receiver_address, guest_email_subject, guest_email_msg)
-        email.send()
-        i += 1
 
+def timed_send_command(device, wlc_ip, command, kind='command'):
+    #send_command with the read timeout of the latency profile of the WLC (netmiko's 10 s without one), the reply time goes into the profile
+    from netmiko import ReadTimeout
+    read_timeout = controller_timing.read_timeout(wlc_ip, kind)
+    command_start = monotonic()
+    try:
+        output = device.send_command(command, read_timeout=read_timeout)
+    except ReadTimeout:
+        #a WLC slower than its read timeout gets a longer one next time
+        controller_timing.observe(wlc_ip, kind, read_timeout)
+        raise
+    controller_timing.observe(wlc_ip, kind, monotonic() - command_start)
+    return output
 
-def send_generic_mail(email_server, admin_email_sender_name, admin_email_sender_address, admin_email_receiver_name, admin_email_receiver_address, admin_email_subject, admin_email_msg):
-    email = email_SMTP(email_server, admin_email_sender_name, admin_email_sender_address, admin_email_receiver_name, admin_email_receiver_address, admin_email_subject, admin_email_msg)
-    result = email.send()
-    return result
 
+def measure_prompt_round_trip(device, wlc_ip):
+    #Times the reply of the WLC to an empty line for its latency profile, the prompt wait follows it from the next session on
+    read_timeout = controller_timing.read_timeout(wlc_ip, 'command')
+    #output left over from the login would answer the probe
+    device.clear_buffer(backoff=False)
+    device.write_channel(device.RETURN)
+    output = ''
+    probe_start = monotonic()
+    while not (device.base_prompt in output and output.rstrip()[-1:] in ('>', '#')):
+        if monotonic() - probe_start > read_timeout:
+            device.clear_buffer()
+            return
+        data = device.read_channel()
+        if data:
+            output += data
+        else:
+            sleep(0.002)
+    controller_timing.observe(wlc_ip, 'prompt', monotonic() - probe_start)
+    log.info('Adaptive timing for %s: round trip %.0f ms, delay factor %.2f from the next session, read timeouts %.1f s (command) %.1f s (save config)' % (wlc_ip, (monotonic() - probe_start) * 1000, controller_timing.delay_factor(wlc_ip), controller_timing.read_timeout(wlc_ip, 'command'), controller_timing.read_timeout(wlc_ip, 'save_config')))
 
-def test_email_server(email_server):
-    email = email_SMTP(email_server)
-    result = email.test()
-    return result
 
+def send_command_batch(device, commands, prompt, timeout=120, poll_interval=0.02):
+    #Streams a block of commands down the SSH channel in a single write and reads the combined output once
+    #The output is split back on the device prompt, one segment per command, with the command echo removed
+    device.write_channel(device.RETURN.join(commands) + device.RETURN)
+    output = ''
+    deadline = monotonic() + timeout
+    while output.count(prompt) < len(commands):
+        if monotonic() > deadline:
+            raise IOError('Timed out waiting for the output of a batch of %s commands' % len(commands))
+        data = device.read_channel()
+        if data:
+            output += data
+        else:
+            sleep(poll_interval)
+    
+    command_results = []
+    for command, segment in zip(commands, output.split(prompt)):
+        lines = segment.replace('\r\n', '\n').replace('\r', '').lstrip('\n').split('\n')
+        #the echo of a long command can be wrapped over several lines by the WLC
+        echo = ''
+        while lines and lines[0].strip() and command.replace(' ', '').startswith((echo + lines[0]).replace(' ', '')):
+            echo += lines.pop(0)
+        command_result = '\n'.join(lines).strip('\n')
+        command_results.append(command_result + '\n' if command_result != '' else '\n')
+    return command_results
 
-def fmt_multiple_email_addresses(email_add):
-    #Format e-mails to add to text
-    fmt_email_add = ""
-    if (len(email_add) >= 1):
-        for i in range(len(email_add)):
-            if i != (len(email_add)-1):
-                fmt_email_add += email_add[i] + ' - '
-            else:
-                fmt_email_add += email_add[i]
-    return fmt_email_add
 
+cli_failure_msg = 'WLC cli commads execution failure, check script log file for command execution logs'
+netuser_password_re = re.compile(r'(config netuser add \S+ |user add \S+ )(\S+)( wlan)')
+#checked in order, the first pattern found in the output of a command gives its result
+cli_output_patterns = (
+    ('rejected', re.compile(r'Guest user not added|Incorrect (?:usage|input)|Invalid|Error|not allowed|already exists|Request failed', re.IGNORECASE)),
+    ('deleted', re.compile(r'Deleted user', re.IGNORECASE)),
+    ('absent', re.compile(r'User\b.*?\bdoes not exist', re.IGNORECASE)),
+)
+command_result = namedtuple('command_result', ['command_type', 'kind', 'user'])
 
-def main(argv):
-    config_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),'config.ini')
-    fmt = "%a %b %d %Y - %H:%M:00 %Z %z"
-    fmtlog = "%a %b %d %Y - %H:%M:%S %Z %z"
-    successful_job_count = 0
-    failed_job_count = 0
+
+def mask_netuser_password(text):
+    #Hides the password of config netuser add commands in logs
+    if 'user add ' not in text:
+        return text
+    return netuser_password_re.sub(r'\1********\3', text)
+
+
+def classify_command_output(command, command_output):
+    #Returns the command_result of a netuser command from its CLI output:
+    #kind is added, deleted, absent (user to delete does not exist), rejected or unknown
+    if command.startswith('config netuser add '):
+        command_type, user = 'add', command.split(' ', 4)[3]
+    elif command.startswith('config netuser delete '):
+        command_type, user = 'delete', command.rsplit(' ', 1)[-1]
+    else:
+        command_type, user = 'other', ''
     
-    try:
-        config = configparser.ConfigParser()
-        config.read(config_file)
-        
-        #load config files setting
-        platform = config['DEVICE_PARAMETERS']['Platform']
-        username = config['DEVICE_PARAMETERS']['Username']
-        password = config['DEVICE_PARAMETERS']['Password']
-        guest_email_sender_name = config['GUEST_USERS_EMAIL']['GuestEmailSenderName']
-        guest_email_sender_address = config['GUEST_USERS_EMAIL']['GuestEmailSenderAddress']
-        admin_email_sender_name  = config['ADMIN_NOTIFICATION_EMAIL']['AdminEmailSenderName']
-        admin_email_sender_address = config['ADMIN_NOTIFICATION_EMAIL']['AdminEmailSenderAddress']
-        admin_email_receiver_name = config['ADMIN_NOTIFICATION_EMAIL']['AdminEmailReceiverName']
-        admin_email_receiver_address = config['ADMIN_NOTIFICATION_EMAIL']['AdminEmailReceiverAddress']
-        csv_file = config['GLOBAL_PARAMETERS']['CsvFile']
-        csv_rows_skip = config['GLOBAL_PARAMETERS']['CsvRowsSkip']
-        email_server = config['GLOBAL_PARAMETERS']['EmailServer']
-        file_logging = config['GLOBAL_PARAMETERS']['FileLogging']
-        log_file_name = config['GLOBAL_PARAMETERS']['LogFileName']
+    if command_output.strip() == '':
+        kind = {'add': 'added', 'delete': 'deleted'}.get(command_type, 'unknown')
+    else:
+        kind = 'unknown'
+        for output_kind, output_pattern in cli_output_patterns:
+            if output_pattern.search(command_output):
+                kind = output_kind
+                break
+        if command_type == 'add' and kind != 'rejected':
+            kind = 'unknown'
+    return command_result(command_type, kind, user)
+
+
+netuser_summary_user_re = re.compile(r'^\s*User Name\.+\s*(\S+)', re.MULTILINE)
+netuser_delete_syntax_cache = {}
+
+
+def parse_netuser_summary(output):
+    #Returns the set of user names listed by "show netuser summary"
+    return set(netuser_summary_user_re.findall(output))
+
+
+def detect_netuser_delete_syntax(device, wlc_ip):
+    #Newer WLC releases take "config netuser delete username X", older ones "config netuser delete X"
+    #An absent probe user is deleted with the newer syntax: only a WLC accepting it names the probe user in its reply
+    if wlc_ip not in netuser_delete_syntax_cache:
+        probe_user = 'wlc_guest_user_creator_probe'
+        probe_output = timed_send_command(device, wlc_ip, 'config netuser delete username ' + probe_user)
+        netuser_delete_syntax_cache[wlc_ip] = 'username' if probe_user in probe_output else 'legacy'
+    return netuser_delete_syntax_cache[wlc_ip]
+
+
+class wlc_netusers(object):
+    """Guest users of a WLC, read once with show netuser summary and kept up to date with the commands the WLC accepts
+    
+    The streaming chunks of a job and the grouped jobs of a session share it, so the table of a WLC
+    with thousands of netusers is read once instead of before every command list.
+    """
+    def __init__(self):
+        self.users = None
+        self.delete_syntax = None
+    
+    
+    def read(self, device, wlc_ip):
+        if self.users is None:
+            self.users = parse_netuser_summary(timed_send_command(device, wlc_ip, 'show netuser summary', 'show'))
+            log.info('Reconciliation: %s guest users found on the WLC' % len(self.users))
+        return self.users
+    
+    
+    def update(self, cli_result):
+        if self.users is None:
+            return
+        if cli_result.kind == 'added':
+            self.users.add(cli_result.user)
+        elif cli_result.kind in ('deleted', 'absent'):
+            self.users.discard(cli_result.user)
+
+
+def reconcile_command_list(command_list, existing_users, delete_syntax):
+    #Drops delete commands for users not present on the WLC and for the delete syntax it does not support
+    reconciled_command_list = []
+    for command in command_list:
+        if command.startswith('config netuser delete '):
+            command_words = command.split()
+            if command_words[-1] not in existing_users:
+                continue
+            if (len(command_words) == 5) != (delete_syntax == 'username'):
+                continue
+        reconciled_command_list.append(command)
+    return reconciled_command_list
+
+
+class ssh_session_pool(object):
+    """Pool of reusable SSH sessions to the WLCs, keyed by WLC IP
+    """
+    def __init__(self, max_sessions_per_controller=1, idle_timeout=300, keepalive=30):
+        self.max_sessions_per_controller = max_sessions_per_controller
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.lock = threading.Lock()
+        self.idle_sessions = {}
+        self.session_slots = {}
+
+
+    def controller_slots(self, wlc_ip):
+        with self.lock:
+            if wlc_ip not in self.session_slots:
+                self.session_slots[wlc_ip] = threading.BoundedSemaphore(self.max_sessions_per_controller)
+            return self.session_slots[wlc_ip]
+
+
+    def acquire(self, platform, wlc_ip, username, password, ssh_port=22, login_timeout=None):
+        #Hands out a healthy idle session to the WLC, or logs in a new one if there is none
+        #login_timeout bounds each step of a new login (TCP connect, SSH banner, authentication, prompt)
+        from netmiko import ConnectHandler
+        self.controller_slots(wlc_ip).acquire()
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle_sessions.get(wlc_ip):
+                        break
+                    device, last_used = self.idle_sessions[wlc_ip].pop()
+                if monotonic() - last_used < self.idle_timeout and self.is_healthy(device):
+                    log.info('Reusing SSH session to ' + wlc_ip)
+                    metrics.increment('ssh_sessions', controller=wlc_ip, session='reused')
+                    return device
+                self.disconnect(device)
+            with metrics.timer('ssh_connect_seconds', controller=wlc_ip):
+                device = ConnectHandler(device_type=platform, ip=wlc_ip, port=ssh_port, username=username, password=password, keepalive=self.keepalive, global_delay_factor=controller_timing.delay_factor(wlc_ip), **ssh_login_timeouts(login_timeout))
+            #the jobs reading from the session keep their own read timeouts
+            device.read_timeout_override = None
+            metrics.increment('ssh_sessions', controller=wlc_ip, session='new')
+            return device
+        except:
+            self.controller_slots(wlc_ip).release()
+            raise
+
+
+    def release(self, wlc_ip, device, reusable=True):
+        if reusable:
+            with self.lock:
+                self.idle_sessions.setdefault(wlc_ip, []).append((device, monotonic()))
+        else:
+            self.disconnect(device)
+        self.controller_slots(wlc_ip).release()
+        self.evict_idle()
+
+
+    def is_healthy(self, device):
+        try:
+            if not device.is_alive():
+                return False
+            device.clear_buffer()
+            return True
+        except Exception:
+            return False
+
+
+    def disconnect(self, device):
+        try:
+            device.disconnect()
+        except Exception:
+            pass
+
+
+    def evict_idle(self, idle_timeout=None):
+        #Closes sessions that have not been used for idle_timeout seconds
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        evicted_sessions = []
+        with self.lock:
+            for wlc_ip in self.idle_sessions:
+                evicted_sessions += [device for device, last_used in self.idle_sessions[wlc_ip] if monotonic() - last_used >= idle_timeout]
+                self.idle_sessions[wlc_ip] = [(device, last_used) for device, last_used in self.idle_sessions[wlc_ip] if monotonic() - last_used < idle_timeout]
+        for device in evicted_sessions:
+            self.disconnect(device)
+
+
+    def close(self):
+        self.evict_idle(0)
+
+
+def run_commands_on_session(device, wlc_name, wlc_ip, command_list, batch_size=1, reconcile=False, delete_syntax='auto', save_config=True, command_callback=None, netusers=None):
+    #Runs the job commands and save config on a connected WLC session and returns the creation outcome
+    #command_callback(wlc_ip, command_result) is called after every command and after save config
+    #netusers (wlc_netusers) carries the guest users of the WLC over from an earlier command list of the run
+    creation_outcome = 'success'
+    
+    if reconcile:
+        #Only delete users the WLC actually has, using the one delete syntax it supports
+        if netusers is None:
+            netusers = wlc_netusers()
+        existing_users = netusers.read(device, wlc_ip)
+        if delete_syntax == 'auto' and netusers.delete_syntax is None and any(command.split()[-1] in existing_users for command in command_list if command.startswith('config netuser delete ')):
+            netusers.delete_syntax = detect_netuser_delete_syntax(device, wlc_ip)
+        if delete_syntax == 'auto':
+            delete_syntax = netusers.delete_syntax or 'auto'
+        planned_command_count = len(command_list)
+        if command_callback:
+            #users the WLC does not have are reported as absent, their delete commands are not sent
+            for user in sorted(set(command.split()[-1] for command in command_list if command.startswith('config netuser delete ')) - existing_users):
+                command_callback(wlc_ip, command_result('delete', 'absent', user))
+        command_list = reconcile_command_list(command_list, existing_users, delete_syntax)
+        if len(command_list) != planned_command_count:
+            log.info('Reconciliation: %s of %s commands needed' % (len(command_list), planned_command_count))
+    
+    if batch_size > 1:
+        prompt = device.find_prompt()
+        command_batches = [command_list[i:i+batch_size] for i in range(0, len(command_list), batch_size)]
+    else:
+        command_batches = [[command] for command in command_list]
+    
+    for command_batch in command_batches:
+        command_start = monotonic()
+        if batch_size > 1:
+            command_batch_results = send_command_batch(device, command_batch, prompt, controller_timing.batch_timeout(wlc_ip, len(command_batch)), controller_timing.poll_interval(wlc_ip))
+        else:
+            command_batch_results = [timed_send_command(device, wlc_ip, command_batch[0])]
+        #commands streamed in a batch share its latency evenly
+        command_seconds = (monotonic() - command_start) / len(command_batch)
+        if batch_size > 1: controller_timing.observe(wlc_ip, 'batch', command_seconds)
         
-        #Allow multiple admin e-mails separated by semicolumn ;
-        admin_email_receiver_name = admin_email_receiver_name.split(';')
-        admin_email_receiver_address = admin_email_receiver_address.split(';')
-        fmt_admin_email_receiver_address = fmt_multiple_email_addresses(admin_email_receiver_address)
+        for command, command_output in zip(command_batch, command_batch_results):
+            cli_result = classify_command_output(command, command_output)
+            metrics.observe('wlc_command_seconds', command_seconds, controller=wlc_ip, command_type=cli_result.command_type)
+            metrics.increment('wlc_commands', controller=wlc_ip, command_type=cli_result.command_type, kind=cli_result.kind)
+            if command_callback:
+                command_callback(wlc_ip, cli_result)
+            if reconcile: netusers.update(cli_result)
+            #a WLC succeeds when every user add is accepted, a failed delete shows up in the add that follows it
+            if cli_result.command_type == 'add' and cli_result.kind != 'added':
+                creation_outcome = cli_failure_msg
+            log.info(mask_netuser_password(command))
+            if command_output.strip() == '':
+                command_output = '\nNo Output\n\n'
+            else:
+                command_output = mask_netuser_password(command_output)
+            log.info('Command Output (' + cli_result.kind + '):\n' + ('-' * 100) + '\n' + command_output + '' + ('-' * 100) + '\n')
+    
+    #in streaming mode only the last chunk saves, unless a chunk fails and the job stops there
+    if save_config or creation_outcome != 'success':
+        save_config_on_session(device, wlc_ip, [command_callback])
+    return creation_outcome
+
+
+def save_config_on_session(device, wlc_ip, command_callbacks=[]):
+    log.info('save config')
+    with metrics.timer('wlc_save_config_seconds', controller=wlc_ip):
+        output = timed_send_command(device, wlc_ip, 'save config\ny', 'save_config')
+    log.info(output)
+    for command_callback in command_callbacks:
+        if command_callback:
+            command_callback(wlc_ip, command_result('save', 'saved', ''))
+
+
+def issue_commands_on_device(platform, wlc_name, wlc_ip, username, password, command_list, batch_size=1, reconcile=False, delete_syntax='auto', ssh_pool=None, save_config=True, ssh_port=22, command_callback=None, netusers=None):
+    return run_on_device(platform, wlc_name, wlc_ip, username, password, lambda device: run_commands_on_session(device, wlc_name, wlc_ip, command_list, batch_size, reconcile, delete_syntax, save_config, command_callback, netusers), ssh_pool, ssh_port)
+
+
+def run_on_device(platform, wlc_name, wlc_ip, username, password, session_task, ssh_pool=None, ssh_port=22):
+    #Connects to the WLC (or takes a pooled session) and returns session_task(device), or the error message of a failed session
+    #netmiko is only loaded once a job actually needs to connect to a WLC
+    from netmiko import (
+        ConnectHandler, NetMikoTimeoutException, NetMikoAuthenticationException, ReadTimeout)
+    
+    try:
+        if ssh_pool:
+            device = ssh_pool.acquire(platform, wlc_ip, username, password, ssh_port)
+        else:
+            with metrics.timer('ssh_connect_seconds', controller=wlc_ip):
+                device = ConnectHandler(device_type=platform, ip=wlc_ip, port=ssh_port, username=username, password=password, global_delay_factor=controller_timing.delay_factor(wlc_ip))
+            metrics.increment('ssh_sessions', controller=wlc_ip, session='new')
+        log.info('SSH Connected!\nExecuting the following commands via ssh on "' + wlc_name + ' - '  + wlc_ip + '":\n' + '-' * 100)
         
-        #add full path to files
-        log_full_path_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),log_file_name)
-        full_path_csv_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),csv_file)
-    except:
-        print('Error: it is not possible to read config from file: ' + config_file)
-        sys.exit(0)
-    users_email_qty_sent = 0
-    email_admin_report = ''
-    admin_email_msg = ''
-    csv_exception_occurred = False
-    id_list_pass = []
+        try:
+            if controller_timing.enabled(): measure_prompt_round_trip(device, wlc_ip)
+            creation_outcome = session_task(device)
+        except:
+            #a session that failed half way is never handed out again
+            if ssh_pool: ssh_pool.release(wlc_ip, device, False)
+            raise
+        finally:
+            controller_timing.save()
+        
+        if ssh_pool:
+            ssh_pool.release(wlc_ip, device)
+        else:
+            with metrics.timer('ssh_disconnect_seconds', controller=wlc_ip):
+                device.disconnect()
+        return creation_outcome
+
+    except NetMikoTimeoutException:
+        metrics.increment('ssh_failures', controller=wlc_ip, reason='timeout')
+        err_msg = 'SSH connection timeout for %s (%s)' % (wlc_name, wlc_ip)
+        log.error(err_msg)
+        return err_msg
+    except NetMikoAuthenticationException:
+        metrics.increment('ssh_failures', controller=wlc_ip, reason='authentication')
+        err_msg = 'SSH authentication failure for %s (%s)' % (wlc_name, wlc_ip)
+        log.error(err_msg)
+        return err_msg
+    except ReadTimeout:
+        metrics.increment('ssh_failures', controller=wlc_ip, reason='read_timeout')
+        err_msg = 'WLC reply timeout for %s (%s), the read timeout of its latency profile is raised for the next run' % (wlc_name, wlc_ip) if controller_timing.enabled() else 'WLC reply timeout for %s (%s)' % (wlc_name, wlc_ip)
+        log.error(err_msg)
+        return err_msg
+    except IOError:
+        metrics.increment('ssh_failures', controller=wlc_ip, reason='session_ended')
+        err_msg = 'SSH session ended unexpectedly for %s (%s)' % (wlc_name, wlc_ip)
+        log.error(err_msg)
+        return err_msg
+    except Exception:
+        metrics.increment('ssh_failures', controller=wlc_ip, reason='other')
+        if wlc_ip == '':
+            wlc_ip ='WLC IP Missing'
+        err_msg = 'Unspecified exception for %s (%s).<br>Possible reasons: missing wlc ip, wrong password, or something else entirely' % (wlc_name, wlc_ip)
+        log.error(err_msg)
+        return err_msg
+
+
+def issue_commands_on_devices(platform, wlc_name, wlc_ip, username, password, command_list, job_id, max_parallel_controllers, batch_size=1, reconcile=False, delete_syntax='auto', ssh_pool=None, save_config=True, ssh_port=22, command_callback=None, transport=None, netuser_tables=None):
+    #Runs the job on every WLC listed in it, up to max_parallel_controllers at a time
+    #Results are returned in the same order as wlc_ip so they line up with wlc_name
+    #command_list can also be a dict with the commands of each WLC IP, a WLC with None has nothing left to do
+    #transport (see wlc_transports) replaces the netmiko CLI
+    #netuser_tables is a dict of the wlc_netusers of each WLC IP, shared by the calls of a run so each WLC table is read once
+    def issue_commands_on_wlc(i):
+        log_job_id.set(job_id)
+        log_controller.set(wlc_ip[i])
+        wlc_command_list = command_list[wlc_ip[i]] if isinstance(command_list, dict) else command_list
+        if wlc_command_list is None:
+            log.info('Nothing left to do on %s (%s) - Running job id: %s' % (wlc_name[i], wlc_ip[i], job_id))
+            return 'success'
+        if transport and transport.name != 'cli':
+            log.info('Attempting to reach %s (%s) over %s - Running job id: %s' % (wlc_name[i], wlc_ip[i], transport.name, job_id))
+            return transport.issue_commands(wlc_name[i], wlc_ip[i], wlc_command_list, ssh_pool, save_config, command_callback)
+        log.info('Attempting to SSH to %s (%s) - Running job id: %s' % (wlc_name[i], wlc_ip[i], job_id))
+        netusers = netuser_tables.setdefault(wlc_ip[i], wlc_netusers()) if netuser_tables is not None else None
+        return issue_commands_on_device(platform, wlc_name[i], wlc_ip[i], username, password, wlc_command_list, batch_size, reconcile, delete_syntax, ssh_pool, save_config, ssh_port, command_callback, netusers)
+
+    #each WLC runs in its own copy of the log context so its controller id does not leak into the job
+    if max_parallel_controllers <= 1 or len(wlc_ip) == 1:
+        return [contextvars.copy_context().run(issue_commands_on_wlc, i) for i in range(len(wlc_ip))]
+    
+    with ThreadPoolExecutor(max_workers=min(max_parallel_controllers, len(wlc_ip))) as executor:
+        wlc_futures = [executor.submit(contextvars.copy_context().run, issue_commands_on_wlc, i) for i in range(len(wlc_ip))]
+        return [wlc_future.result() for wlc_future in wlc_futures]
+
+
+def issue_job_commands_on_device(settings, wlc_name, wlc_ip, job_commands, ssh_pool=None):
+    #Runs the commands of several jobs on one WLC in a single session ending with a single save config
+    #job_commands is a list of (job_id, command_list, command_callback), the outcome of each job is returned in the same order
+    def run_job_commands(device):
+        job_outcomes = []
+        #the jobs of the session share one read of the WLC table
+        netusers = wlc_netusers()
+        for job_id, command_list, command_callback in job_commands:
+            log_job_id.set(job_id)
+            log.info('Job id %s: %s commands' % (job_id, len(command_list)))
+            job_outcomes.append(run_commands_on_session(device, wlc_name, wlc_ip, command_list, settings['command_batch_size'], settings['reconcile_netusers'], settings['netuser_delete_syntax'], False, command_callback, netusers))
+        log_job_id.set('')
+        save_config_on_session(device, wlc_ip, [command_callback for job_id, command_list, command_callback in job_commands])
+        return job_outcomes
+    
+    outcome = run_on_device(settings['platform'], wlc_name, wlc_ip, settings['username'], settings['password'], run_job_commands, ssh_pool, settings['ssh_port'])
+    #a failed session fails every job of the WLC, nothing was saved
+    return outcome if type(outcome) == list else [outcome] * len(job_commands)
+
+
+def issue_commands_by_controller(settings, jobs, ssh_pool=None):
+    #Groups the WLC commands of the guest_jobs by controller IP, each WLC gets the commands of all its jobs
+    #in one session with one save config, up to max_parallel_controllers WLCs at a time
+    #Returns the WLC results of each job, in the order of the jobs and of their WLC lists
+    #jobs reaching the same WLC with different transports are run separately
+    controllers = {}
+    wlc_creation_results = []
+    for job_number, job in enumerate(jobs):
+        wlc_command_lists = job.wlc_command_lists()
+        wlc_creation_results.append([None] * len(job.wlc_ip))
+        for i in range(len(job.wlc_ip)):
+            command_list = wlc_command_lists[job.wlc_ip[i]] if isinstance(wlc_command_lists, dict) else wlc_command_lists
+            controllers.setdefault((job.transport.name, job.wlc_ip[i]), [job.wlc_name[i], job.transport, []])[2].append((job_number, i, command_list))
+    
+    def issue_commands_on_controller(controller):
+        wlc_ip = controller[1]
+        log_controller.set(wlc_ip)
+        wlc_name, transport, controller_jobs = controllers[controller]
+        pending_jobs = []
+        for job_number, i, command_list in controller_jobs:
+            if command_list is None:
+                log.info('Nothing left to do on %s (%s) - Running job id: %s' % (wlc_name, wlc_ip, jobs[job_number].id))
+                wlc_creation_results[job_number][i] = 'success'
+            else:
+                pending_jobs.append((job_number, i, command_list))
+        if not pending_jobs:
+            return
+        log.info('Attempting to reach %s (%s) over %s - Running job ids: %s' % (wlc_name, wlc_ip, transport.name, ', '.join(jobs[job_number].id for job_number, i, command_list in pending_jobs)))
+        job_outcomes = transport.issue_job_commands(wlc_name, wlc_ip, [(jobs[job_number].id, command_list, jobs[job_number].command_callback()) for job_number, i, command_list in pending_jobs], ssh_pool)
+        for (job_number, i, command_list), job_outcome in zip(pending_jobs, job_outcomes):
+            wlc_creation_results[job_number][i] = job_outcome
+    
+    #each WLC runs in its own copy of the log context
+    if settings['max_parallel_controllers'] <= 1 or len(controllers) == 1:
+        for controller in controllers:
+            contextvars.copy_context().run(issue_commands_on_controller, controller)
+    else:
+        with ThreadPoolExecutor(max_workers=min(settings['max_parallel_controllers'], len(controllers))) as executor:
+            for wlc_future in [executor.submit(contextvars.copy_context().run, issue_commands_on_controller, controller) for controller in controllers]:
+                wlc_future.result()
+    return wlc_creation_results
+
+
+class cli_transport(object):
+    """Line by line netuser CLI commands over SSH with netmiko, the default transport
+    """
+    name = 'cli'
+    
+    def __init__(self, settings):
+        self.settings = settings
+    
+    
+    def issue_commands(self, wlc_name, wlc_ip, command_list, ssh_pool=None, save_config=True, command_callback=None):
+        settings = self.settings
+        return issue_commands_on_device(settings['platform'], wlc_name, wlc_ip, settings['username'], settings['password'], command_list, settings['command_batch_size'], settings['reconcile_netusers'], settings['netuser_delete_syntax'], ssh_pool, save_config, settings['ssh_port'], command_callback)
+    
+    
+    def issue_job_commands(self, wlc_name, wlc_ip, job_commands, ssh_pool=None):
+        return issue_job_commands_on_device(self.settings, wlc_name, wlc_ip, job_commands, ssh_pool)
+
+
+netuser_add_re = re.compile(r'^config netuser add (\S+) (\S+) wlan (\d+) userType (\S+) lifetime (\d+) description "(.*)"$')
+restconf_failure_msg = 'WLC RESTCONF provisioning failure, check script log file for the request logs'
+
+
+class restconf_transport(object):
+    """Bulk provisioning over RESTCONF
+    
+    The netuser commands of a job are turned into YANG Patch (RFC 8072) edits on the netuser list of
+    RestconfDataPath, a remove and a create per user, and sent RestconfBatchSize users per request on one
+    HTTP connection, followed by the RestconfSavePath operation. A patch is applied by the WLC as a whole:
+    when one edit is rejected none of the users of that request are created.
+    """
+    name = 'restconf'
+    
+    def __init__(self, settings):
+        self.settings = settings
+    
+    
+    def connect(self, wlc_ip):
+        import http.client
+        import ssl
+        settings = self.settings
+        if settings['restconf_scheme'] == 'http':
+            return http.client.HTTPConnection(wlc_ip, settings['restconf_port'], timeout=settings['restconf_timeout'])
+        context = ssl.create_default_context()
+        if not settings['restconf_verify_tls']:
+            #WLCs usually present a self-signed certificate
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return http.client.HTTPSConnection(wlc_ip, settings['restconf_port'], timeout=settings['restconf_timeout'], context=context)
+    
+    
+    def request(self, connection, method, path, body=None, content_type='application/yang-data+json'):
+        #Returns the HTTP status and the decoded JSON reply (None when empty)
+        from base64 import b64encode
+        credentials = b64encode((self.settings['username'] + ':' + self.settings['password']).encode()).decode()
+        headers = {'Authorization': 'Basic ' + credentials, 'Accept': 'application/yang-data+json'}
+        if body is not None:
+            headers['Content-Type'] = content_type
+            body = json.dumps(body)
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        reply = response.read()
+        try:
+            reply = json.loads(reply.decode()) if reply.strip() else None
+        except ValueError:
+            reply = {'text': reply.decode(errors='replace')}
+        return response.status, reply
+    
+    
+    def user_edits(self, command_list):
+        #Returns [(user, edits)] in command order, the two delete syntaxes of a user become one remove edit
+        #remove does not fail for a user the WLC does not have
+        user_edits = {}
+        for command in command_list:
+            if command.startswith('config netuser delete '):
+                user = command.rsplit(' ', 1)[-1]
+                edits = user_edits.setdefault(user, [])
+                if not any(edit['operation'] == 'remove' for edit in edits):
+                    edits.append({'edit-id': 'remove-' + user, 'operation': 'remove', 'target': '/netuser=' + quote(user, safe='')})
+            elif command.startswith('config netuser add '):
+                add_match = netuser_add_re.match(command)
+                if add_match is None:
+                    raise ValueError('netuser command not supported by the RESTCONF transport: ' + mask_netuser_password(command))
+                user, password, wlan_id, user_type, lifetime, description = add_match.groups()
+                user_edits.setdefault(user, []).append({'edit-id': 'create-' + user, 'operation': 'create', 'target': '/netuser=' + quote(user, safe=''),
+                    'value': {'netuser': [{'name': user, 'password': password, 'wlan-id': int(wlan_id), 'user-type': user_type, 'lifetime': int(lifetime), 'description': description}]}})
+        return list(user_edits.items())
+    
+    
+    def patch_errors(self, reply):
+        #Returns the error messages of a rejected YANG Patch, global and per edit
+        reply = reply or {}
+        patch_status = reply.get('ietf-yang-patch:yang-patch-status', {})
+        errors = list(patch_status.get('errors', {}).get('error', [])) + list(reply.get('ietf-restconf:errors', {}).get('error', []))
+        for edit_status in patch_status.get('edit-status', {}).get('edit', []):
+            errors += [dict(error, **{'edit-id': edit_status.get('edit-id', '')}) for error in edit_status.get('errors', {}).get('error', [])]
+        return ['%s%s (%s)' % (error['edit-id'] + ': ' if error.get('edit-id') else '', error.get('error-message', ''), error.get('error-tag', '')) for error in errors] or [reply.get('text', str(reply))]
+    
+    
+    def issue_commands(self, wlc_name, wlc_ip, command_list, ssh_pool=None, save_config=True, command_callback=None):
+        return self.issue_job_commands(wlc_name, wlc_ip, [(None, command_list, command_callback)], ssh_pool, save_config)[0]
+    
+    
+    def issue_job_commands(self, wlc_name, wlc_ip, job_commands, ssh_pool=None, save_config=True):
+        #job_commands is a list of (job_id, command_list, command_callback), the outcome of each job is returned in the same order
+        #the WLC is saved once at the end, ssh_pool is not used
+        import http.client
+        settings = self.settings
+        job_outcomes = ['success'] * len(job_commands)
+        current_job_id = log_job_id.get()
+        connection = self.connect(wlc_ip)
+        try:
+            log.info('RESTCONF connection to "' + wlc_name + ' - ' + wlc_ip + '", sending users in batches of %s:\n' % settings['restconf_batch_size'] + '-' * 100)
+            for job_number, (job_id, command_list, command_callback) in enumerate(job_commands):
+                if job_id: log_job_id.set(job_id)
+                user_edits = self.user_edits(command_list)
+                for i in range(0, len(user_edits), settings['restconf_batch_size']):
+                    batch_user_edits = user_edits[i:i+settings['restconf_batch_size']]
+                    edits = [edit for user, edit_list in batch_user_edits for edit in edit_list]
+                    yang_patch = {'ietf-yang-patch:yang-patch': {'patch-id': uuid.uuid4().hex[:12], 'edit': edits}}
+                    request_start = monotonic()
+                    status, reply = self.request(connection, 'PATCH', settings['restconf_data_path'], yang_patch, 'application/yang-patch+json')
+                    request_seconds = monotonic() - request_start
+                    metrics.observe('restconf_request_seconds', request_seconds, controller=wlc_ip)
+                    if status in (401, 403):
+                        metrics.increment('restconf_failures', controller=wlc_ip, reason='authentication')
+                        err_msg = 'RESTCONF authentication failure for %s (%s)' % (wlc_name, wlc_ip)
+                        log.error(err_msg)
+                        return [err_msg] * len(job_commands)
+                    
+                    patch_accepted = 200 <= status < 300
+                    for user, edit_list in batch_user_edits:
+                        for edit in edit_list:
+                            command_type = 'delete' if edit['operation'] == 'remove' else 'add'
+                            cli_result = command_result(command_type, ('deleted' if command_type == 'delete' else 'added') if patch_accepted else 'rejected', user)
+                            #the edits of a request share its latency evenly
+                            metrics.observe('wlc_command_seconds', request_seconds / len(edits), controller=wlc_ip, command_type=command_type)
+                            metrics.increment('wlc_commands', controller=wlc_ip, command_type=command_type, kind=cli_result.kind)
+                            if command_callback:
+                                command_callback(wlc_ip, cli_result)
+                    log.info('YANG Patch %s: %s users, %s edits - HTTP %s' % (yang_patch['ietf-yang-patch:yang-patch']['patch-id'], len(batch_user_edits), len(edits), status))
+                    if not patch_accepted:
+                        log.error('Error: the WLC rejected the YANG Patch: ' + '; '.join(self.patch_errors(reply)))
+                        job_outcomes[job_number] = restconf_failure_msg
+            log_job_id.set(current_job_id)
+            
+            if save_config or job_outcomes.count('success') != len(job_outcomes):
+                log.info('save config')
+                with metrics.timer('wlc_save_config_seconds', controller=wlc_ip):
+                    status, reply = self.request(connection, 'POST', settings['restconf_save_path'])
+                log.info('save config - HTTP %s' % status)
+                if 200 <= status < 300:
+                    for job_id, command_list, command_callback in job_commands:
+                        if command_callback:
+                            command_callback(wlc_ip, command_result('save', 'saved', ''))
+                else:
+                    log.error('Error: save config failed on the WLC: ' + '; '.join(self.patch_errors(reply)))
+                    job_outcomes = ['RESTCONF save config failure for %s (%s)' % (wlc_name, wlc_ip)] * len(job_commands)
+            return job_outcomes
+        
+        except ValueError as e:
+            log_job_id.set(current_job_id)
+            log.error('Error: ' + str(e))
+            return [str(e)] * len(job_commands)
+        except (OSError, http.client.HTTPException) as e:
+            log_job_id.set(current_job_id)
+            metrics.increment('restconf_failures', controller=wlc_ip, reason='connection')
+            err_msg = 'RESTCONF connection failure for %s (%s): %s' % (wlc_name, wlc_ip, html.escape(str(e) or type(e).__name__))
+            log.error(err_msg)
+            return [err_msg] * len(job_commands)
+        finally:
+            connection.close()
+
+
+#values of the transport column of job_data.csv and of DefaultTransport
+wlc_transports = {'cli': cli_transport, 'restconf': restconf_transport}
+
+
+def stream_job_to_devices(settings, selected_data, wlc_name, wlc_ip, ssh_pool, send_chunk_mail, journal=None, transport=None, command_callback=None, ledger=None):
+    #Streaming mode for large jobs: each chunk of users is created on all the WLCs of the job
+    #and its credentials are handed to send_chunk_mail straight away, the job stops at the first failed chunk
+    #Returns the WLC results of the last chunk run and the number of users created and e-mailed
+    #command_callback defaults to the journal, the ledger is written after every chunk
+    #the netuser table of each WLC is read by the first chunk only, the later ones reconcile against it
+    if command_callback is None and journal:
+        command_callback = journal.record_command
+    chunk_size = settings['stream_chunk_size']
+    chunk_count = (int(selected_data[4]) + chunk_size - 1) // chunk_size
+    job_ssh_pool = ssh_pool or ssh_session_pool(1, settings['ssh_session_idle_timeout'], settings['ssh_keepalive'])
+    users_created = 0
+    netuser_tables = {}
+    issued_credentials = journal.credentials if journal else None
+    for chunk_number, (user_credentials, command_list) in enumerate(iter_user_chunks(selected_data, chunk_size, issued_credentials)):
+        log.info('Job id %s - chunk %s of %s (%s users)' % (selected_data[0], chunk_number + 1, chunk_count, len(user_credentials)))
+        if journal:
+            journal.record_issued(user_credentials)
+            command_list = journal.pending_commands(selected_data, user_credentials, wlc_ip, chunk_number == chunk_count - 1)
+        if ledger and settings['ledger_known_deletes_only']:
+            command_list = ledger.known_deletes_only(command_list, wlc_ip)
+        wlc_creation_results = issue_commands_on_devices(settings['platform'], wlc_name, wlc_ip, settings['username'], settings['password'], command_list, selected_data[0], settings['max_parallel_controllers'], settings['command_batch_size'], settings['reconcile_netusers'], settings['netuser_delete_syntax'], job_ssh_pool, chunk_number == chunk_count - 1, settings['ssh_port'], command_callback, transport, netuser_tables)
+        if ledger: ledger.flush()
+        if wlc_creation_results.count('success') != len(wlc_ip):
+            break
+        if journal:
+            unmailed_credentials = journal.unmailed(user_credentials)
+            if unmailed_credentials:
+                send_chunk_mail(unmailed_credentials)
+                journal.record_mailed(unmailed_credentials)
+        else:
+            send_chunk_mail(user_credentials)
+        users_created += len(user_credentials)
+    if job_ssh_pool is not ssh_pool:
+        job_ssh_pool.close()
+    return wlc_creation_results, users_created
+
+
+def send_guest_user_mail(user_credentials, ssid, user_type, localized_date_start, localized_date_end, email_server, guest_email_sender_name, guest_email_sender_address, guest_email_receiver_address, smtp_pool=None, outbox=None, delivery_mode='individual'):
+    guest_email_receiver_name = guest_email_receiver_address
+    guest_email_subject = "Wireless Guest User Credentials"
+    #Returns False when an e-mail could not be sent (e-mails put in the outbox count as sent)
+    
+    if delivery_mode in ('digest', 'attachment'):
+        return send_guest_user_digest_mail(user_credentials, ssid, localized_date_start, localized_date_end, email_server, guest_email_sender_name, guest_email_sender_address, guest_email_receiver_address, smtp_pool, outbox, delivery_mode)
+    
+    all_sent = True
+    i = 0
+    for user_credential in user_credentials:
+        user, password = user_credential
+        guest_email_msg = ('Wireless Guest User Credentials<br>'
+            '-------------------------------<br>'
+            'Guest account User Name : %s<br>'
+            'Guest account Password : %s<br>'
+            'Profile name : %s<br>'
+            'User Active from : %s<br>'
+            'User Active until : %s<br><br>'
+            'DISCLAIMER : Guests understand and acknowledge that we exercise no control over the nature, content or reliability of the information and/or data passing through our network.<br><br>'
+            'Regards,<br><br>'
+            'Network Team'
+        ) % (user, password, ssid, localized_date_start, localized_date_end)
+        #print(guest_email_msg)
+        email = email_SMTP(email_server, guest_email_sender_name, guest_email_sender_address, guest_email_receiver_name, guest_email_receiver_address, guest_email_subject, guest_email_msg, smtp_pool)
+        if outbox:
+            #delivered in the background by the outbox workers
+            outbox.enqueue(guest_email_sender_address, guest_email_receiver_address, email.build())
+        elif not email.send():
+            all_sent = False
+        i += 1
+    return all_sent
+
+
+def send_guest_user_digest_mail(user_credentials, ssid, localized_date_start, localized_date_end, email_server, guest_email_sender_name, guest_email_sender_address, guest_email_receiver_address, smtp_pool=None, outbox=None, delivery_mode='digest'):
+    #One e-mail with all the credentials of the job: as a table in the e-mail (digest)
+    #or as a csv file plus printable vouchers attached to it (attachment)
+    guest_email_receiver_name = guest_email_receiver_address
+    guest_email_subject = "Wireless Guest User Credentials (%s users)" % len(user_credentials)
+    guest_email_msg = ('Wireless Guest User Credentials<br>'
+        '-------------------------------<br>'
+        'Profile name : %s<br>'
+        'Users Active from : %s<br>'
+        'Users Active until : %s<br>'
+        'Number of users : %s<br><br>'
+    ) % (html.escape(ssid), localized_date_start, localized_date_end, len(user_credentials))
+    attachments = []
+    if delivery_mode == 'digest':
+        #kept on a single line, the e-mail body is rendered with white-space: pre
+        guest_email_msg += '<table style="border-collapse: collapse;"><tr><th style="border: 1px solid #999; padding: 2px 8px;">User Name</th><th style="border: 1px solid #999; padding: 2px 8px;">Password</th></tr>'
+        for user, password in user_credentials:
+            guest_email_msg += '<tr><td style="border: 1px solid #999; padding: 2px 8px;">%s</td><td style="border: 1px solid #999; padding: 2px 8px; font-family: monospace;">%s</td></tr>' % (user, password)
+        guest_email_msg += '</table><br>'
+    else:
+        guest_email_msg += 'The user names and passwords are attached as a csv file (guest_users.csv) and as printable vouchers (guest_vouchers.html).<br><br>'
+        credentials_csv = io.StringIO()
+        csv_writer = csv.writer(credentials_csv)
+        csv_writer.writerow(['user', 'password', 'ssid', 'active_from', 'active_until'])
+        for user, password in user_credentials:
+            csv_writer.writerow([user, password, ssid, localized_date_start, localized_date_end])
+        vouchers = ('<html><head><style>'
+            '.voucher { display: inline-block; width: 30%; margin: 1%; padding: 10px; border: 1px dashed #666; font-family: Arial,sans-serif; page-break-inside: avoid; }'
+            '.credential { font-family: monospace; font-size: 16px; }'
+            '</style></head><body>\n')
+        for user, password in user_credentials:
+            vouchers += ('<div class="voucher"><b>Wireless Guest Access</b><br>'
+                'Network: %s<br>'
+                'User Name: <span class="credential">%s</span><br>'
+                'Password: <span class="credential">%s</span><br>'
+                'Valid until: %s</div>\n'
+            ) % (html.escape(ssid), user, password, localized_date_end)
+        vouchers += '</body></html>\n'
+        attachments = [('guest_users.csv', 'csv', credentials_csv.getvalue()), ('guest_vouchers.html', 'html', vouchers)]
+    guest_email_msg += ('DISCLAIMER : Guests understand and acknowledge that we exercise no control over the nature, content or reliability of the information and/or data passing through our network.<br><br>'
+        'Regards,<br><br>'
+        'Network Team'
+    )
+    email = email_SMTP(email_server, guest_email_sender_name, guest_email_sender_address, guest_email_receiver_name, guest_email_receiver_address, guest_email_subject, guest_email_msg, smtp_pool, attachments)
+    if outbox:
+        outbox.enqueue(guest_email_sender_address, guest_email_receiver_address, email.build())
+        return True
+    return email.send()
+
+
+def send_generic_mail(email_server, admin_email_sender_name, admin_email_sender_address, admin_email_receiver_name, admin_email_receiver_address, admin_email_subject, admin_email_msg, smtp_pool=None):
+    email = email_SMTP(email_server, admin_email_sender_name, admin_email_sender_address, admin_email_receiver_name, admin_email_receiver_address, admin_email_subject, admin_email_msg, smtp_pool)
+    result = email.send()
+    return result
+
+
+def test_email_server(email_server, smtp_pool=None, timeout=None):
+    email = email_SMTP(email_server, pool=smtp_pool)
+    result = email.test(timeout)
+    return result
+
+
+class preflight_cache(object):
+    """Pre-flight checks passed recently, kept in PreflightCacheFile for PreflightCacheTtl seconds
+    
+    Back to back runs skip the checks that passed, failed checks are not cached and run again every time.
+    """
+    def __init__(self, cache_file, ttl):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        try:
+            with open(cache_file) as f:
+                self.passed = json.load(f)
+        except (IOError, ValueError):
+            self.passed = {}
+    
+    
+    def fresh(self, check):
+        with self.lock:
+            return time() - self.passed.get(check, 0) < self.ttl
+    
+    
+    def record(self, check):
+        with self.lock:
+            self.passed[check] = time()
+    
+    
+    def save(self):
+        with self.lock:
+            passed = dict((check, checked) for check, checked in self.passed.items() if time() - checked < self.ttl)
+        try:
+            with open(self.cache_file + '.%s.tmp' % os.getpid(), 'w') as f:
+                json.dump(passed, f, indent=1, sort_keys=True)
+            os.replace(self.cache_file + '.%s.tmp' % os.getpid(), self.cache_file)
+        except (IOError, OSError) as e:
+            log.error('Error: the pre-flight cache file could not be written (' + str(e) + ')')
+
+
+def ssh_login_timeouts(timeout):
+    #netmiko arguments bounding each step of a login by timeout seconds, the netmiko defaults without one
+    if not timeout:
+        return {}
+    return dict(conn_timeout=timeout, banner_timeout=timeout, auth_timeout=timeout, read_timeout_override=timeout)
+
+
+def close_ssh_session(device):
+    try:
+        device.disconnect()
+    except Exception:
+        pass
+
+
+def check_controller_login(settings, wlc_name, wlc_ip, timeout, ssh_pool=None):
+    #Logs in to the WLC like a job would, returns None or the reason the login failed, and the session the caller has to close
+    #a pooled session is handed back to the pool so the job reuses it
+    from netmiko import ConnectHandler, NetMikoAuthenticationException, NetMikoTimeoutException
+    device = None
+    try:
+        if ssh_pool:
+            ssh_pool.release(wlc_ip, ssh_pool.acquire(settings['platform'], wlc_ip, settings['username'], settings['password'], settings['ssh_port'], timeout))
+        else:
+            device = ConnectHandler(device_type=settings['platform'], ip=wlc_ip, port=settings['ssh_port'], username=settings['username'], password=settings['password'],
+                global_delay_factor=controller_timing.delay_factor(wlc_ip), **ssh_login_timeouts(timeout))
+    except NetMikoAuthenticationException:
+        return 'SSH authentication failure for %s (%s)' % (wlc_name, wlc_ip), None
+    except NetMikoTimeoutException:
+        return 'SSH connection timeout for %s (%s)' % (wlc_name, wlc_ip), None
+    except Exception as e:
+        return 'SSH login to %s (%s) failed: %s' % (wlc_name, wlc_ip, html.escape(str(e).strip().split('\n')[0] or type(e).__name__)), None
+    return None, device
+
+
+def run_preflight_checks(settings, job_ids, smtp_pool, ssh_pool=None):
+    #Checks the SMTP server and every WLC of the job ids (TCP port, then SSH login for the cli transport) in parallel, all within PreflightTimeout seconds
+    #Returns whether the SMTP server answered and {(transport, wlc_ip): reason} for the WLCs that failed their check
+    preflight_start = monotonic()
+    deadline = preflight_start + settings['preflight_timeout']
+    cache = preflight_cache(settings['full_path_preflight_cache_file'], settings['preflight_cache_ttl'])
+    
+    controllers = {}
+    try:
+        job_index, duplicate_job_ids = load_job_data(settings['full_path_csv_file'], settings['csv_rows_skip'])
+    except Exception:
+        #run_jobs() reports a job data file that cannot be loaded
+        job_index = {}
+    for job_id in job_ids:
+        job_row = job_index.get(job_id)
+        if job_row is None or len(job_row[1].split(';')) != len(job_row[2].split(';')):
+            continue
+        transport_name = (job_row[13] if len(job_row) > 13 else '') or settings['default_transport']
+        for wlc_ip, wlc_name in zip(job_row[1].split(';'), job_row[2].split(';')):
+            controllers.setdefault((transport_name, wlc_ip), wlc_name)
+    
+    def time_left():
+        #every connect, login and SMTP call only gets what is left of the overall budget
+        return deadline - monotonic()
+    
+    def timeout_reason(wlc_name, wlc_ip):
+        return 'Pre-flight check of %s (%s) did not complete within %s s' % (wlc_name, wlc_ip, settings['preflight_timeout'])
+    
+    def check_smtp():
+        check = 'smtp ' + settings['email_server']
+        if cache.fresh(check):
+            metrics.increment('preflight_checks', check='smtp', result='cached')
+            return True
+        smtp_ok = test_email_server(settings['email_server'], smtp_pool, max(time_left(), 0.1))
+        metrics.increment('preflight_checks', check='smtp', result='ok' if smtp_ok else 'failed')
+        if smtp_ok: cache.record(check)
+        return smtp_ok
+    
+    def check_controller(transport_name, wlc_ip, wlc_name):
+        log_controller.set(wlc_ip)
+        port = settings['restconf_port'] if transport_name == 'restconf' else settings['ssh_port']
+        check = '%s %s:%s %s' % (transport_name, wlc_ip, port, settings['username'])
+        if cache.fresh(check):
+            metrics.increment('preflight_checks', check=transport_name, result='cached')
+            return None
+        if time_left() <= 0:
+            #queued behind other checks until the budget ran out
+            return timeout_reason(wlc_name, wlc_ip)
+        try:
+            socket.create_connection((wlc_ip, port), timeout=max(time_left(), 0.1)).close()
+            reason = None
+        except (OSError, ValueError) as e:
+            reason = 'TCP port %s of %s (%s) is unreachable: %s' % (port, wlc_name, wlc_ip, html.escape(str(e) or type(e).__name__))
+        #the SSH login only runs once the port answered
+        #RESTCONF credentials are checked by the first request of the job
+        if reason is None and transport_name == 'cli' and settings['preflight_ssh_login']:
+            if time_left() <= 0:
+                reason = timeout_reason(wlc_name, wlc_ip)
+            else:
+                reason, device = check_controller_login(settings, wlc_name, wlc_ip, time_left(), ssh_pool)
+                #netmiko takes seconds to log out of a WLC, the session is closed in the background once the check has reported
+                if device: threading.Thread(target=close_ssh_session, args=(device,)).start()
+        metrics.increment('preflight_checks', check=transport_name, result='failed' if reason else 'ok')
+        if reason is None: cache.record(check)
+        return reason
+    
+    log.info('Pre-flight checks: SMTP server %s and %s WLCs, %s s at most' % (settings['email_server'], len(controllers), settings['preflight_timeout']))
+    executor = ThreadPoolExecutor(max_workers=min(len(controllers) + 1, settings['preflight_max_parallel_checks']))
+    smtp_future = executor.submit(contextvars.copy_context().run, check_smtp)
+    controller_futures = dict((controller, executor.submit(contextvars.copy_context().run, check_controller, controller[0], controller[1], wlc_name)) for controller, wlc_name in controllers.items())
+    wait_futures([smtp_future] + list(controller_futures.values()), timeout=max(time_left(), 0))
+    #checks not started yet are dropped, the ones still running are bounded by the budget and end on their own
+    for future in [smtp_future] + list(controller_futures.values()):
+        future.cancel()
+    executor.shutdown(wait=False)
+    
+    preflight_failures = {}
+    for (transport_name, wlc_ip), controller_future in controller_futures.items():
+        try:
+            reason = controller_future.result(timeout=0)
+        except (FutureTimeoutError, CancelledError):
+            metrics.increment('preflight_checks', check=transport_name, result='timeout')
+            reason = timeout_reason(controllers[(transport_name, wlc_ip)], wlc_ip)
+        except Exception as e:
+            metrics.increment('preflight_checks', check=transport_name, result='failed')
+            reason = 'Pre-flight check of %s (%s) failed: %s' % (controllers[(transport_name, wlc_ip)], wlc_ip, html.escape(str(e) or type(e).__name__))
+        if reason:
+            log.error('Error: pre-flight check failed - ' + reason)
+            preflight_failures[(transport_name, wlc_ip)] = reason
+    try:
+        smtp_ok = smtp_future.result(timeout=0)
+    except Exception:
+        log.error('Error: the SMTP server %s did not answer within %s s' % (settings['email_server'], settings['preflight_timeout']))
+        metrics.increment('preflight_checks', check='smtp', result='timeout')
+        smtp_ok = False
+    cache.save()
+    
+    metrics.observe('preflight_seconds', monotonic() - preflight_start)
+    log.info('Pre-flight checks done in %.1f s: SMTP server %s, %s of %s WLCs OK' % (monotonic() - preflight_start, 'OK' if smtp_ok else 'failed', len(controllers) - len(preflight_failures), len(controllers)))
+    return smtp_ok, preflight_failures
+
+
+def fmt_multiple_email_addresses(email_add):
+    #Format e-mails to add to text
+    fmt_email_add = ""
+    if (len(email_add) >= 1):
+        for i in range(len(email_add)):
+            if i != (len(email_add)-1):
+                fmt_email_add += email_add[i] + ' - '
+            else:
+                fmt_email_add += email_add[i]
+    return fmt_email_add
+
+
+def load_settings(config_file):
+    #Reads config.ini into a dict of settings, a KeyError or ValueError is raised for missing or invalid values
+    config = configparser.ConfigParser()
+    if not config.read(config_file):
+        raise IOError('Config file not found: ' + config_file)
+    settings = {}
+    
+    #load config files setting
+    settings['platform'] = config['DEVICE_PARAMETERS']['Platform']
+    settings['username'] = config['DEVICE_PARAMETERS']['Username']
+    settings['password'] = config['DEVICE_PARAMETERS']['Password']
+    settings['ssh_port'] = int(config['DEVICE_PARAMETERS'].get('SshPort', '22'))
+    settings['command_batch_size'] = int(config['DEVICE_PARAMETERS'].get('CommandBatchSize', '1'))
+    settings['reconcile_netusers'] = config['DEVICE_PARAMETERS'].get('ReconcileNetusers', 'False')
+    settings['netuser_delete_syntax'] = config['DEVICE_PARAMETERS'].get('NetuserDeleteSyntax', 'auto')
+    settings['ssh_session_pool'] = config['DEVICE_PARAMETERS'].get('SshSessionPool', 'False')
+    settings['ssh_max_sessions_per_controller'] = int(config['DEVICE_PARAMETERS'].get('SshMaxSessionsPerController', '1'))
+    settings['ssh_session_idle_timeout'] = int(config['DEVICE_PARAMETERS'].get('SshSessionIdleTimeout', '300'))
+    settings['ssh_keepalive'] = int(config['DEVICE_PARAMETERS'].get('SshKeepalive', '30'))
+    settings['adaptive_timing'] = config['DEVICE_PARAMETERS'].get('AdaptiveTiming', 'False')
+    settings['latency_profile_file'] = config['DEVICE_PARAMETERS'].get('LatencyProfileFile', 'wlc_latency_profile.json')
+    settings['read_timeout_multiplier'] = float(config['DEVICE_PARAMETERS'].get('ReadTimeoutMultiplier', '3'))
+    settings['min_read_timeout'] = float(config['DEVICE_PARAMETERS'].get('MinReadTimeout', '5'))
+    settings['max_read_timeout'] = float(config['DEVICE_PARAMETERS'].get('MaxReadTimeout', '300'))
+    settings['default_transport'] = config['DEVICE_PARAMETERS'].get('DefaultTransport', 'cli')
+    settings['restconf_scheme'] = config['DEVICE_PARAMETERS'].get('RestconfScheme', 'https')
+    settings['restconf_port'] = int(config['DEVICE_PARAMETERS'].get('RestconfPort', '443'))
+    settings['restconf_verify_tls'] = config['DEVICE_PARAMETERS'].get('RestconfVerifyTls', 'True')
+    settings['restconf_timeout'] = int(config['DEVICE_PARAMETERS'].get('RestconfTimeout', '60'))
+    settings['restconf_batch_size'] = int(config['DEVICE_PARAMETERS'].get('RestconfBatchSize', '200'))
+    settings['restconf_data_path'] = config['DEVICE_PARAMETERS'].get('RestconfDataPath', '/restconf/data/wlc-guest-users:netusers')
+    settings['restconf_save_path'] = config['DEVICE_PARAMETERS'].get('RestconfSavePath', '/restconf/operations/cisco-ia:save-config')
+    settings['guest_email_sender_name'] = config['GUEST_USERS_EMAIL']['GuestEmailSenderName']
+    settings['guest_email_sender_address'] = config['GUEST_USERS_EMAIL']['GuestEmailSenderAddress']
+    settings['default_email_delivery'] = config['GUEST_USERS_EMAIL'].get('DefaultEmailDelivery', 'individual')
+    settings['admin_email_sender_name'] = config['ADMIN_NOTIFICATION_EMAIL']['AdminEmailSenderName']
+    settings['admin_email_sender_address'] = config['ADMIN_NOTIFICATION_EMAIL']['AdminEmailSenderAddress']
+    settings['admin_email_receiver_name'] = config['ADMIN_NOTIFICATION_EMAIL']['AdminEmailReceiverName']
+    settings['admin_email_receiver_address'] = config['ADMIN_NOTIFICATION_EMAIL']['AdminEmailReceiverAddress']
+    settings['csv_file'] = config['GLOBAL_PARAMETERS']['CsvFile']
+    settings['csv_rows_skip'] = config['GLOBAL_PARAMETERS']['CsvRowsSkip']
+    settings['email_server'] = config['GLOBAL_PARAMETERS']['EmailServer']
+    settings['file_logging'] = config['GLOBAL_PARAMETERS']['FileLogging']
+    settings['log_file_name'] = config['GLOBAL_PARAMETERS']['LogFileName']
+    settings['max_parallel_controllers'] = int(config['GLOBAL_PARAMETERS'].get('MaxParallelControllers', '1'))
+    settings['smtp_pool_size'] = int(config['GLOBAL_PARAMETERS'].get('SmtpPoolSize', '1'))
+    settings['smtp_max_messages_per_connection'] = int(config['GLOBAL_PARAMETERS'].get('SmtpMaxMessagesPerConnection', '100'))
+    settings['email_outbox_enabled'] = config.get('EMAIL_OUTBOX', 'OutboxEnabled', fallback='False')
+    settings['outbox_dir'] = config.get('EMAIL_OUTBOX', 'OutboxDir', fallback='outbox')
+    settings['outbox_workers'] = int(config.get('EMAIL_OUTBOX', 'OutboxWorkers', fallback='2'))
+    settings['outbox_max_per_second'] = float(config.get('EMAIL_OUTBOX', 'OutboxMaxPerSecond', fallback='0'))
+    settings['outbox_max_attempts'] = int(config.get('EMAIL_OUTBOX', 'OutboxMaxAttempts', fallback='8'))
+    settings['outbox_retry_delay'] = int(config.get('EMAIL_OUTBOX', 'OutboxRetryDelay', fallback='30'))
+    settings['outbox_drain_timeout'] = int(config.get('EMAIL_OUTBOX', 'OutboxDrainTimeout', fallback='300'))
+    settings['stream_chunk_size'] = int(config['GLOBAL_PARAMETERS'].get('StreamChunkSize', '0'))
+    settings['log_format'] = config['GLOBAL_PARAMETERS'].get('LogFormat', 'text')
+    settings['log_level'] = config['GLOBAL_PARAMETERS'].get('LogLevel', 'INFO').upper()
+    settings['log_rotation'] = config['GLOBAL_PARAMETERS'].get('LogRotation', 'none')
+    settings['log_max_bytes'] = int(config['GLOBAL_PARAMETERS'].get('LogMaxBytes', '10485760'))
+    settings['log_backup_count'] = int(config['GLOBAL_PARAMETERS'].get('LogBackupCount', '5'))
+    settings['log_rotate_when'] = config['GLOBAL_PARAMETERS'].get('LogRotateWhen', 'midnight')
+    settings['daemon_max_concurrent_jobs'] = int(config['GLOBAL_PARAMETERS'].get('DaemonMaxConcurrentJobs', '2'))
+    settings['metrics_report_file'] = config['GLOBAL_PARAMETERS'].get('MetricsReportFile', '')
+    settings['metrics_textfile'] = config['GLOBAL_PARAMETERS'].get('MetricsTextfile', '')
+    settings['journal_dir'] = config['GLOBAL_PARAMETERS'].get('JournalDir', '')
+    settings['group_jobs_by_controller'] = config['GLOBAL_PARAMETERS'].get('GroupJobsByController', 'False')
+    settings['queue_file'] = config.get('WORK_QUEUE', 'QueueFile', fallback='work_queue.sqlite')
+    settings['queue_lease_seconds'] = int(config.get('WORK_QUEUE', 'LeaseSeconds', fallback='600'))
+    settings['queue_max_attempts'] = int(config.get('WORK_QUEUE', 'MaxAttempts', fallback='3'))
+    settings['queue_poll_interval'] = float(config.get('WORK_QUEUE', 'PollInterval', fallback='5'))
+    settings['queue_collect_timeout'] = float(config.get('WORK_QUEUE', 'CollectTimeout', fallback='3600'))
+    settings['worker_exit_when_idle'] = config.get('WORK_QUEUE', 'WorkerExitWhenIdle', fallback='True')
+    settings['preflight_enabled'] = config.get('PREFLIGHT', 'PreflightEnabled', fallback='False')
+    settings['preflight_timeout'] = float(config.get('PREFLIGHT', 'PreflightTimeout', fallback='15'))
+    settings['preflight_ssh_login'] = config.get('PREFLIGHT', 'PreflightSshLogin', fallback='True')
+    settings['preflight_max_parallel_checks'] = int(config.get('PREFLIGHT', 'PreflightMaxParallelChecks', fallback='32'))
+    settings['preflight_cache_file'] = config.get('PREFLIGHT', 'PreflightCacheFile', fallback='preflight_cache.json')
+    settings['preflight_cache_ttl'] = float(config.get('PREFLIGHT', 'PreflightCacheTtl', fallback='300'))
+    settings['ledger_file'] = config.get('LEDGER', 'LedgerFile', fallback='')
+    settings['ledger_known_deletes_only'] = config.get('LEDGER', 'DeleteKnownUsersOnly', fallback='False')
+    settings['warm_pool_file'] = config.get('WARM_POOL', 'PoolFile', fallback='warm_pool.sqlite')
+    settings['warm_pool_listen_address'] = config.get('WARM_POOL', 'ListenAddress', fallback='127.0.0.1')
+    settings['warm_pool_listen_port'] = int(config.get('WARM_POOL', 'ListenPort', fallback='8750'))
+    settings['warm_pool_handout_token'] = config.get('WARM_POOL', 'HandoutToken', fallback='')
+    settings['warm_pool_refill_batch_size'] = int(config.get('WARM_POOL', 'RefillBatchSize', fallback='25'))
+    settings['warm_pool_refill_interval'] = float(config.get('WARM_POOL', 'RefillInterval', fallback='60'))
+    settings['warm_pool_min_remaining_lifetime'] = float(config.get('WARM_POOL', 'MinRemainingLifetime', fallback='0.5'))
+    
+    #Allow multiple admin e-mails separated by semicolumn ;
+    settings['admin_email_receiver_name'] = settings['admin_email_receiver_name'].split(';')
+    settings['admin_email_receiver_address'] = settings['admin_email_receiver_address'].split(';')
+    settings['fmt_admin_email_receiver_address'] = fmt_multiple_email_addresses(settings['admin_email_receiver_address'])
+    
+    #add full path to files
+    settings['log_full_path_file'] = os.path.join(os.path.dirname(os.path.realpath(__file__)),settings['log_file_name'])
+    settings['full_path_csv_file'] = os.path.join(os.path.dirname(os.path.realpath(__file__)),settings['csv_file'])
+    settings['full_path_outbox_dir'] = os.path.join(os.path.dirname(os.path.realpath(__file__)),settings['outbox_dir'])
+    #an empty metrics file name disables that output
+    settings['full_path_metrics_report_file'] = settings['metrics_report_file'] and os.path.join(os.path.dirname(os.path.realpath(__file__)),settings['metrics_report_file'])
+    settings['full_path_metrics_textfile'] = settings['metrics_textfile'] and os.path.join(os.path.dirname(os.path.realpath(__file__)),settings['metrics_textfile'])
+    settings['full_path_journal_dir'] = settings['journal_dir'] and os.path.join(os.path.dirname(os.path.realpath(__file__)),settings['journal_dir'])
+    settings['full_path_queue_file'] = os.path.join(os.path.dirname(os.path.realpath(__file__)),settings['queue_file'])
+    settings['full_path_latency_profile_file'] = os.path.join(os.path.dirname(os.path.realpath(__file__)),settings['latency_profile_file'])
+    settings['full_path_preflight_cache_file'] = os.path.join(os.path.dirname(os.path.realpath(__file__)),settings['preflight_cache_file'])
+    settings['full_path_ledger_file'] = settings['ledger_file'] and os.path.join(os.path.dirname(os.path.realpath(__file__)),settings['ledger_file'])
+    settings['full_path_warm_pool_file'] = os.path.join(os.path.dirname(os.path.realpath(__file__)),settings['warm_pool_file'])
+    
+    settings['file_logging'] = settings['file_logging'] != 'False'
+    settings['reconcile_netusers'] = settings['reconcile_netusers'] == 'True'
+    settings['email_outbox_enabled'] = settings['email_outbox_enabled'] == 'True'
+    settings['ssh_session_pool'] = settings['ssh_session_pool'] == 'True'
+    settings['restconf_verify_tls'] = settings['restconf_verify_tls'] != 'False'
+    settings['adaptive_timing'] = settings['adaptive_timing'] == 'True'
+    settings['worker_exit_when_idle'] = settings['worker_exit_when_idle'] == 'True'
+    settings['group_jobs_by_controller'] = settings['group_jobs_by_controller'] == 'True'
+    settings['ledger_known_deletes_only'] = settings['ledger_known_deletes_only'] == 'True'
+    settings['preflight_enabled'] = settings['preflight_enabled'] == 'True'
+    settings['preflight_ssh_login'] = settings['preflight_ssh_login'] != 'False'
+    return settings
+
+
+cron_field_ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+#names accepted by the month and day of week fields, as in crontab (JAN-DEC, SUN-SAT, any case)
+cron_field_names = ({}, {}, {},
+    dict((name, number) for number, name in enumerate(['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC'], 1)),
+    dict((name, number) for number, name in enumerate(['SUN', 'MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT'])))
+
+
+def parse_cron_value(field, value, names):
+    value = names.get(value.upper(), value)
+    if isinstance(value, int):
+        return value
+    if not value.isdigit():
+        raise ValueError('Cron field "%s" has an invalid value "%s"' % (field, value))
+    return int(value)
+
+
+def parse_cron_field(field, minimum, maximum, names={}):
+    #Expands a cron field (*, 5, 1-5, */15, 0-30/10, 1,15, MON-FRI) into the set of values it matches
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = parse_cron_value(field, step, {})
+        if part == '*':
+            first, last = minimum, maximum
+        elif '-' in part:
+            first, last = [parse_cron_value(field, value, names) for value in part.split('-', 1)]
+        else:
+            first = parse_cron_value(field, part, names)
+            last = maximum if step != 1 else first
+        if first < minimum or last > maximum or first > last or step < 1:
+            raise ValueError('Cron field "%s" is out of range %s-%s' % (field, minimum, maximum))
+        values.update(range(first, last + 1, step))
+    return values
+
+
+class job_schedule(object):
+    """Daemon mode schedule of a job id: a 5 field cron expression or "every N" seconds
+    """
+    def __init__(self, job_id, expression):
+        self.job_id = job_id
+        self.expression = expression
+        self.next_run = 0
+        self.last_minute = None
+        fields = expression.split()
+        if len(fields) == 2 and fields[0] == 'every' and fields[1].isdigit() and int(fields[1]) > 0:
+            self.interval = int(fields[1])
+            self.cron_fields = None
+        elif len(fields) == 5:
+            self.interval = None
+            try:
+                self.cron_fields = [parse_cron_field(field, minimum, maximum, names) for field, (minimum, maximum), names in zip(fields, cron_field_ranges, cron_field_names)]
+            except ValueError as e:
+                raise ValueError('Invalid schedule for job id %s: "%s" (%s)' % (job_id, expression, e))
+            if 7 in self.cron_fields[4]:
+                self.cron_fields[4].add(0)
+            self.day_restricted = fields[2] != '*'
+            self.weekday_restricted = fields[4] != '*'
+        else:
+            raise ValueError('Invalid schedule for job id %s: "%s"' % (job_id, expression))
+
+
+    def cron_matches(self, local_time):
+        minutes, hours, days, months, weekdays = self.cron_fields
+        if local_time.minute not in minutes or local_time.hour not in hours or local_time.month not in months:
+            return False
+        day_match = local_time.day in days
+        weekday_match = (local_time.isoweekday() % 7) in weekdays
+        #as in cron, a restricted day of month and day of week match when either of them does
+        if self.day_restricted and self.weekday_restricted:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+
+    def is_due(self, now):
+        if self.interval:
+            return now >= self.next_run
+        local_time = datetime.fromtimestamp(now)
+        return local_time.replace(second=0, microsecond=0) != self.last_minute and self.cron_matches(local_time)
+
+
+    def mark_started(self, now):
+        if self.interval:
+            self.next_run = now + self.interval
+        else:
+            self.last_minute = datetime.fromtimestamp(now).replace(second=0, microsecond=0)
+
+
+def load_schedules(config_file, previous_schedules={}):
+    #Reads the [SCHEDULE] section (job id = cron expression or every N seconds)
+    #Schedules that did not change keep their state so a reload does not trigger extra runs
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(config_file)
+    schedules = {}
+    if config.has_section('SCHEDULE'):
+        for job_id, expression in config.items('SCHEDULE'):
+            if job_id in previous_schedules and previous_schedules[job_id].expression == expression:
+                schedules[job_id] = previous_schedules[job_id]
+            else:
+                schedules[job_id] = job_schedule(job_id, expression)
+    return schedules
+
+
+def run_daemon(config_file, settings, smtp_pool, outbox, ssh_pool=None):
+    #Long running replacement for cron: runs the job ids of [SCHEDULE] in-process until CTRL-C or SIGTERM
+    #config.ini and the job data file are reloaded when they change on disk, logging included
+    try:
+        schedules = load_schedules(config_file)
+    except ValueError as e:
+        log.error('Error: the [SCHEDULE] section of config file ' + config_file + ' is not valid, the daemon is not started (' + str(e) + ')')
+        return False
+    config_mtime = os.stat(config_file).st_mtime_ns
+    running_job_ids = set()
+    running_lock = threading.Lock()
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    executor = ThreadPoolExecutor(max_workers=settings['daemon_max_concurrent_jobs'])
+    
+    def run_scheduled_job(job_id, job_settings):
+        try:
+            log.info('Daemon: running job id ' + job_id + '\n' + '-' * 100)
+            run_jobs(job_settings, [job_id], datetime.utcnow(), smtp_pool, outbox, ssh_pool)
+        except Exception:
+            log.error('Daemon: job id ' + job_id + ' stopped with an unexpected error: %s', sys.exc_info()[0])
+        finally:
+            with running_lock:
+                running_job_ids.discard(job_id)
+            #the daemon keeps adding to the same metrics, the files are refreshed after every job
+            metrics.write(job_settings['full_path_metrics_report_file'], job_settings['full_path_metrics_textfile'])
+    
+    log.info('Daemon started with %s scheduled job ids: %s' % (len(schedules), ', '.join(schedules)))
+    log.info('-' * 100)
+    try:
+        while not stop_event.is_set():
+            if os.stat(config_file).st_mtime_ns != config_mtime:
+                config_mtime = os.stat(config_file).st_mtime_ns
+                try:
+                    reloaded_settings = load_settings(config_file)
+                    schedules = load_schedules(config_file, schedules)
+                    if any(reloaded_settings[key] != settings[key] for key in logging_setting_keys):
+                        setup_logging(reloaded_settings)
+                    settings = reloaded_settings
+                    log.info('Daemon: reloaded config file ' + config_file)
+                except Exception as e:
+                    log.error('Error: config file ' + config_file + ' could not be reloaded, previous config is kept (' + str(e) + ')')
+            
+            now = time()
+            for job_id, schedule in schedules.items():
+                if not schedule.is_due(now):
+                    continue
+                schedule.mark_started(now)
+                with running_lock:
+                    if job_id in running_job_ids:
+                        log.info('Daemon: job id ' + job_id + ' is still running, this run is skipped')
+                        continue
+                    running_job_ids.add(job_id)
+                executor.submit(run_scheduled_job, job_id, settings)
+            if ssh_pool: ssh_pool.evict_idle()
+            stop_event.wait(1)
+    except KeyboardInterrupt:
+        pass
+    log.info('Daemon: stopping, waiting for running jobs to complete')
+    executor.shutdown(wait=True)
+    return True
+
+
+def split_script_options(argv):
+    #Separates --options from the job id arguments
+    script_options = [arg for arg in argv if arg.startswith('--')]
+    job_ids = [arg for arg in argv if not arg.startswith('--')]
+    return script_options, job_ids
+
+
+def check_job_row(job_row, duplicate_job_ids, all_timezones):
+    #Returns the list of problems found in a job data row
+    job_problems = []
+    if job_row[0] in duplicate_job_ids:
+        job_problems.append('job id is present more than once in the job data file')
+    wlc_ip = job_row[1].split(';')
+    wlc_name = job_row[2].split(';')
+    if len(wlc_ip) != len(wlc_name):
+        job_problems.append('wlcIP has %s items and wlcName has %s, they must match' % (len(wlc_ip), len(wlc_name)))
+    for ip in wlc_ip:
+        try:
+            ipaddress.ip_address(ip)
+        except ValueError:
+            job_problems.append('wlcIP "%s" is not a valid IP address' % ip)
+    for column_name, column_value, minimum in (('userQty', job_row[4], 1), ('wlanId', job_row[5], 1), ('lifetime', job_row[8], 0)):
+        if not column_value.isdigit() or int(column_value) < minimum:
+            job_problems.append('%s "%s" must be a number not lower than %s' % (column_name, column_value, minimum))
+    if job_row[9] not in all_timezones:
+        job_problems.append('timezone "%s" is not a valid timezone code (see timezone_list.txt)' % job_row[9])
+    if job_row[11] == '':
+        job_problems.append('email recipient is missing')
+    if len(job_row) > 12 and job_row[12] not in ('', 'individual', 'digest', 'attachment'):
+        job_problems.append('delivery "%s" must be individual, digest or attachment' % job_row[12])
+    if len(job_row) > 13 and job_row[13] not in [''] + list(wlc_transports):
+        job_problems.append('transport "%s" must be %s' % (job_row[13], ' or '.join(wlc_transports)))
+    return job_problems
+
+
+def check_configuration(config_file, job_ids):
+    #Validates config, job data and timezones without connecting to anything or loading netmiko
+    try:
+        settings = load_settings(config_file)
+        if settings['netuser_delete_syntax'] not in ('auto', 'username', 'legacy'):
+            raise ValueError('NetuserDeleteSyntax must be auto, username or legacy')
+        if settings['default_email_delivery'] not in ('individual', 'digest', 'attachment'):
+            raise ValueError('DefaultEmailDelivery must be individual, digest or attachment')
+        if settings['default_transport'] not in wlc_transports:
+            raise ValueError('DefaultTransport must be ' + ' or '.join(wlc_transports))
+        load_schedules(config_file)
+    except Exception as e:
+        print('Error: it is not possible to read config from file: ' + config_file + ' (' + str(e) + ')')
+        return False
+    print('Config file OK: ' + config_file)
+    
+    try:
+        job_index, duplicate_job_ids = load_job_data(settings['full_path_csv_file'], settings['csv_rows_skip'])
+    except Exception as e:
+        print('Error: it is not possible to correctly load job data from file: ' + settings['full_path_csv_file'] + ' (' + str(e) + ')')
+        return False
+    print('Job data file OK: ' + settings['full_path_csv_file'] + ' (' + str(len(job_index)) + ' jobs)')
     
-    if file_logging == 'False':
-        file_logging = False 
-    else: 
-        file_logging = True
-        
-    if file_logging == True:
-        fd = open(log_full_path_file,'a') # File logging location and name.
-        sys.stdout = fd
-        script_start_time = script_start(True, fmtlog)
-    else:
-        script_start_time = script_start(False, fmtlog)
-        
-    date_start = script_start_time
+    from pytz import all_timezones_set
+    check_passed = True
+    for job_id in (job_ids or list(job_index)):
+        if job_id not in job_index:
+            job_problems = ['job id does not exist in the job data file']
+        else:
+            job_problems = check_job_row(job_index[job_id], duplicate_job_ids, all_timezones_set)
+        if job_problems:
+            check_passed = False
+            print('Error: job id ' + job_id + ':\n  ' + '\n  '.join(job_problems))
+        else:
+            print('Job id ' + job_id + ' OK')
+    return check_passed
+
+
+#latencies in seconds used by --plan when no run report is given, and the run report timer each one is calibrated from
+plan_default_latency = {'ssh_connect': 3.0, 'ssh_disconnect': 2.5, 'command': 0.15, 'save_config': 5.0, 'smtp_send': 0.2, 'restconf_request': 1.0}
+plan_latency_timers = {'ssh_connect': 'ssh_connect_seconds', 'ssh_disconnect': 'ssh_disconnect_seconds', 'command': 'wlc_command_seconds', 'save_config': 'wlc_save_config_seconds', 'smtp_send': 'smtp_send_seconds', 'restconf_request': 'restconf_request_seconds'}
+
+
+def load_latency_model(report_files):
+    #Returns the latency of each phase, overall and per WLC, as measured in earlier run reports (see MetricsReportFile)
+    #Phases that were never measured keep their default latency
+    timer_totals = {}
+    for report_file in report_files:
+        with open(report_file) as f:
+            run_report = json.load(f)
+        for timer in run_report.get('timers', []):
+            for phase, timer_name in plan_latency_timers.items():
+                if timer['name'] != timer_name or timer['count'] == 0:
+                    continue
+                controller = timer['labels'].get('controller', '')
+                for key in set([('', phase), (controller, phase)]):
+                    totals = timer_totals.setdefault(key, [0.0, 0])
+                    totals[0] += timer['sum_seconds']
+                    totals[1] += timer['count']
+    latency_model = {'': dict(plan_default_latency)}
+    for (controller, phase), (sum_seconds, count) in timer_totals.items():
+        latency_model.setdefault(controller, {})[phase] = sum_seconds / count
+    return latency_model
+
+
+def plan_latency(latency_model, wlc_ip, phase):
+    return latency_model.get(wlc_ip, {}).get(phase, latency_model[''][phase])
+
+
+def fmt_duration(seconds):
+    return '%d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def plan_jobs(config_file, job_ids, report_files):
+    #Prints the commands, e-mails and estimated duration of each job without connecting to any WLC or SMTP server
+    try:
+        settings = load_settings(config_file)
+        job_index, duplicate_job_ids = load_job_data(settings['full_path_csv_file'], settings['csv_rows_skip'])
+        latency_model = load_latency_model(report_files)
+    except Exception as e:
+        print('Error: it is not possible to plan the jobs (' + str(e) + ')')
+        return False
     
-    print('Testing availability of SMTP server: ' + email_server)
-    email_test_result = test_email_server(email_server)
-    if email_test_result:
-        print('-' * 100)
+    print('Latency model: ssh connect %.2f s - command %.3f s - save config %.2f s - ssh disconnect %.2f s - restconf request %.2f s - e-mail %.3f s' % tuple(latency_model[''][phase] for phase in ('ssh_connect', 'command', 'save_config', 'ssh_disconnect', 'restconf_request', 'smtp_send')))
+    if report_files:
+        print('Calibrated from: ' + ', '.join(report_files))
     else:
-        script_end(True, fmtlog)
-        fd.close()
-        sys.exit(0)
+        print('Default latencies, use --calibrate to measure them from earlier run reports')
+    print('-' * 100)
+    
+    plan_passed = True
+    run_seconds = 0.0
+    run_mail_count = 0
+    run_command_count = 0
+    connected_wlc_ips = set()
+    #save configs of the non-streaming jobs on each WLC, grouped into one with GroupJobsByController
+    wlc_save_counts = Counter()
+    for job_id in (job_ids or list(job_index)):
+        selected_data, command_list, user_credentials, error_check = process_select_data(job_index, duplicate_job_ids, job_id, settings['full_path_csv_file'], settings['log_full_path_file'], settings['stream_chunk_size'])
+        if error_check != '':
+            plan_passed = False
+            print('Error: job id ' + job_id + ': ' + error_check[1].replace('\n', ' '))
+            continue
+        wlc_ip = selected_data[1].split(';')
+        wlc_name = selected_data[2].split(';')
+        user_qty = int(selected_data[4])
+        email_delivery = selected_data[12] or settings['default_email_delivery']
+        transport = selected_data[13] or settings['default_transport']
+        if len(wlc_ip) != len(wlc_name):
+            plan_passed = False
+            print('Error: job id ' + job_id + ': the number of WLC IPs and names does not match')
+            continue
         
-    if len(argv) == 0:
-        print('You need to enter at least one id argument!\n')
-        script_end(True, fmtlog)
-        fd.close()
-        sys.exit(0)
+        if command_list is None:
+            #streaming jobs generate their commands chunk by chunk, the count is the same
+            chunk_count = (user_qty + settings['stream_chunk_size'] - 1) // settings['stream_chunk_size']
+            command_list = build_user_commands(guest_user(selected_data[3] + '_1', ''), selected_data[5], selected_data[7], selected_data[8], selected_data[10]) * user_qty
+        else:
+            chunk_count = 1
+            wlc_save_counts.update(wlc_ip)
+        add_count = len([command for command in command_list if command.startswith('config netuser add ')])
+        delete_count = len(command_list) - add_count
+        if email_delivery == 'individual':
+            mail_count = user_qty
+        else:
+            mail_count = chunk_count
         
-    for arg in argv:
-        if (argv.count(arg)) > 1:
-            print('Error: id ' + str(arg) + ' has ' + str(argv.count(arg)) + ' duplicates.')
-            print('Duplicate script arguments are not allowed, remove them and run the script again.')
-            script_end(True, fmtlog)
-            fd.close()
-            sys.exit(0)
-            
+        print('Job id %s - %s users - %s e-mail delivery%s' % (job_id, user_qty, email_delivery, ' - streamed in %s chunks' % chunk_count if chunk_count > 1 else ''))
+        wlc_seconds = []
+        for i in range(len(wlc_ip)):
+            if transport == 'restconf':
+                #one YANG Patch per RestconfBatchSize users of each chunk
+                chunk_sizes = [min(settings['stream_chunk_size'], user_qty - chunk_start) for chunk_start in range(0, user_qty, settings['stream_chunk_size'])] if chunk_count > 1 else [user_qty]
+                request_count = sum((chunk_size + settings['restconf_batch_size'] - 1) // settings['restconf_batch_size'] for chunk_size in chunk_sizes)
+                seconds = request_count * plan_latency(latency_model, wlc_ip[i], 'restconf_request') + plan_latency(latency_model, wlc_ip[i], 'save_config')
+                wlc_seconds.append(seconds)
+                print('  %s (%s): %s users in %s RESTCONF requests, 1 save config - estimated %.1f s' % (wlc_name[i], wlc_ip[i], user_qty, request_count, seconds))
+                continue
+            #pooled sessions are opened once per run and stay open at the end of each job
+            new_session = not settings['ssh_session_pool'] or wlc_ip[i] not in connected_wlc_ips
+            connected_wlc_ips.add(wlc_ip[i])
+            seconds = len(command_list) * plan_latency(latency_model, wlc_ip[i], 'command') + plan_latency(latency_model, wlc_ip[i], 'save_config')
+            if new_session:
+                seconds += plan_latency(latency_model, wlc_ip[i], 'ssh_connect')
+            if not settings['ssh_session_pool']:
+                seconds += plan_latency(latency_model, wlc_ip[i], 'ssh_disconnect')
+            wlc_seconds.append(seconds)
+            print('  %s (%s): %s commands (%s delete, %s add), 1 save config, %s - estimated %.1f s' % (wlc_name[i], wlc_ip[i], len(command_list), delete_count, add_count, 'new ssh session' if new_session else 'pooled ssh session', seconds))
+        
+        #WLCs run max_parallel_controllers at a time, each one starting on the first free slot
+        slots = [0.0] * min(max(settings['max_parallel_controllers'], 1), len(wlc_ip))
+        for seconds in wlc_seconds:
+            slots[slots.index(min(slots))] += seconds
+        job_seconds = max(slots)
+        mail_seconds = mail_count * plan_latency(latency_model, '', 'smtp_send')
+        if settings['email_outbox_enabled']:
+            #the outbox delivers in the background while the next jobs run
+            mail_seconds = 0.0
+        print('  e-mails: %s guest e-mails to %s - %s' % (mail_count, fmt_multiple_email_addresses(selected_data[11].split(';')), 'delivered in the background by the outbox' if settings['email_outbox_enabled'] else 'estimated %.1f s' % mail_seconds))
+        print('  job estimate: %.1f s (%s)' % (job_seconds + mail_seconds, fmt_duration(job_seconds + mail_seconds)))
+        run_seconds += job_seconds + mail_seconds
+        run_mail_count += mail_count
+        run_command_count += len(command_list) * len(wlc_ip)
+    
+    grouped_save_count = len(wlc_save_counts)
+    if settings['group_jobs_by_controller'] and sum(wlc_save_counts.values()) > grouped_save_count:
+        #each WLC shared by several jobs saves its config once, in a single session
+        grouped_seconds = sum((save_count - 1) * (plan_latency(latency_model, wlc_ip, 'save_config') + (0 if settings['ssh_session_pool'] else plan_latency(latency_model, wlc_ip, 'ssh_connect') + plan_latency(latency_model, wlc_ip, 'ssh_disconnect'))) for wlc_ip, save_count in wlc_save_counts.items())
+        run_seconds = max(run_seconds - grouped_seconds, 0.0)
+        print('-' * 100)
+        print('Jobs grouped by controller: %s save configs instead of %s - %.1f s less than the job estimates' % (grouped_save_count, sum(wlc_save_counts.values()), grouped_seconds))
+    
+    #one admin report e-mail, plus the guest e-mails the outbox has not delivered when the jobs are over
+    run_mail_count += 1
+    run_seconds += plan_latency(latency_model, '', 'smtp_send')
+    if settings['email_outbox_enabled']:
+        outbox_rate = settings['outbox_workers'] / plan_latency(latency_model, '', 'smtp_send')
+        if settings['outbox_max_per_second'] > 0:
+            outbox_rate = min(outbox_rate, settings['outbox_max_per_second'])
+        run_seconds = max(run_seconds, run_mail_count / outbox_rate)
+    print('-' * 100)
+    print('Run estimate: %s WLC commands, %s e-mails (including the admin report) - %s' % (run_command_count, run_mail_count, fmt_duration(run_seconds)))
+    return plan_passed
+
+
+job_result = namedtuple('job_result', ['job_id', 'result', 'user_qty', 'report', 'error'])
+#result: success, failed (its admin error e-mail is sent by run_job) or invalid (job data error, e-mailed by the caller)
+
+
+def show_active_accounts(config_file, controller=''):
+    #Prints the accounts of the ledger that have not expired yet, on every WLC or on one WLC (IP or name), without connecting to anything
     try:
-        csv_loaded_data = np.loadtxt(full_path_csv_file, dtype=str, delimiter=',', skiprows=int(csv_rows_skip))
-    except:
-        load_error = 'Error: it is not possible to correctly load job data from file: ' + full_path_csv_file + '\n'
-        print(load_error)
-        admin_email_subject = "Error / Wireless Guest User Creation - Unable to load job data file"
-        admin_email_msg = load_error
-        send_generic_mail(email_server, admin_email_sender_name, admin_email_sender_address, admin_email_receiver_name, admin_email_receiver_address, admin_email_subject, admin_email_msg)
-        csv_exception_occurred = True
+        settings = load_settings(config_file)
+        if not settings['full_path_ledger_file']:
+            raise ValueError('LedgerFile is not set')
+        accounts = account_ledger(settings['full_path_ledger_file']).active(time(), controller)
+    except Exception as e:
+        print('Error: it is not possible to read the ledger (' + str(e) + ')')
+        return False
+    controller_accounts = {}
+    for account_controller, controller_name, user, job_id, expires in accounts:
+        controller_accounts.setdefault((account_controller, controller_name), []).append((user, job_id, expires))
+    for (account_controller, controller_name), wlc_accounts in controller_accounts.items():
+        print('%s (%s): %s active accounts' % (controller_name, account_controller, len(wlc_accounts)))
+        for user, job_id, expires in wlc_accounts:
+            print('  %s - job id %s - %s' % (user, job_id, 'active until ' + datetime.fromtimestamp(expires).astimezone().strftime(fmtlog) if expires else 'no expiry'))
+    print('-' * 100)
+    print('%s active accounts on %s WLCs' % (len(accounts), len(controller_accounts)))
+    return True
+
+
+class guest_job(object):
+    """One job id of the job data file, from its selected row to its job_result
+    
+    run_job() runs it on its own WLCs, run_jobs() can also run the WLC commands of several jobs
+    together with a controller_plan and hand each job its results.
+    """
+    def __init__(self, settings, selected_csv_data, commands, user_credentials, date_start, resume=False):
+        from pytz import timezone
+        self.settings = settings
+        self.job_start = monotonic()
+        self.selected_csv_data = selected_csv_data
+        self.commands = commands
+        self.user_credentials = user_credentials
+        self.streamed_user_qty = 0
+        self.preflight_failed = False
+        self.id = selected_csv_data[0]
+        self.user_prefix = selected_csv_data[3]
+        self.user_qty = selected_csv_data[4]
+        self.wlan_id = selected_csv_data[5]
+        self.ssid = selected_csv_data[6]
+        self.user_type = selected_csv_data[7]
+        self.lifetime = selected_csv_data[8]
+        self.timezone_code = selected_csv_data[9]
+        self.description = selected_csv_data[10]
+        self.email_delivery = selected_csv_data[12] or settings['default_email_delivery']
+        self.transport = wlc_transports[selected_csv_data[13] or settings['default_transport']](settings)
+        self.ledger = account_ledger(settings['full_path_ledger_file']) if settings['full_path_ledger_file'] else None
         
-    for argument in argv:
-        try:
-            selected_csv_data, commands, user_credentials, error_check = process_select_data(csv_loaded_data, argument, full_path_csv_file, log_full_path_file)
-            if ((type(error_check) == list) and (error_check[0] != "")):
-                raise Exception
-        except:
-            if csv_exception_occurred != True:
-                admin_email_subject = error_check[0]
-                admin_email_msg = error_check[1]
-                send_generic_mail(email_server, admin_email_sender_name, admin_email_sender_address, admin_email_receiver_name, admin_email_receiver_address, admin_email_subject, admin_email_msg)
-                print(('-' * 100) + '\n' + admin_email_msg + '\n' + ('-' * 100))
-                csv_exception_occurred = True
-            continue
-            
-        id = selected_csv_data[0]
-        wlc_ip = selected_csv_data[1]
-        wlc_name = selected_csv_data[2]
-        user_prefix = selected_csv_data[3]
-        user_qty = selected_csv_data[4]
-        wlan_id = selected_csv_data[5]
-        ssid = selected_csv_data[6]
-        user_type = selected_csv_data[7]
-        lifetime = selected_csv_data[8]
-        timezone_code = selected_csv_data[9]
-        description = selected_csv_data[10]
-        guest_email_receiver_address = selected_csv_data[11]
-        date_end = date_start + timedelta(seconds=int(lifetime))
+        job_date_start = date_start
+        self.journal = None
+        if settings['full_path_journal_dir']:
+            self.journal = job_journal(settings['full_path_journal_dir'], self.id)
+            if resume and self.journal.load() and self.journal.job_row == selected_csv_data:
+                self.journal.resume()
+                job_date_start = self.journal.date_start
+                log.info('Resuming job id %s from its journal: %s users issued, %s e-mailed' % (self.id, len(self.journal.credentials), len(self.journal.mailed)))
+            else:
+                if resume:
+                    log.info('No journal matching job id %s to resume from, the job is run from the start' % self.id)
+                self.journal = job_journal(settings['full_path_journal_dir'], self.id)
+                self.journal.start(selected_csv_data, date_start)
+        date_end = job_date_start + timedelta(seconds=int(self.lifetime))
         # Format and Convert to local date/time (localize time)
-        localized_date_start = date_start.astimezone(timezone(timezone_code))
-        localized_date_start = localized_date_start.strftime(fmt)
-        localized_date_end = date_end.astimezone(timezone(timezone_code))
-        localized_date_end = localized_date_end.strftime(fmt)
+        localized_date_start = job_date_start.astimezone(timezone(self.timezone_code))
+        self.localized_date_start = localized_date_start.strftime(fmt)
+        localized_date_end = date_end.astimezone(timezone(self.timezone_code))
+        self.localized_date_end = localized_date_end.strftime(fmt)
         
-        #Execute commands to add users on WLCs
         #Split WLC IPs and Names and e-mail addresses in case there are multiple entries
-        wlc_ip = wlc_ip.split(";")
-        wlc_name = wlc_name.split(";")
-        guest_email_receiver_address  = guest_email_receiver_address.split(";")
-        fmt_guest_email_receiver_address = fmt_multiple_email_addresses(guest_email_receiver_address)
+        self.wlc_ip = selected_csv_data[1].split(";")
+        self.wlc_name = selected_csv_data[2].split(";")
+        self.guest_email_receiver_address = selected_csv_data[11].split(";")
+        self.fmt_guest_email_receiver_address = fmt_multiple_email_addresses(self.guest_email_receiver_address)
+    
+    
+    def wlc_list_valid(self):
+        return (len(self.wlc_ip) >= 1 and len(self.wlc_name) >= 1) and (len(self.wlc_ip) == len(self.wlc_name))
+    
+    
+    def streaming(self):
+        return self.commands is None
+    
+    
+    def preflight_results(self, preflight_failures):
+        #WLC results of a job with a WLC that failed its pre-flight check (the job is not run on any of its WLCs), None otherwise
+        if not self.wlc_list_valid() or not any((self.transport.name, ip) in preflight_failures for ip in self.wlc_ip):
+            return None
+        log.error('Error: job id %s is not run, a WLC of the job failed its pre-flight check' % self.id)
+        self.preflight_failed = True
+        return [preflight_failures.get((self.transport.name, self.wlc_ip[i]), 'Not run on %s (%s): another WLC of the job failed its pre-flight check' % (self.wlc_name[i], self.wlc_ip[i])) for i in range(len(self.wlc_ip))]
+    
+    
+    def wlc_command_lists(self):
+        #Returns the commands of the job, or a dict with the commands of each WLC when the job has a journal or uses the ledger deletes
+        wlc_command_lists = self.commands
+        if self.journal:
+            #users already issued keep their password, each WLC only gets the users it has not confirmed
+            self.user_credentials = [guest_user(user, self.journal.credentials.get(user, password)) for user, password in self.user_credentials]
+            self.journal.record_issued(self.user_credentials)
+            wlc_command_lists = self.journal.pending_commands(self.selected_csv_data, self.user_credentials, self.wlc_ip)
+        if self.ledger and self.settings['ledger_known_deletes_only']:
+            wlc_command_lists = self.ledger.known_deletes_only(wlc_command_lists, self.wlc_ip)
+        return wlc_command_lists
+    
+    
+    def command_callback(self):
+        return chain_command_callbacks(self.journal and self.journal.record_command, self.ledger and self.ledger.recorder(self.id, dict(zip(self.wlc_ip, self.wlc_name)), self.transport.name, int(self.lifetime)))
+    
+    
+    def send_mail(self, user_credentials, smtp_pool, outbox):
+        log.info('\nSending e-mails to recipient: ' + self.fmt_guest_email_receiver_address + '\n' + '-' * 100)
+        send_guest_user_mail(user_credentials, self.ssid, 'guest', self.localized_date_start, self.localized_date_end, self.settings['email_server'], self.settings['guest_email_sender_name'], self.settings['guest_email_sender_address'], self.guest_email_receiver_address, smtp_pool, outbox, self.email_delivery)
+        log.info('-' * 100)
+    
+    
+    def run_on_devices(self, smtp_pool, outbox, ssh_pool=None):
+        #Executes commands to add users on the WLCs of the job, returns the WLC results (None for a non-matching WLC list)
+        settings = self.settings
+        if self.wlc_list_valid() and self.streaming():
+            #Streaming mode, guest e-mails are sent chunk by chunk as soon as the users exist on all the WLCs
+            wlc_creation_results, self.streamed_user_qty = stream_job_to_devices(settings, self.selected_csv_data, self.wlc_name, self.wlc_ip, ssh_pool, lambda chunk_user_credentials: self.send_mail(chunk_user_credentials, smtp_pool, outbox), self.journal, self.transport, self.command_callback(), self.ledger)
+            return wlc_creation_results
+        elif self.wlc_list_valid():
+            return issue_commands_on_devices(settings['platform'], self.wlc_name, self.wlc_ip, settings['username'], settings['password'], self.wlc_command_lists(), self.id, settings['max_parallel_controllers'], settings['command_batch_size'], settings['reconcile_netusers'], settings['netuser_delete_syntax'], ssh_pool, True, settings['ssh_port'], self.command_callback(), self.transport)
+        log.error('Error: it is not possible to run a job with a non-matching count of WCL IPs and Names\n')
+        log.info('-' * 100)
+        return None
+    
+    
+    def finish(self, wlc_creation_results, smtp_pool, outbox):
+        #E-mails the guest credentials or the admin error e-mail and returns the job_result that goes into the admin report
+        settings = self.settings
+        if self.ledger: self.ledger.flush()
+        id = self.id
+        wlc_ip = self.wlc_ip
+        wlc_name = self.wlc_name
+        user_prefix = self.user_prefix
+        user_qty = self.user_qty
+        lifetime = self.lifetime
+        timezone_code = self.timezone_code
+        journal = self.journal
+        fmt_guest_email_receiver_address = self.fmt_guest_email_receiver_address
         
-        if ((len(wlc_ip) >= 1 and len(wlc_name) >= 1) and (len(wlc_ip) == len(wlc_name))):
-            wlc_creation_results = [None] * len(wlc_ip)
-            for i in range(len(wlc_ip)):
-                print('Attempting to SSH to %s (%s) - Running job id: %s' % (wlc_name[i], wlc_ip[i], id))
-                wlc_creation_results[i] = issue_commands_on_device(platform, wlc_name[i], wlc_ip[i], username, password, commands)
-        else:
-            wlc_creation_results = None
-            print('Error: it is not possible to run a job with a non-matching count of WCL IPs and Names\n')
-            print('-' * 100)
-            
         if (type(wlc_creation_results) == list):
             if wlc_creation_results.count("success") == len(wlc_ip):
                 wlc_creation_collective_result = 'success'
             else:
                 wlc_creation_collective_result = 'WLC bulk failure'
-                print('Error: one of the WLC listed in this job did not completed sucessfully. See logs for more info...')
-                print('-' * 100)
+                log.error('Error: one of the WLC listed in this job did not completed sucessfully. See logs for more info...')
+                log.info('-' * 100)
         else:
             wlc_creation_collective_result = 'Syntax Error: wlc_ip and wlc_name values are incorrectly entered.<br>Check the number of wlc_ip and wlc_name items and make sure they are delimited by ;'
-            print('Error: one of the WLC listed in this job did not completed sucessfully. See logs for more info...')
-            print('-' * 100)
+            log.error('Error: one of the WLC listed in this job did not completed sucessfully. See logs for more info...')
+            log.info('-' * 100)
             
         if wlc_creation_collective_result == 'success':
             #when a job has run succesfully run code below
-            successful_job_count += 1
-            #creating list of ids ran in this script execution
-            id_list_pass.append(id)
-            print('Wireless Guest users were successfully created')
-            print('-' * 100)
+            log.info('Wireless Guest users were successfully created')
+            log.info('-' * 100)
             
-            #Send e-mail for each guest created
-            print('\nSending e-mails to recipient: ' + fmt_guest_email_receiver_address + '\n' + '-' * 100) 
-            send_guest_user_mail(user_credentials, ssid, 'guest', localized_date_start, localized_date_end, email_server, guest_email_sender_name, guest_email_sender_address, guest_email_receiver_address)
-            print('-' * 100)
-            print('\n\n\n')
+            #Send e-mail for each guest created (already done chunk by chunk in streaming mode)
+            #a resumed job only e-mails the users the previous run did not
+            if not self.streaming():
+                mail_credentials = journal.unmailed(self.user_credentials) if journal else self.user_credentials
+                if mail_credentials:
+                    self.send_mail(mail_credentials, smtp_pool, outbox)
+                    if journal: journal.record_mailed(mail_credentials)
+            if journal: journal.close(True)
+            log.info('\n\n\n')
             
             #Formats wireless user creation e-mail that is later send out out to the Admin
-            users_email_qty_sent += int(user_qty)
-            email_admin_report += (
-                '%s guest users for job id %s sent out to: %s<br>'
+            email_admin_report = (
+                '%s guest users for job id %s sent out to: %s (%s e-mail delivery)<br>'
                 'WLC: '
-            ) % (user_qty, id, fmt_guest_email_receiver_address)
+            ) % (user_qty, id, fmt_guest_email_receiver_address, self.email_delivery)
             for i in range(len(wlc_ip)):
                 if wlc_name[i] ==  '': wlc_name[i] = 'N/A'
                 if i != (len(wlc_ip)-1):
@@ -512,13 +2807,13 @@ def main(argv):
                 'Timezone: %s<br>'
                 'Users Active from: %s<br>'
                 'Users Active until: %s<br><br>\n'
-            ) % (user_credentials[0][0][0], user_credentials[-1][0][0], lifetime, timezone_code, localized_date_start, localized_date_end)
-            #adding continue below will generate a single Wireless Guest User Creation Report for Sucessful jobs
-            #removing continue will generate multiple Wireless Guest User Creation Report for each Sucessful job
-            continue
+            ) % (user_prefix + '_1', user_prefix + '_' + str(int(user_qty)), lifetime, timezone_code, self.localized_date_start, self.localized_date_end)
+            metrics.observe('job_seconds', monotonic() - self.job_start, job_id=id)
+            metrics.increment('jobs', result='success')
+            metrics.increment('guest_users_created', int(user_qty))
+            return job_result(id, 'success', int(user_qty), email_admin_report, None)
         else:
-            failed_job_count += 1
-            err_msg = 'An error occurred in the Wireless Guest User Creation script.<br><br>Job id ' + argument + ' failed due to the following reason:<br>'
+            err_msg = 'An error occurred in the Wireless Guest User Creation script.<br><br>Job id ' + id + ' failed due to the following reason:<br>'
             if wlc_creation_collective_result == 'WLC bulk failure':
                 for i in range(len(wlc_ip)):
                     if i != (len(wlc_ip)-1):
@@ -529,6 +2824,14 @@ def main(argv):
                             err_msg += wlc_creation_results[i]
             else:
                 err_msg += wlc_creation_collective_result
+            if self.streaming() and wlc_creation_collective_result == 'WLC bulk failure' and self.streamed_user_qty > 0:
+                err_msg += '<br>The job stopped part way: the first %s of %s users were created and e-mailed before the failure' % (self.streamed_user_qty, user_qty)
+            if journal and self.preflight_failed and not journal.credentials:
+                #the job never started, its next run starts from scratch
+                journal.close(True)
+            elif journal:
+                journal.close()
+                err_msg += '<br>The users already created are kept in the job journal, run the script with --resume %s to continue the job with the same passwords' % id
             err_msg += '<br><br>'
             
             #Job error in creation of Wireless Guest Users, e-mail and continue with next job id if any.
@@ -558,18 +2861,63 @@ def main(argv):
                 'Timezone: %s<br>'
                 'Description: %s<br>'
                 'Email Recipient: %s<br>'
-            ) % (user_prefix, user_qty, wlan_id, ssid, user_type, lifetime, timezone_code, description, fmt_guest_email_receiver_address)
+            ) % (user_prefix, user_qty, self.wlan_id, self.ssid, self.user_type, lifetime, timezone_code, self.description, fmt_guest_email_receiver_address)
             
-            print('-' * 100)
-            print('\n\n')
-            admin_email_subject = 'Error / Wireless Guest User Creation - job id ' + argument + ' failed.'
+            log.info('-' * 100)
+            log.info('\n\n')
+            admin_email_subject = 'Error / Wireless Guest User Creation - job id ' + id + ' failed.'
             admin_email_msg = err_msg
-            print('\nSending e-mail to Admin Recipient: ' + fmt_admin_email_receiver_address + '\n' + admin_email_subject + '\n' + '-' * 100)
-            print(admin_email_msg)
-            print('-' * 100)
-            send_generic_mail(email_server, admin_email_sender_name, admin_email_sender_address, admin_email_receiver_name, admin_email_receiver_address, admin_email_subject, admin_email_msg)
-            print('-' * 100)
-            print('\n\n\n')
+            log.info('\nSending e-mail to Admin Recipient: ' + settings['fmt_admin_email_receiver_address'] + '\n' + admin_email_subject + '\n' + '-' * 100)
+            log.info(admin_email_msg)
+            log.info('-' * 100)
+            send_generic_mail(settings['email_server'], settings['admin_email_sender_name'], settings['admin_email_sender_address'], settings['admin_email_receiver_name'], settings['admin_email_receiver_address'], admin_email_subject, admin_email_msg, smtp_pool)
+            log.info('-' * 100)
+            log.info('\n\n\n')
+            metrics.observe('job_seconds', monotonic() - self.job_start, job_id=id)
+            metrics.increment('jobs', result='failed')
+            if self.streaming() and wlc_creation_collective_result == 'WLC bulk failure' and self.streamed_user_qty > 0:
+                metrics.increment('guest_users_created', self.streamed_user_qty)
+            return job_result(id, 'failed', 0, '', [admin_email_subject, admin_email_msg])
+
+
+def prepare_job(settings, argument, job_index, duplicate_job_ids, date_start, resume=False):
+    #Returns the guest_job of a job id, or the invalid job_result of a job id that cannot run
+    try:
+        selected_csv_data, commands, user_credentials, error_check = process_select_data(job_index, duplicate_job_ids, argument, settings['full_path_csv_file'], settings['log_full_path_file'], settings['stream_chunk_size'])
+        if ((type(error_check) == list) and (error_check[0] != "")):
+            raise Exception
+    except:
+        return job_result(argument, 'invalid', 0, '', error_check)
+    return guest_job(settings, selected_csv_data, commands, user_credentials, date_start, resume)
+
+
+def run_job(settings, argument, job_index, duplicate_job_ids, date_start, smtp_pool, outbox, ssh_pool=None, resume=False, preflight_failures={}):
+    #Runs one job id: creates its users on its WLCs, e-mails the guest credentials or the admin error e-mail
+    #Returns the job_result that goes into the admin report
+    #With resume the job continues from its journal (JournalDir) instead of starting over
+    #A job with a WLC in preflight_failures fails straight away
+    job = prepare_job(settings, argument, job_index, duplicate_job_ids, date_start, resume)
+    if isinstance(job, job_result):
+        return job
+    return job.finish(job.preflight_results(preflight_failures) or job.run_on_devices(smtp_pool, outbox, ssh_pool), smtp_pool, outbox)
+
+
+def send_admin_report(settings, job_results, smtp_pool):
+    #Sends the Wireless Guest User Creation Report of the successful jobs, if any
+    successful_job_count = 0
+    failed_job_count = 0
+    users_email_qty_sent = 0
+    email_admin_report = ''
+    id_list_pass = []
+    for result in job_results:
+        if result.result == 'success':
+            successful_job_count += 1
+            #creating list of ids ran in this script execution
+            id_list_pass.append(result.job_id)
+            users_email_qty_sent += result.user_qty
+            email_admin_report += result.report
+        elif result.result == 'failed':
+            failed_job_count += 1
             
     if users_email_qty_sent > 0:
         #admin_email_msg = 'Total number of guest e-mails sent out for all jobs: %s<br><br>Successful Jobs: %s<br><br>Failed Jobs: %s<br><br>' % (users_email_qty_sent, str(successful_job_count), str(failed_job_count)) 
@@ -593,21 +2941,831 @@ def main(argv):
             else:
                 report_heading += id_list_pass[i]
             i+=1
-        print('\nSending e-mail to Admin Recipient: ' + fmt_admin_email_receiver_address + '\n' + report_heading + '\n' + '-' * 100)
-        print(admin_email_msg)
-        print('-' * 100)
+        log.info('\nSending e-mail to Admin Recipient: ' + settings['fmt_admin_email_receiver_address'] + '\n' + report_heading + '\n' + '-' * 100)
+        log.info(admin_email_msg)
+        log.info('-' * 100)
         admin_email_subject = report_heading
-        send_generic_mail(email_server, admin_email_sender_name, admin_email_sender_address, admin_email_receiver_name, admin_email_receiver_address, admin_email_subject, admin_email_msg)
-        print('-' * 100)
+        send_generic_mail(settings['email_server'], settings['admin_email_sender_name'], settings['admin_email_sender_address'], settings['admin_email_receiver_name'], settings['admin_email_receiver_address'], admin_email_subject, admin_email_msg, smtp_pool)
+        log.info('-' * 100)
+    
+    return successful_job_count, failed_job_count
+
+
+def run_jobs(settings, job_ids, date_start, smtp_pool, outbox, ssh_pool=None, resume=False, preflight_failures={}):
+    #Runs the given job ids, e-mails the guest credentials and sends the admin report/error e-mails
+    #With resume a job continues from its journal (JournalDir) instead of starting over
+    #Jobs with a WLC in preflight_failures (see run_preflight_checks) fail straight away
+    admin_email_msg = ''
+    csv_exception_occurred = False
+    job_results = []
+    log_run_id.set(uuid.uuid4().hex[:12])
+    
+    job_index, duplicate_job_ids = {}, set()
+    try:
+        with metrics.timer('job_data_load_seconds'):
+            job_index, duplicate_job_ids = load_job_data(settings['full_path_csv_file'], settings['csv_rows_skip'])
+    except:
+        load_error = 'Error: it is not possible to correctly load job data from file: ' + settings['full_path_csv_file'] + '\n'
+        log.error(load_error)
+        admin_email_subject = "Error / Wireless Guest User Creation - Unable to load job data file"
+        admin_email_msg = load_error
+        send_generic_mail(settings['email_server'], settings['admin_email_sender_name'], settings['admin_email_sender_address'], settings['admin_email_receiver_name'], settings['admin_email_receiver_address'], admin_email_subject, admin_email_msg, smtp_pool)
+        csv_exception_occurred = True
+        
+    #with GroupJobsByController the jobs are prepared first and their WLC commands run together
+    group_jobs = settings['group_jobs_by_controller'] and len(job_ids) > 1
+    jobs = []
+    for argument in job_ids:
+        log_job_id.set(argument)
+        if group_jobs:
+            result = prepare_job(settings, argument, job_index, duplicate_job_ids, date_start, resume)
+            if isinstance(result, guest_job):
+                jobs.append(result)
+                continue
+        else:
+            result = run_job(settings, argument, job_index, duplicate_job_ids, date_start, smtp_pool, outbox, ssh_pool, resume, preflight_failures)
+        if result.result == 'invalid':
+            if csv_exception_occurred != True:
+                admin_email_subject = result.error[0]
+                admin_email_msg = result.error[1]
+                send_generic_mail(settings['email_server'], settings['admin_email_sender_name'], settings['admin_email_sender_address'], settings['admin_email_receiver_name'], settings['admin_email_receiver_address'], admin_email_subject, admin_email_msg, smtp_pool)
+                log.error(('-' * 100) + '\n' + admin_email_msg + '\n' + ('-' * 100))
+                csv_exception_occurred = True
+            continue
+        job_results.append(result)
+    if jobs:
+        job_results += run_jobs_by_controller(settings, jobs, smtp_pool, outbox, ssh_pool, preflight_failures)
+        
+    return send_admin_report(settings, job_results, smtp_pool)
+
+
+def run_jobs_by_controller(settings, jobs, smtp_pool, outbox, ssh_pool=None, preflight_failures={}):
+    #Runs the WLC commands of the guest_jobs grouped by controller, then e-mails and reports each job on its own
+    #streaming jobs and jobs with a non-matching WLC list are run one by one as usual
+    preflight_results = dict((job.id, job.preflight_results(preflight_failures)) for job in jobs)
+    grouped_jobs = [job for job in jobs if job.wlc_list_valid() and not job.streaming() and not preflight_results[job.id]]
+    grouped_wlc_creation_results = []
+    if grouped_jobs:
+        log_job_id.set('')
+        log.info('Running the WLC commands of job ids %s grouped by controller' % ', '.join(job.id for job in grouped_jobs))
+        log.info('-' * 100)
+        grouped_wlc_creation_results = issue_commands_by_controller(settings, grouped_jobs, ssh_pool)
+    
+    job_results = []
+    for job in jobs:
+        log_job_id.set(job.id)
+        if job in grouped_jobs:
+            wlc_creation_results = grouped_wlc_creation_results[grouped_jobs.index(job)]
+        elif preflight_results[job.id]:
+            wlc_creation_results = preflight_results[job.id]
+        else:
+            wlc_creation_results = job.run_on_devices(smtp_pool, outbox, ssh_pool)
+        job_results.append(job.finish(wlc_creation_results, smtp_pool, outbox))
+    return job_results
+
+
+class work_queue(object):
+    """Job ids shared by several worker processes through a SQLite file
+    
+    Job ids are enqueued in batches, a worker claims one job id at a time with a lease it keeps renewing
+    while the job runs and stores the job_result, the coordinator builds the admin report of a batch from them.
+    A job id whose worker stopped renewing its lease is run again by another worker (from its journal),
+    after MaxAttempts it is given up.
+    """
+    def __init__(self, queue_file, lease_seconds=600, max_attempts=3):
+        self.queue_file = queue_file
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS work_batches (batch_id TEXT PRIMARY KEY, enqueued REAL NOT NULL, reported REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS work_units (unit_id INTEGER PRIMARY KEY AUTOINCREMENT, batch_id TEXT NOT NULL, job_id TEXT NOT NULL, '
+                'status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, lease_until REAL, finished REAL, '
+                'result TEXT, user_qty INTEGER, report TEXT, error TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS work_units_status ON work_units (status, unit_id)')
+            db.execute('CREATE INDEX IF NOT EXISTS work_units_batch ON work_units (batch_id)')
+    
+    
+    @contextmanager
+    def connect(self):
+        #autocommit connection, transactions are opened explicitly with BEGIN IMMEDIATE
+        import sqlite3
+        db = sqlite3.connect(self.queue_file, timeout=60, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+    
+    
+    def expire_leases(self, db, now):
+        #units whose lease ran out MaxAttempts times are given up, the others can be claimed again
+        db.execute('UPDATE work_units SET status = ?, finished = ? WHERE status = ? AND lease_until < ? AND attempts >= ?', ('abandoned', now, 'running', now, self.max_attempts))
+    
+    
+    def enqueue(self, job_ids):
+        #Returns the batch id of the job ids
+        batch_id = uuid.uuid4().hex[:12]
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('INSERT INTO work_batches (batch_id, enqueued) VALUES (?, ?)', (batch_id, time()))
+            db.executemany('INSERT INTO work_units (batch_id, job_id, status) VALUES (?, ?, ?)', [(batch_id, job_id, 'queued') for job_id in job_ids])
+            db.execute('COMMIT')
+        return batch_id
+    
+    
+    def claim(self, worker_id):
+        #Returns (unit_id, batch_id, job_id, attempt) of the oldest unit nobody holds a lease on, or None
+        #a job id is never run by two workers at the same time
+        now = time()
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                self.expire_leases(db, now)
+                unit = db.execute('SELECT unit_id, batch_id, job_id, attempts FROM work_units WHERE (status = ? OR (status = ? AND lease_until < ?)) '
+                    'AND job_id NOT IN (SELECT job_id FROM work_units WHERE status = ? AND lease_until >= ?) ORDER BY unit_id LIMIT 1',
+                    ('queued', 'running', now, 'running', now)).fetchone()
+                if unit:
+                    db.execute('UPDATE work_units SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1 WHERE unit_id = ?', ('running', worker_id, now + self.lease_seconds, unit[0]))
+                db.execute('COMMIT')
+            except:
+                db.execute('ROLLBACK')
+                raise
+        return unit and (unit[0], unit[1], unit[2], unit[3] + 1)
+    
+    
+    def renew(self, unit_id, worker_id):
+        #Returns False when the lease was lost to another worker
+        with self.connect() as db:
+            return db.execute('UPDATE work_units SET lease_until = ? WHERE unit_id = ? AND worker = ? AND status = ?', (time() + self.lease_seconds, unit_id, worker_id, 'running')).rowcount == 1
+    
+    
+    def complete(self, unit_id, worker_id, result):
+        #Stores the job_result of a unit, returns False when the lease was lost to another worker
+        with self.connect() as db:
+            return db.execute('UPDATE work_units SET status = ?, finished = ?, result = ?, user_qty = ?, report = ?, error = ? WHERE unit_id = ? AND worker = ? AND status = ?',
+                ('done', time(), result.result, result.user_qty, result.report, json.dumps(result.error), unit_id, worker_id, 'running')).rowcount == 1
+    
+    
+    def unfinished(self, batch_id=None):
+        #Number of units queued or running, in a batch or in the whole queue
+        now = time()
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            self.expire_leases(db, now)
+            db.execute('COMMIT')
+            if batch_id:
+                return db.execute('SELECT COUNT(*) FROM work_units WHERE status IN (?, ?) AND batch_id = ?', ('queued', 'running', batch_id)).fetchone()[0]
+            return db.execute('SELECT COUNT(*) FROM work_units WHERE status IN (?, ?)', ('queued', 'running')).fetchone()[0]
+    
+    
+    def latest_batch(self):
+        with self.connect() as db:
+            batch = db.execute('SELECT batch_id FROM work_batches ORDER BY enqueued DESC LIMIT 1').fetchone()
+        return batch and batch[0]
+    
+    
+    def batch(self, batch_id):
+        #Returns (reported, units) of a batch, units are (job_result, status, worker, attempts), None for an unknown batch
+        with self.connect() as db:
+            batch = db.execute('SELECT reported FROM work_batches WHERE batch_id = ?', (batch_id,)).fetchone()
+            if batch is None:
+                return None
+            units = db.execute('SELECT job_id, result, user_qty, report, error, status, worker, attempts FROM work_units WHERE batch_id = ? ORDER BY unit_id', (batch_id,)).fetchall()
+        return batch[0], [(job_result(job_id, result, user_qty or 0, report or '', error and json.loads(error)), status, worker, attempts) for job_id, result, user_qty, report, error, status, worker, attempts in units]
+    
+    
+    def mark_reported(self, batch_id):
+        with self.connect() as db:
+            db.execute('UPDATE work_batches SET reported = ? WHERE batch_id = ?', (time(), batch_id))
+
+
+def run_worker(settings, smtp_pool, outbox, ssh_pool=None):
+    #Runs the job ids of the work queue one after the other until CTRL-C or SIGTERM
+    #and, with WorkerExitWhenIdle, until no job id is queued or running anywhere
+    import sqlite3
+    work_queue_db = work_queue(settings['full_path_queue_file'], settings['queue_lease_seconds'], settings['queue_max_attempts'])
+    worker_id = '%s:%s' % (socket.gethostname(), os.getpid())
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    log.info('Worker %s started on work queue %s' % (worker_id, settings['full_path_queue_file']))
+    log.info('-' * 100)
+    
+    while not stop_event.is_set():
+        unit = work_queue_db.claim(worker_id)
+        if unit is None:
+            if settings['worker_exit_when_idle'] and work_queue_db.unfinished() == 0:
+                log.info('Worker: the work queue is empty')
+                break
+            if ssh_pool: ssh_pool.evict_idle()
+            stop_event.wait(settings['queue_poll_interval'])
+            continue
+        
+        unit_id, batch_id, job_id, attempt = unit
+        #the batch id is the run id, the logs of all the workers of a batch share it
+        log_run_id.set(batch_id)
+        log_job_id.set(job_id)
+        log.info('Worker: running job id %s of batch %s (attempt %s)\n' % (job_id, batch_id, attempt) + '-' * 100)
+        
+        #the lease is renewed in the background while the job runs
+        job_done = threading.Event()
+        def renew_lease():
+            while not job_done.wait(settings['queue_lease_seconds'] / 3.0):
+                try:
+                    if not work_queue_db.renew(unit_id, worker_id):
+                        log.error('Error: the lease on job id ' + job_id + ' was lost, another worker may run it again')
+                        return
+                except sqlite3.Error as e:
+                    log.error('Error: the lease on job id ' + job_id + ' could not be renewed (' + str(e) + ')')
+        lease_thread = threading.Thread(target=renew_lease, daemon=True)
+        lease_thread.start()
+        
+        try:
+            with metrics.timer('job_data_load_seconds'):
+                job_index, duplicate_job_ids = load_job_data(settings['full_path_csv_file'], settings['csv_rows_skip'])
+            #a job id run again after its worker was lost continues from its journal
+            result = run_job(settings, job_id, job_index, duplicate_job_ids, datetime.utcnow(), smtp_pool, outbox, ssh_pool, attempt > 1)
+            if result.result == 'invalid':
+                send_generic_mail(settings['email_server'], settings['admin_email_sender_name'], settings['admin_email_sender_address'], settings['admin_email_receiver_name'], settings['admin_email_receiver_address'], result.error[0], result.error[1], smtp_pool)
+                log.error(('-' * 100) + '\n' + result.error[1] + '\n' + ('-' * 100))
+        except Exception:
+            log.error('Worker: job id ' + job_id + ' stopped with an unexpected error: %s', sys.exc_info()[0])
+            admin_email_subject = 'Error / Wireless Guest User Creation - job id ' + job_id + ' failed.'
+            admin_email_msg = 'An error occurred in the Wireless Guest User Creation script.<br><br>Job id %s stopped on worker %s with an unexpected error: %s<br>' % (job_id, worker_id, html.escape(str(sys.exc_info()[1])))
+            send_generic_mail(settings['email_server'], settings['admin_email_sender_name'], settings['admin_email_sender_address'], settings['admin_email_receiver_name'], settings['admin_email_receiver_address'], admin_email_subject, admin_email_msg, smtp_pool)
+            result = job_result(job_id, 'failed', 0, '', [admin_email_subject, admin_email_msg])
+        finally:
+            job_done.set()
+            lease_thread.join()
+        
+        if not work_queue_db.complete(unit_id, worker_id, result):
+            log.error('Error: the result of job id ' + job_id + ' was not stored, its lease was lost to another worker')
+        #the worker keeps adding to the same metrics, the files are refreshed after every job
+        metrics.write(settings['full_path_metrics_report_file'], settings['full_path_metrics_textfile'])
+        log_run_id.set('')
+        log_job_id.set('')
+    log.info('Worker %s stopped' % worker_id)
+
+
+def collect_work_batch(settings, batch_id, smtp_pool):
+    #Coordinator: waits until the workers have run every job id of the batch, then sends its admin report
+    #Returns False for an unknown batch, or when job ids are still pending after CollectTimeout seconds (the batch is then left unreported)
+    work_queue_db = work_queue(settings['full_path_queue_file'], settings['queue_lease_seconds'], settings['queue_max_attempts'])
+    batch_id = batch_id or work_queue_db.latest_batch()
+    if not batch_id or work_queue_db.batch(batch_id) is None:
+        log.error('Error: batch %s is not in the work queue %s' % (batch_id, settings['full_path_queue_file']))
+        return False
+    log_run_id.set(batch_id)
+    
+    unfinished = work_queue_db.unfinished(batch_id)
+    if unfinished:
+        log.info('Waiting for the workers to run the %s job ids left in batch %s' % (unfinished, batch_id))
+    collect_deadline = monotonic() + settings['queue_collect_timeout']
+    while unfinished and monotonic() < collect_deadline:
+        sleep(min(settings['queue_poll_interval'], max(collect_deadline - monotonic(), 0)))
+        unfinished = work_queue_db.unfinished(batch_id)
+    
+    reported, units = work_queue_db.batch(batch_id)
+    if unfinished:
+        #no worker finished them in time (all workers stopped?), a later --collect can still report the batch
+        pending_units = ['%s (%s%s, %s attempts)' % (result.job_id, status, ' on worker ' + worker if worker else '', attempts) for result, status, worker, attempts in units if status in ('queued', 'running')]
+        admin_email_subject = 'Error / Wireless Guest User Creation - batch ' + batch_id + ' not complete.'
+        admin_email_msg = 'An error occurred in the Wireless Guest User Creation script.<br><br>%s job ids of batch %s were still pending after %s seconds, the batch was not reported:<br>%s<br><br>Check that workers are running, then run the script with --collect=%s again<br>' % (
+            len(pending_units), batch_id, settings['queue_collect_timeout'], '<br>'.join(pending_units), batch_id)
+        log.error(admin_email_msg)
+        send_generic_mail(settings['email_server'], settings['admin_email_sender_name'], settings['admin_email_sender_address'], settings['admin_email_receiver_name'], settings['admin_email_receiver_address'], admin_email_subject, admin_email_msg, smtp_pool)
+        return False
+    if reported:
+        log.info('Batch %s was already reported on %s' % (batch_id, datetime.fromtimestamp(reported).strftime(fmtlog)))
+        return True
+    job_results = []
+    for result, status, worker, attempts in units:
+        if status == 'abandoned':
+            #nobody could complete it, the workers did not send an error e-mail for it
+            admin_email_subject = 'Error / Wireless Guest User Creation - job id ' + result.job_id + ' failed.'
+            admin_email_msg = 'An error occurred in the Wireless Guest User Creation script.<br><br>Job id %s of batch %s was given up after %s attempts, the last one on worker %s stopped renewing its lease.<br>' % (result.job_id, batch_id, attempts, worker)
+            if settings['full_path_journal_dir']:
+                admin_email_msg += 'Run the script with --resume %s to continue the job with the same passwords<br>' % result.job_id
+            log.error(admin_email_msg)
+            send_generic_mail(settings['email_server'], settings['admin_email_sender_name'], settings['admin_email_sender_address'], settings['admin_email_receiver_name'], settings['admin_email_receiver_address'], admin_email_subject, admin_email_msg, smtp_pool)
+            job_results.append(result._replace(result='failed'))
+        elif result.result != 'invalid':
+            job_results.append(result)
+    successful_job_count, failed_job_count = send_admin_report(settings, job_results, smtp_pool)
+    work_queue_db.mark_reported(batch_id)
+    log.info('Batch %s: %s successful jobs, %s failed jobs' % (batch_id, successful_job_count, failed_job_count))
+    log.info('-' * 100)
+    return True
+
+
+def sweep_ledger(settings, smtp_pool, ssh_pool=None):
+    #Deletes the expired accounts of the ledger from their WLCs, all the accounts of a WLC in one session, up to MaxParallelControllers WLCs at a time
+    #Only the accounts whose delete the WLC confirmed (deleted or already absent) leave the ledger,
+    #the others and the WLCs that could not be swept are reported in an admin error e-mail and swept again next time
+    if not settings['full_path_ledger_file']:
+        log.error('Error: LedgerFile is not set in config.ini, there is no ledger to sweep')
+        return
+    ledger = account_ledger(settings['full_path_ledger_file'])
+    expired_accounts = ledger.expired(time())
+    log.info('Ledger sweep: %s expired accounts on %s WLCs' % (sum(len(users) for controller_name, users in expired_accounts.values()), len(expired_accounts)))
+    log.info('-' * 100)
+    sweep_failures = []
+    for transport_name in sorted(set(transport_name for transport_name, controller in expired_accounts)):
+        controllers = [(controller, controller_name, users) for (controller_transport_name, controller), (controller_name, users) in expired_accounts.items() if controller_transport_name == transport_name]
+        wlc_ip = [controller for controller, controller_name, users in controllers]
+        wlc_name = [controller_name for controller, controller_name, users in controllers]
+        #both delete syntaxes, like the delete commands of a job
+        command_lists = dict((controller, [command for user in users for command in ('config netuser delete username ' + user, 'config netuser delete ' + user)]) for controller, controller_name, users in controllers)
+        transport = wlc_transports.get(transport_name, cli_transport)(settings)
+        #the outcome of a WLC only reflects user adds, the recorder keeps the deletes each WLC confirmed
+        sweep_recorder = ledger.recorder('ledger sweep', dict(zip(wlc_ip, wlc_name)), transport_name, 0)
+        wlc_sweep_results = issue_commands_on_devices(settings['platform'], wlc_name, wlc_ip, settings['username'], settings['password'], command_lists, 'ledger sweep', settings['max_parallel_controllers'], settings['command_batch_size'], settings['reconcile_netusers'], settings['netuser_delete_syntax'], ssh_pool, True, settings['ssh_port'], sweep_recorder, transport)
+        ledger.flush()
+        for (controller, controller_name, users), wlc_sweep_result in zip(controllers, wlc_sweep_results):
+            left_users = sorted(ledger.controller_users(controller) & set(users))
+            metrics.increment('ledger_swept_accounts', len(users) - len(left_users), controller=controller)
+            if left_users or wlc_sweep_result != 'success':
+                reason = wlc_sweep_result if wlc_sweep_result != 'success' else 'the WLC did not confirm the delete of ' + ', '.join(left_users)
+                sweep_failures.append('%s (%s): %s of %s expired accounts not deleted - %s' % (controller_name, controller, len(left_users), len(users), reason))
+                metrics.increment('ledger_sweep_failures', controller=controller)
+    
+    if sweep_failures:
+        admin_email_subject = 'Error / Wireless Guest User Creation - ledger sweep failed on %s WLCs' % len(sweep_failures)
+        admin_email_msg = 'An error occurred in the Wireless Guest User Creation script.<br><br>The expired guest accounts of these WLCs could not be deleted, they stay in the ledger and are swept again next time:<br>' + '<br>'.join(sweep_failures)
+        log.error('Error: ledger sweep failed on %s WLCs' % len(sweep_failures))
+        log.info('\nSending e-mail to Admin Recipient: ' + settings['fmt_admin_email_receiver_address'] + '\n' + admin_email_subject + '\n' + '-' * 100)
+        send_generic_mail(settings['email_server'], settings['admin_email_sender_name'], settings['admin_email_sender_address'], settings['admin_email_receiver_name'], settings['admin_email_receiver_address'], admin_email_subject, admin_email_msg, smtp_pool)
+        log.info('-' * 100)
+    else:
+        log.info('Ledger sweep completed')
+        log.info('-' * 100)
+
+
+class warm_pool(object):
+    """Guest accounts created ahead of time on the WLCs of a job and handed out one at a time (--warm-pool)
+    
+    Kept in a SQLite file (passwords included, only readable by the user running the script).
+    An account is ready once it exists on every WLC of its job, issued once handed out.
+    """
+    def __init__(self, pool_file):
+        self.pool_file = pool_file
+        if not os.path.exists(pool_file):
+            os.close(os.open(pool_file, os.O_CREAT | os.O_WRONLY, 0o600))
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS pool_accounts (user TEXT PRIMARY KEY, pool_id TEXT NOT NULL, password TEXT NOT NULL, '
+                'created REAL NOT NULL, expires REAL NOT NULL, status TEXT NOT NULL, issued REAL, issued_to TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS pool_accounts_ready ON pool_accounts (pool_id, status, created)')
+            db.execute('CREATE TABLE IF NOT EXISTS pool_counters (pool_id TEXT PRIMARY KEY, next_number INTEGER NOT NULL)')
+    
+    
+    @contextmanager
+    def connect(self):
+        #autocommit connection, transactions are opened explicitly with BEGIN IMMEDIATE
+        import sqlite3
+        db = sqlite3.connect(self.pool_file, timeout=60, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+    
+    
+    def reserve_numbers(self, pool_id, count):
+        #Returns the first of count user numbers never used before in the pool
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            counter = db.execute('SELECT next_number FROM pool_counters WHERE pool_id = ?', (pool_id,)).fetchone()
+            first_number = counter[0] if counter else 1
+            db.execute('INSERT OR REPLACE INTO pool_counters (pool_id, next_number) VALUES (?, ?)', (pool_id, first_number + count))
+            db.execute('COMMIT')
+        return first_number
+    
+    
+    def add_accounts(self, pool_id, user_credentials, created, lifetime):
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('INSERT INTO pool_accounts (user, pool_id, password, created, expires, status) VALUES (?, ?, ?, ?, ?, ?)',
+                [(user, pool_id, password, created, created + lifetime, 'ready') for user, password in user_credentials])
+            db.execute('COMMIT')
+    
+    
+    def take(self, pool_id, created_after, issued_to):
+        #Returns the oldest ready account created after created_after as (guest_user, created, expires), or None
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            account = db.execute('SELECT user, password, created, expires FROM pool_accounts WHERE pool_id = ? AND status = ? AND created > ? ORDER BY created LIMIT 1', (pool_id, 'ready', created_after)).fetchone()
+            if account:
+                db.execute('UPDATE pool_accounts SET status = ?, issued = ?, issued_to = ? WHERE user = ?', ('issued', time(), issued_to, account[0]))
+            db.execute('COMMIT')
+        return account and (guest_user(account[0], account[1]), account[2], account[3])
+    
+    
+    def release(self, user):
+        #Puts an issued account back in its pool, as when it was created
+        with self.connect() as db:
+            db.execute('UPDATE pool_accounts SET status = ?, issued = NULL, issued_to = NULL WHERE user = ? AND status = ?', ('ready', user, 'issued'))
+    
+    
+    def ready_count(self, pool_id, created_after):
+        with self.connect() as db:
+            return db.execute('SELECT COUNT(*) FROM pool_accounts WHERE pool_id = ? AND status = ? AND created > ?', (pool_id, 'ready', created_after)).fetchone()[0]
+    
+    
+    def stale_users(self, pool_id, created_before):
+        #ready accounts too old to be handed out
+        with self.connect() as db:
+            return [user for user, in db.execute('SELECT user FROM pool_accounts WHERE pool_id = ? AND status = ? AND created <= ?', (pool_id, 'ready', created_before))]
+    
+    
+    def remove(self, users):
+        with self.connect() as db:
+            db.executemany('DELETE FROM pool_accounts WHERE user = ?', [(user,) for user in users])
+    
+    
+    def prune_issued(self, now):
+        #issued accounts are kept until they expire on the WLCs
+        with self.connect() as db:
+            db.execute('DELETE FROM pool_accounts WHERE status = ? AND expires < ?', ('issued', now))
+    
+    
+    def status(self):
+        #Returns {pool_id: {status: count}}
+        pool_status = {}
+        with self.connect() as db:
+            for pool_id, status, count in db.execute('SELECT pool_id, status, COUNT(*) FROM pool_accounts GROUP BY pool_id, status'):
+                pool_status.setdefault(pool_id, {})[status] = count
+        return pool_status
+
+
+def load_warm_pools(config_file):
+    #Reads the [WARM_POOL_JOBS] section (job id = pool size and low-water mark)
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(config_file)
+    warm_pools = {}
+    if config.has_section('WARM_POOL_JOBS'):
+        for job_id, pool_sizes in config.items('WARM_POOL_JOBS'):
+            pool_size, low_water_mark = [int(value) for value in pool_sizes.split()]
+            if not 0 <= low_water_mark <= pool_size:
+                raise ValueError('the low-water mark of warm pool %s must be between 0 and its size' % job_id)
+            warm_pools[job_id] = (pool_size, low_water_mark)
+    return warm_pools
+
+
+def warm_pool_min_created(settings, job_row, now):
+    #accounts created before this time have less than MinRemainingLifetime of their lifetime left
+    return now - int(job_row[8]) * (1 - settings['warm_pool_min_remaining_lifetime'])
+
+
+def refill_warm_pool(settings, pool, pool_id, job_row, pool_size, low_water_mark, ssh_pool=None):
+    #Deletes the stale accounts of the pool from the WLCs and, when fewer than low_water_mark accounts are ready,
+    #creates accounts in batches of RefillBatchSize until pool_size are ready
+    #Returns the number of accounts created
+    wlc_ip = job_row[1].split(';')
+    wlc_name = job_row[2].split(';')
+    transport = wlc_transports[(job_row[13] if len(job_row) > 13 else '') or settings['default_transport']](settings)
+    ledger = account_ledger(settings['full_path_ledger_file']) if settings['full_path_ledger_file'] else None
+    command_callback = ledger and ledger.recorder(pool_id, dict(zip(wlc_ip, wlc_name)), transport.name, int(job_row[8]))
+    now = time()
+    min_created = warm_pool_min_created(settings, job_row, now)
+    
+    stale_users = pool.stale_users(pool_id, min_created)
+    if stale_users:
+        log.info('Warm pool %s: deleting %s accounts too old to be handed out' % (pool_id, len(stale_users)))
+        command_list = []
+        for user in stale_users:
+            command_list += build_user_commands(guest_user(user, ''), job_row[5], job_row[7], job_row[8], job_row[10])[:2]
+        issue_commands_on_devices(settings['platform'], wlc_name, wlc_ip, settings['username'], settings['password'], command_list, pool_id, settings['max_parallel_controllers'], settings['command_batch_size'], settings['reconcile_netusers'], settings['netuser_delete_syntax'], ssh_pool, True, settings['ssh_port'], command_callback, transport)
+        if ledger: ledger.flush()
+        #accounts a WLC failed to delete expire there on their own
+        pool.remove(stale_users)
+        metrics.increment('warm_pool_accounts', len(stale_users), pool=pool_id, event='recycled')
+    
+    ready_count = pool.ready_count(pool_id, min_created)
+    if ready_count >= low_water_mark and ready_count > 0:
+        return 0
+    created_count = 0
+    while ready_count + created_count < pool_size:
+        batch_size = min(pool_size - ready_count - created_count, settings['warm_pool_refill_batch_size'])
+        #pool accounts are named user_prefix_W_N so they never clash with the users of the job itself
+        user_credentials = list(generate_guest_users(job_row[3] + '_W', pool.reserve_numbers(pool_id, batch_size), batch_size))
+        command_list = []
+        for guest_credential in user_credentials:
+            command_list += build_user_commands(guest_credential, job_row[5], job_row[7], job_row[8], job_row[10])
+        log.info('Warm pool %s: creating %s accounts (%s ready of %s)' % (pool_id, batch_size, ready_count + created_count, pool_size))
+        created = time()
+        wlc_creation_results = issue_commands_on_devices(settings['platform'], wlc_name, wlc_ip, settings['username'], settings['password'], command_list, pool_id, settings['max_parallel_controllers'], settings['command_batch_size'], settings['reconcile_netusers'], settings['netuser_delete_syntax'], ssh_pool, True, settings['ssh_port'], command_callback, transport)
+        if ledger: ledger.flush()
+        if wlc_creation_results.count('success') != len(wlc_ip):
+            log.error('Error: warm pool %s could not be refilled: %s' % (pool_id, '; '.join(result for result in wlc_creation_results if result != 'success')))
+            break
+        pool.add_accounts(pool_id, user_credentials, created, int(job_row[8]))
+        metrics.increment('warm_pool_accounts', batch_size, pool=pool_id, event='created')
+        created_count += batch_size
+    return created_count
+
+
+def hand_out_warm_pool_account(settings, pool, pool_id, job_row, email_address, smtp_pool):
+    #Takes a ready account of the pool and e-mails it at once to email_address (the email of the job when empty)
+    #Returns the details of the account handed out, None when the pool is empty
+    #or {'error': reason} when the e-mail could not be sent (the account then goes back to the pool)
+    from pytz import timezone
+    guest_email_receiver_address = (email_address or job_row[11]).split(';')
+    with metrics.timer('warm_pool_handout_seconds', pool=pool_id):
+        account = pool.take(pool_id, warm_pool_min_created(settings, job_row, time()), ';'.join(guest_email_receiver_address))
+        if account is None:
+            metrics.increment('warm_pool_accounts', pool=pool_id, event='empty')
+            return None
+        guest_credential, created, expires = account
+        #the lifetime on the WLC started when the account was created
+        localized_date_start = datetime.now(timezone(job_row[9])).strftime(fmt)
+        localized_date_end = datetime.fromtimestamp(expires, timezone(job_row[9])).strftime(fmt)
+        log.info('Warm pool %s: handing out %s to %s' % (pool_id, guest_credential.user, fmt_multiple_email_addresses(guest_email_receiver_address)))
+        if not send_guest_user_mail([guest_credential], job_row[6], 'guest', localized_date_start, localized_date_end, settings['email_server'], settings['guest_email_sender_name'], settings['guest_email_sender_address'], guest_email_receiver_address, smtp_pool):
+            pool.release(guest_credential.user)
+            metrics.increment('warm_pool_accounts', pool=pool_id, event='mail_failed')
+            log.error('Error: warm pool %s: the e-mail to %s could not be sent, %s goes back to the pool' % (pool_id, fmt_multiple_email_addresses(guest_email_receiver_address), guest_credential.user))
+            return {'error': 'the e-mail to %s could not be sent, try again later' % ';'.join(guest_email_receiver_address)}
+    metrics.increment('warm_pool_accounts', pool=pool_id, event='handed_out')
+    return {'pool': pool_id, 'user': guest_credential.user, 'password': guest_credential.password, 'ssid': job_row[6], 'active_from': localized_date_start, 'active_until': localized_date_end, 'emailed_to': guest_email_receiver_address}
+
+
+#largest hand-out request body read
+warm_pool_max_request_bytes = 65536
+
+
+class warm_pool_request_handler(object):
+    """Local hand-out interface of the warm pools, combined with http.server's BaseHTTPRequestHandler by run_warm_pool()
+    
+    POST /handout with pool (job id) and optional email, as JSON or form fields: hands out and e-mails one account
+    GET /pools: ready and issued accounts of each pool
+    """
+    def log_message(self, format, *args):
+        log.info('Warm pool request from %s: %s' % (self.client_address[0], format % args))
+    
+    
+    def reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+    
+    
+    def authorized(self):
+        #run_warm_pool() does not start without a token, it is compared in constant time so replies do not leak it
+        from hmac import compare_digest
+        token = self.server.settings['warm_pool_handout_token']
+        if not token or not compare_digest(self.headers.get('Authorization', '').encode('utf-8', 'surrogateescape'), ('Bearer ' + token).encode('utf-8')):
+            self.reply(401, {'error': 'missing or wrong hand-out token'})
+            return False
+        return True
+    
+    
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if urlparse(self.path).path != '/pools':
+            return self.reply(404, {'error': 'unknown path'})
+        pool_status = self.server.pool.status()
+        self.reply(200, {pool_id: dict(pool_status.get(pool_id, {}), size=pool_size, low_water_mark=low_water_mark) for pool_id, (pool_size, low_water_mark) in self.server.warm_pools.items()})
+    
+    
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if urlparse(self.path).path != '/handout':
+            return self.reply(404, {'error': 'unknown path'})
+        try:
+            content_length = int(self.headers.get('Content-Length', '0'))
+        except ValueError:
+            content_length = -1
+        if not 0 <= content_length <= warm_pool_max_request_bytes:
+            return self.reply(400, {'error': 'missing, invalid or too large Content-Length'})
+        body = self.rfile.read(content_length).decode(errors='replace')
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                request = json.loads(body or '{}')
+            else:
+                request = dict((key, values[0]) for key, values in parse_qs(body or urlparse(self.path).query).items())
+        except ValueError:
+            return self.reply(400, {'error': 'the request is not valid JSON'})
+        pool_id = request.get('pool', '')
+        job_row = self.server.job_rows.get(pool_id)
+        if pool_id not in self.server.warm_pools or job_row is None:
+            return self.reply(404, {'error': 'no warm pool for job id "%s"' % pool_id})
+        
+        log_job_id.set(pool_id)
+        account = hand_out_warm_pool_account(self.server.settings, self.server.pool, pool_id, job_row, request.get('email', ''), self.server.smtp_pool)
+        #the pool is refilled in the background
+        self.server.refill_event.set()
+        if account is None:
+            return self.reply(503, {'error': 'warm pool %s has no account ready, it is being refilled' % pool_id})
+        if 'error' in account:
+            return self.reply(502, account)
+        self.reply(200, account)
+
+
+def run_warm_pool(config_file, settings, smtp_pool, ssh_pool=None):
+    #Keeps the pools of [WARM_POOL_JOBS] filled and serves the hand-out interface until CTRL-C or SIGTERM
+    #config.ini and the job data file are reloaded when they change on disk
+    #Returns False when it cannot start
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    if not settings['warm_pool_handout_token']:
+        #anybody reaching the port could get guest passwords
+        log.error('Error: the warm pool is not started, HandoutToken has to be set in the [WARM_POOL] section of ' + config_file)
+        return False
+    warm_pools = load_warm_pools(config_file)
+    pool = warm_pool(settings['full_path_warm_pool_file'])
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    
+    server = ThreadingHTTPServer((settings['warm_pool_listen_address'], settings['warm_pool_listen_port']), type('warm_pool_http_handler', (warm_pool_request_handler, BaseHTTPRequestHandler), {}))
+    server.daemon_threads = True
+    server.settings = settings
+    server.pool = pool
+    server.warm_pools = warm_pools
+    server.job_rows = {}
+    server.smtp_pool = smtp_pool
+    server.refill_event = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info('Warm pool started with %s pools (%s), hand-out interface on http://%s:%s/handout' % (len(warm_pools), ', '.join(warm_pools), settings['warm_pool_listen_address'], server.server_address[1]))
+    log.info('-' * 100)
+    
+    config_mtime = os.stat(config_file).st_mtime_ns
+    try:
+        while not stop_event.is_set():
+            if os.stat(config_file).st_mtime_ns != config_mtime:
+                config_mtime = os.stat(config_file).st_mtime_ns
+                try:
+                    #a new listen address or port needs a restart
+                    server.settings = settings = load_settings(config_file)
+                    server.warm_pools = warm_pools = load_warm_pools(config_file)
+                    log.info('Warm pool: reloaded config file ' + config_file)
+                except Exception as e:
+                    log.error('Error: config file ' + config_file + ' could not be reloaded, previous config is kept (' + str(e) + ')')
+            try:
+                #load_job_data() only parses the job data file again when it changed
+                job_index, duplicate_job_ids = load_job_data(settings['full_path_csv_file'], settings['csv_rows_skip'])
+                server.job_rows = dict((pool_id, job_index[pool_id]) for pool_id in warm_pools if pool_id in job_index and pool_id not in duplicate_job_ids)
+            except Exception as e:
+                log.error('Error: the job data file ' + settings['full_path_csv_file'] + ' could not be read (' + str(e) + ')')
+            
+            for pool_id, (pool_size, low_water_mark) in warm_pools.items():
+                if stop_event.is_set():
+                    break
+                log_job_id.set(pool_id)
+                if pool_id not in server.job_rows:
+                    log.error('Error: warm pool %s has no single matching job id in the job data file' % pool_id)
+                    continue
+                try:
+                    refill_warm_pool(settings, pool, pool_id, server.job_rows[pool_id], pool_size, low_water_mark, ssh_pool)
+                except Exception:
+                    log.error('Warm pool %s: refill stopped with an unexpected error: %s' % (pool_id, sys.exc_info()[1]))
+            log_job_id.set('')
+            pool.prune_issued(time())
+            if ssh_pool: ssh_pool.evict_idle()
+            metrics.write(settings['full_path_metrics_report_file'], settings['full_path_metrics_textfile'])
+            
+            #hand-outs wake the refill up early
+            refill_deadline = monotonic() + settings['warm_pool_refill_interval']
+            while not stop_event.is_set() and not server.refill_event.is_set() and monotonic() < refill_deadline:
+                server.refill_event.wait(1)
+            server.refill_event.clear()
+    except KeyboardInterrupt:
+        pass
+    log.info('Warm pool: stopping')
+    server.shutdown()
+    server.server_close()
+    return True
+
+
+def main(argv):
+    config_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),'config.ini')
+    
+    script_options, argv = split_script_options(argv)
+    for script_option in script_options:
+        if script_option.startswith('--config='):
+            config_file = os.path.abspath(script_option.split('=', 1)[1])
+    if '--check' in script_options:
+        sys.exit(0 if check_configuration(config_file, argv) else 1)
+    if '--active' in script_options or any(script_option.startswith('--active=') for script_option in script_options):
+        #--active=WLC (IP or name) lists the accounts of one WLC
+        active_controller = ([script_option.split('=', 1)[1] for script_option in script_options if script_option.startswith('--active=')] or [''])[0]
+        sys.exit(0 if show_active_accounts(config_file, active_controller) else 1)
+    if '--plan' in script_options:
+        #--calibrate=FILE (repeatable) or --calibrate for the run report of config.ini
+        report_files = [script_option.split('=', 1)[1] for script_option in script_options if script_option.startswith('--calibrate=')]
+        if '--calibrate' in script_options:
+            report_files.append(load_settings(config_file)['full_path_metrics_report_file'])
+        sys.exit(0 if plan_jobs(config_file, argv, report_files) else 1)
+    daemon_mode = '--daemon' in script_options
+    resume = '--resume' in script_options
+    #work queue: --enqueue JOB-IDs adds a batch, --worker runs queued job ids, --collect[=BATCH] sends the admin report of a batch
+    enqueue = '--enqueue' in script_options
+    worker_mode = '--worker' in script_options
+    collect = '--collect' in script_options or any(script_option.startswith('--collect=') for script_option in script_options)
+    collect_batch_id = ([script_option.split('=', 1)[1] for script_option in script_options if script_option.startswith('--collect=')] or [''])[0]
+    #warm pool: keeps accounts of the [WARM_POOL_JOBS] job ids ready and hands them out over HTTP
+    warm_pool_mode = '--warm-pool' in script_options
+    #ledger: --sweep deletes the expired accounts of the ledger from the WLCs
+    sweep = '--sweep' in script_options
+    
+    try:
+        with metrics.timer('config_load_seconds'):
+            settings = load_settings(config_file)
+    except:
+        print('Error: it is not possible to read config from file: ' + config_file)
+        sys.exit(0)
+    
+    setup_logging(settings)
+    if settings['adaptive_timing']:
+        controller_timing.configure(settings['full_path_latency_profile_file'], settings['read_timeout_multiplier'], settings['min_read_timeout'], settings['max_read_timeout'])
+    script_start_time = script_start(True, fmtlog)
+    date_start = script_start_time
+    
+    #Argument checks run before anything is connected to
+    if len(argv) == 0 and not (daemon_mode or worker_mode or collect or warm_pool_mode or sweep):
+        log.error('You need to enter at least one id argument!\n')
+        script_end(True, fmtlog)
+        sys.exit(0)
         
-    if file_logging == True:
+    argv_count = Counter(argv)
+    for arg in argv_count:
+        if argv_count[arg] > 1:
+            log.error('Error: id ' + str(arg) + ' has ' + str(argv_count[arg]) + ' duplicates.')
+            log.info('Duplicate script arguments are not allowed, remove them and run the script again.')
+            script_end(True, fmtlog)
+            sys.exit(0)
+            
+    if enqueue:
+        #the workers run the jobs, nothing is connected to here
+        work_queue_db = work_queue(settings['full_path_queue_file'], settings['queue_lease_seconds'], settings['queue_max_attempts'])
+        collect_batch_id = work_queue_db.enqueue(argv)
+        log.info('Enqueued %s job ids as batch %s in the work queue %s' % (len(argv), collect_batch_id, settings['full_path_queue_file']))
+        log.info('-' * 100)
+        if not collect:
+            script_end(True, fmtlog)
+            sys.exit(0)
+            
+    #Every e-mail sent in this run shares the same pooled SMTP sessions
+    smtp_pool = smtp_connection_pool(settings['email_server'], settings['smtp_pool_size'], settings['smtp_max_messages_per_connection'])
+    
+    #WLC sessions are shared by all jobs of the run (or of the daemon) targeting the same WLC
+    if settings['ssh_session_pool']:
+        ssh_pool = ssh_session_pool(settings['ssh_max_sessions_per_controller'], settings['ssh_session_idle_timeout'], settings['ssh_keepalive'])
+    else:
+        ssh_pool = None
+    
+    preflight_failures = {}
+    if settings['preflight_enabled'] and argv and not (daemon_mode or worker_mode or collect or warm_pool_mode):
+        #the SMTP server and the WLCs of the job ids are checked in parallel, jobs with an unreachable WLC fail fast
+        email_test_result, preflight_failures = run_preflight_checks(settings, argv, smtp_pool, ssh_pool)
+    else:
+        log.info('Testing availability of SMTP server: ' + settings['email_server'])
+        with metrics.timer('smtp_test_seconds'):
+            email_test_result = test_email_server(settings['email_server'], smtp_pool)
+    if email_test_result:
+        log.info('-' * 100)
+        if settings['email_outbox_enabled']:
+            #Guest e-mails are spooled to disk and delivered in the background while the jobs keep running
+            outbox = email_outbox(settings['full_path_outbox_dir'], smtp_pool, settings['outbox_workers'], settings['outbox_max_per_second'], settings['outbox_max_attempts'], settings['outbox_retry_delay'])
+            outbox.start()
+        else:
+            outbox = None
+    else:
+        if ssh_pool: ssh_pool.close()
+        smtp_pool.close()
+        metrics.increment('smtp_test_failures')
+        metrics.write(settings['full_path_metrics_report_file'], settings['full_path_metrics_textfile'])
         script_end(True, fmtlog)
-        fd.close()
+        sys.exit(0)
+        
+    if daemon_mode:
+        run_daemon(config_file, settings, smtp_pool, outbox, ssh_pool)
+    elif warm_pool_mode:
+        run_warm_pool(config_file, settings, smtp_pool, ssh_pool)
+    elif worker_mode:
+        run_worker(settings, smtp_pool, outbox, ssh_pool)
+    elif collect:
+        collect_work_batch(settings, collect_batch_id, smtp_pool)
+    else:
+        #expired accounts are swept before the job ids given with --sweep are run
+        if sweep: sweep_ledger(settings, smtp_pool, ssh_pool)
+        if argv: run_jobs(settings, argv, date_start, smtp_pool, outbox, ssh_pool, resume, preflight_failures)
+    if ssh_pool: ssh_pool.close()
+        
+    if outbox:
+        log.info('Waiting for the e-mail outbox to be delivered')
+        outbox.close(settings['outbox_drain_timeout'])
+        log.info('-' * 100)
+    smtp_pool.close()
+    
+    metrics.write(settings['full_path_metrics_report_file'], settings['full_path_metrics_textfile'])
+    script_end(True, fmtlog)
         
 if __name__ == "__main__":
     try:
         main(sys.argv[1:])
     except KeyboardInterrupt:
-        print('\nInterrupted by CTRL-C')
+        log.info('\nInterrupted by CTRL-C')
         script_end(True, fmtlog)
         sys.exit(0)